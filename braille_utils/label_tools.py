@@ -101,13 +101,7 @@ def human_label_to_int(label):
     return label123_to_int(label123)
 
 
-def int_to_letter(int_lbl, langs):
-    '''
-    Gets letter corresponding to int_lbl in a first language dict that contains it
-    :param int_lbl:
-    :param langs: list of language dict codes (see letters.letter_dicts)
-    :return: letter or string (for special symbols that need postprocessing) or None
-    '''
+def _int_to_letter_in_dicts(int_lbl, langs):
     label123 = int_to_label123(int_lbl)
     for lang in langs:
         d = letters.letter_dicts[lang]
@@ -123,6 +117,45 @@ for d in letters.letter_dicts.values():
     for lbl123, char in d.items():
         reverce_dict[char].add(lbl123)
 
+
+_letter_tables = dict()  # tuple of langs -> letter_table
+
+
+def letter_table(langs):
+    '''
+    Lookup table for int_to_letter, built from letters.letter_dicts once for every combination of langs
+    :param langs: list of language dict codes (see letters.letter_dicts). KeyError is raised if some is unknown
+    :return: list of 64 letters (or None) indexed by int_label
+    '''
+    key = tuple(langs)
+    table = _letter_tables.get(key)
+    if table is None:
+        unknown = [lang for lang in key if lang not in letters.letter_dicts]
+        if unknown:
+            raise KeyError(unknown[0])
+        table = [_int_to_letter_in_dicts(int_label, key) for int_label in range(64)]
+        _letter_tables[key] = table
+    return table
+
+
+def int_to_letter(int_lbl, langs):
+    '''
+    Gets letter corresponding to int_lbl in a first language dict that contains it
+    :param int_lbl:
+    :param langs: list of language dict codes (see letters.letter_dicts)
+    :return: letter or string (for special symbols that need postprocessing) or None
+    '''
+    try:
+        return letter_table(langs)[int_lbl]
+    except (KeyError, IndexError, TypeError):
+        # unknown dicts are reported only if lookup reaches them, non-standard labels are looked up directly
+        return _int_to_letter_in_dicts(int_lbl, langs)
+
+
+# tables for dict combinations used in interpretation
+for langs in (['SYM'], ['NUM'], ['NUM_DENOMINATOR'], ['MATH_RU'], ['RU', 'SYM'], ['SYM', 'RU', 'NUM']):
+    letter_table(langs)
+
 # global list of 64 bools indicating what labels are valid in most common language dicts
 label_is_valid = [
     True if (int_to_letter(int_label, ['SYM','RU', 'NUM']) is not None) else False
@@ -6,9 +6,13 @@ import PIL
 
 from braille_utils import letters
 from braille_utils import label_tools as lt
+from braille_utils import transliteration
 
 
 class LineChar:
+    __slots__ = ('original_box', 'x', 'y', 'w', 'h', 'approximation', 'refined_box', 'label', 'spaces_before',
+                 'char', 'labeling_char', 'score')
+
     def __init__(self, box, label):
         self.original_box = box # box found by NN
         self.x = (box[0] + box[2])/2 # original x of last char
@@ -21,6 +25,43 @@ class LineChar:
         self.spaces_before = 0
         self.char = '' # char to display in printed text
         self.labeling_char = '' # char to display in rects labeling
+        self.score = None # detection score if known
+
+
+class PageArrays:
+    """
+    Struct-of-arrays copy of chars of a page (list of Line) for vectorized processing of the whole page.
+    Chars are in lines order. Changes of arrays are written back to LineChar objects by store_... methods.
+    """
+    def __init__(self, lines):
+        self.chars = [ch for ln in lines for ch in ln.chars]
+        self.line_ids = np.repeat(np.arange(len(lines), dtype=np.int32), [len(ln.chars) for ln in lines])
+        n = len(self.chars)
+        self.original_boxes = np.array([ch.original_box[:4] for ch in self.chars], dtype=np.float64).reshape(n, 4)
+        self.refined_boxes = np.array([ch.refined_box[:4] for ch in self.chars], dtype=np.float64).reshape(n, 4)
+        self.labels = np.array([ch.label for ch in self.chars], dtype=np.int32)
+        self.spaces_before = np.array([ch.spaces_before for ch in self.chars], dtype=np.int32)
+
+    def __len__(self):
+        return len(self.chars)
+
+    def is_line_start(self):
+        """
+        :return: bool mask of 1st chars of lines
+        """
+        return np.diff(self.line_ids, prepend=-1) != 0
+
+    def store_refined_boxes(self, mask=None):
+        for i in (range(len(self.chars)) if mask is None else np.flatnonzero(mask)):
+            self.chars[i].refined_box = self.refined_boxes[i].tolist()
+
+    def store_original_boxes(self, mask=None):
+        for i in (range(len(self.chars)) if mask is None else np.flatnonzero(mask)):
+            self.chars[i].original_box = self.original_boxes[i].tolist()
+
+    def store_spaces_before(self, mask=None):
+        for i in (range(len(self.chars)) if mask is None else np.flatnonzero(mask)):
+            self.chars[i].spaces_before = int(self.spaces_before[i])
 
 
 class Line:
@@ -29,7 +70,12 @@ class Line:
     AVG_PERIOD = 5 # for approximation when correcting
     AVG_APPROX_DIST = 3 # points are taken with intervals of at least 2, i.e. 0th and 3rd or 1st and 4th
 
-    def __init__(self, box, label):
+    def __init__(self, box, label, line_thr=None):
+        """
+        :param line_thr: LINE_THR of this line, class default if None
+        """
+        if line_thr is not None:
+            self.LINE_THR = line_thr
         self.chars = []
         new_char = LineChar(box, label)
         self.chars.append(new_char)
@@ -60,24 +106,42 @@ class Line:
             return True
         return False
 
+    _approximation_pairs = {}  # number of chars -> list of (i, j, other points indexes)
+
+    @classmethod
+    def _get_approximation_pairs(cls, n):
+        pairs = cls._approximation_pairs.get(n)
+        if pairs is None:
+            pairs = [(i, j, tuple(k for k in range(n) if k != i and k != j))
+                     for i in range(n - cls.AVG_APPROX_DIST) for j in range(i + cls.AVG_APPROX_DIST, n)]
+            cls._approximation_pairs[n] = pairs
+        return pairs
+
     def _calc_approximation(self, calc_chars):
+        """
+        Finds line through a pair of chars at least AVG_APPROX_DIST apart that best fits some other char
+        :return: (err, a, b, w, h): error of the fit, line y = a*x + b, mean w and h of these 3 chars
+        """
         if len(calc_chars) <= self.AVG_APPROX_DIST:
             return None
-        best_pair = [1e99, None, None, None, None, ] # err,i,j,k,a,b
-        for i in range(len(calc_chars)-self.AVG_APPROX_DIST):
-            for j in range(i+self.AVG_APPROX_DIST, len(calc_chars)):
-                a = (calc_chars[j].y - calc_chars[i].y) / (calc_chars[j].x - calc_chars[i].x)
-                b = (calc_chars[j].x * calc_chars[i].y - calc_chars[i].x * calc_chars[j].y) / (calc_chars[j].x - calc_chars[i].x)
-                ks = [k for k in range(len(calc_chars)) if k!=i and k!= j]
-                errors = [abs(calc_chars[k].x * a + b - calc_chars[k].y) for k in ks]
-                min_err = min(errors)
-                if min_err < best_pair[0]:
-                    idx_if_min = min(range(len(errors)), key=errors.__getitem__)
-                    best_pair = min_err, i, j, ks[idx_if_min], a, b
-        err, i, j, k, a, b = best_pair
-        w = (calc_chars[i].w + calc_chars[j].w + calc_chars[k].w) / 3
-        h = (calc_chars[i].h + calc_chars[j].h + calc_chars[k].h) / 3
-        return err, a, b, w, h
+        xs = [ch.x for ch in calc_chars]
+        ys = [ch.y for ch in calc_chars]
+        best_err, best_i, best_j, best_k, best_a, best_b = 1e99, None, None, None, None, None
+        for i, j, ks in self._get_approximation_pairs(len(calc_chars)):
+            xi, yi, xj, yj = xs[i], ys[i], xs[j], ys[j]
+            a = (yj - yi) / (xj - xi)
+            b = (xj * yi - xi * yj) / (xj - xi)
+            min_err = None
+            for k in ks:
+                err = abs(xs[k] * a + b - ys[k])
+                if min_err is None or err < min_err:
+                    min_err, min_k = err, k
+            if min_err < best_err:
+                best_err, best_i, best_j, best_k, best_a, best_b = min_err, i, j, min_k, a, b
+        chars = calc_chars[best_i], calc_chars[best_j], calc_chars[best_k]
+        w = (chars[0].w + chars[1].w + chars[2].w) / 3
+        h = (chars[0].h + chars[1].h + chars[2].h) / 3
+        return best_err, best_a, best_b, w, h
 
     def refine(self):
         for i in range(len(self.chars)):
@@ -95,6 +159,59 @@ class Line:
                 curr_char.spaces_before = max(0, round(0.5 * ((curr_char.refined_box[0] + curr_char.refined_box[2]) - (prev_char.refined_box[0] + prev_char.refined_box[2])) / step) - 1)
 
 
+def refine_page(lines):
+    """
+    Does Line.refine() for all lines of a page with vectorized operations
+    """
+    page = PageArrays(lines)
+    n = len(page)
+    if not n:
+        return
+    approximations = np.array([ch.approximation if ch.approximation is not None else (np.nan,) * 5
+                               for ch in page.chars], dtype=np.float64)
+    has_approximation = np.array([ch.approximation is not None for ch in page.chars])
+    line_ends = np.cumsum(np.bincount(page.line_ids, minlength=len(lines)))[page.line_ids]
+    # chars i..i+AVG_PERIOD-1 of the same line are candidates to refine char i, the one with min error is used
+    window = np.arange(n)[:, None] + np.arange(Line.AVG_PERIOD)[None, :]
+    is_valid = window < line_ends[:, None]
+    window = np.minimum(window, n - 1)
+    is_valid &= has_approximation[window]
+    errors = np.where(is_valid, approximations[window, 0], np.inf)
+    if not np.isfinite(errors[is_valid]).all():
+        for ln in lines:  # ties of inf/nan are resolved by Line.refine differently
+            ln.refine()
+        return
+    best = window[np.arange(n), np.argmin(errors, axis=1)]
+    is_refined = is_valid.any(axis=1)
+    _, a, b, w, h = approximations[best].T
+    expected_x = np.array([ch.x for ch in page.chars], dtype=np.float64)
+    expected_y = expected_x * a + b
+    refined_boxes = np.stack([expected_x-w/2, expected_y-h/2, expected_x+w/2, expected_y+h/2], axis=1)
+    page.refined_boxes[is_refined] = refined_boxes[is_refined]
+
+    has_prev = ~page.is_line_start()
+    boxes, prev_boxes = page.refined_boxes[has_prev], page.refined_boxes[np.flatnonzero(has_prev) - 1]
+    step = (boxes[:, 2] - boxes[:, 0]) * Line.STEP_TO_W
+    if (step == 0).any():
+        for ln in lines:
+            ln.refine()
+        return
+    spaces = np.round(0.5 * ((boxes[:, 0] + boxes[:, 2]) - (prev_boxes[:, 0] + prev_boxes[:, 2])) / step) - 1
+    page.spaces_before[has_prev] = np.maximum(0, spaces)
+    page.store_refined_boxes(is_refined)
+    page.store_spaces_before(has_prev)
+
+
+def refine_boxes_by_height(lines, coeffs):
+    """
+    Shifts refined boxes coordinates by coeffs (left, top, right, bottom) in units of box height
+    """
+    page = PageArrays(lines)
+    h = page.refined_boxes[:, 3] - page.refined_boxes[:, 1]
+    page.refined_boxes += h[:, None] * np.array(coeffs)
+    page.store_refined_boxes()
+
+
 def get_compareble_y(line1, line2):
     line1, line2, sign = (line1, line2, 1) if line1.length > line2.length else (line2, line1, -1)
     if line2.chars[0].x > line1.middle_x:
@@ -108,153 +225,228 @@ def get_compareble_y(line1, line2):
 
 
 def _sort_lines(lines):
-
-    def _cmp_lines(line1, line2):
-        y1, y2 = get_compareble_y(line1, line2)
-        return 1 if y1 > y2 else -1
-
+    params = []  # get_compareble_y is done on plain tuples, without attribute lookups
     for ln in lines:
-        ln.length = ln.chars[-1].x - ln.chars[0].x
-        ln.middle_x = 0.5*(ln.chars[-1].x + ln.chars[0].x)
-        if ln.length > 0:
-            ln.mean_slip = (ln.chars[-1].y - ln.chars[0].y)/ln.length
+        first_x, first_y, last_x, last_y = ln.chars[0].x, ln.chars[0].y, ln.chars[-1].x, ln.chars[-1].y
+        ln.length = length = last_x - first_x
+        ln.middle_x = middle_x = 0.5*(last_x + first_x)
+        ln.mean_slip = mean_slip = (last_y - first_y)/length if length > 0 else 0
+        params.append((length, middle_x, mean_slip, first_x, first_y, last_x, last_y))
+
+    def _cmp_lines(i1, i2):
+        p1, p2 = params[i1], params[i2]
+        if p1[0] > p2[0]:
+            long_p, short_p, sign = p1, p2, 1
+        else:
+            long_p, short_p, sign = p2, p1, -1
+        short_x = short_p[3]
+        if short_x > long_p[1]:
+            y_long = long_p[6] + long_p[2] * (short_x - long_p[5])
         else:
-            ln.mean_slip = 0
-    return sorted(lines, key = cmp_to_key(_cmp_lines))
+            y_long = long_p[4] + long_p[2] * (short_x - long_p[3])
+        y1, y2 = (y_long, short_p[4]) if sign > 0 else (short_p[4], y_long)
+        return 1 if y1 > y2 else -1
 
+    # comparisons are not always consistent (a line can be both before and after another one), so the result depends
+    # on the sequence of comparisons and is kept the same as sorting of lines with get_compareble_y
+    return [lines[i] for i in sorted(range(len(lines)), key=cmp_to_key(_cmp_lines))]
+
+
+class InterpretationRules:
+    """
+    Declarative interpretation rules of a language. Dict names refer to letters.letter_dicts, they are compiled
+    into 64-entry lookup tables (see label_tools.letter_table) on creation.
+    """
+    def __init__(self, text_dicts, sym_dicts=('SYM',), num_dicts=('NUM',), num_denominator_dicts=('NUM_DENOMINATOR',),
+                 math_dicts=('MATH_RU',), math_lang_signs=('en', 'EN'), math_chars=(',', '.', '(', ')'),
+                 space_after_chars=(',', ';'), number_prefix=('н', '№'), toggle_brackets=('()', '(', ')'),
+                 square_brackets=('ъ', 'ь', '[', ']')):
+        """
+        :param text_dicts: dicts for plain text
+        :param sym_dicts: dicts of signs that are checked first (markout sign, number sign etc.)
+        :param num_dicts, num_denominator_dicts: dicts for digits after number sign
+        :param math_dicts: dicts for math signs after number sign
+        :param math_lang_signs: math_dicts values that switch math text to a language dict (math sign.upper())
+        :param math_chars: text chars that don't end math mode
+        :param space_after_chars: chars followed by space in text mode
+        :param number_prefix: (labeling char, char): the char before number sign is replaced with (i.e. N -> No)
+        :param toggle_brackets: (char, opening, closing): char is alternately replaced with opening and closing
+        :param square_brackets: (opening letter, closing letter, opening, closing): letters used as brackets
+            at word start and end
+        """
+        self.sym_letters = lt.letter_table(sym_dicts)
+        self.num_letters = lt.letter_table(num_dicts)
+        self.num_denominator_letters = lt.letter_table(num_denominator_dicts)
+        self.math_letters = lt.letter_table(math_dicts)
+        self.text_letters = lt.letter_table(text_dicts)
+        self.math_lang_signs = set(math_lang_signs)
+        # math language dicts missing in letters.letter_dicts are looked up by lt.int_to_letter that reports them
+        self.math_lang_letters = {sign: lt.letter_table([sign.upper()]) for sign in math_lang_signs
+                                  if sign.upper() in letters.letter_dicts}
+        self.math_chars = set(math_chars)
+        self.space_after_chars = set(space_after_chars)
+        self.number_prefix = number_prefix
+        self.toggle_brackets = toggle_brackets
+        self.square_brackets = square_brackets
+
+
+# languages registered for interpretation, only ones which dicts are present in letters.letter_dicts
+interpretation_rules = {
+    'RU': InterpretationRules(text_dicts=('RU', 'SYM')),
+}
+
+
+def interpret_lines(lines, lang, mode = None):
+    """
+    precess lines of chars and fills char and labeling_char attributes of chars according to language rules
+    :param lines: list of Line. LineChar must have spaces_before, char and labeling_char attributes
+    :param lang: 'RU' etc. (see interpretation_rules)
+    :param mode: state returned by previous call for preceding lines or None
+    :return: state to continue interpretation of following lines
+    """
+    rules = interpretation_rules[lang]
+    sym_letters = rules.sym_letters
+    num_letters = rules.num_letters
+    denominator_letters = rules.num_denominator_letters
+    math_letters = rules.math_letters
+    text_letters = rules.text_letters
+    number_prefix_labeling_char, number_prefix_char = rules.number_prefix
+    toggle_bracket, toggle_opening, toggle_closing = rules.toggle_brackets
+    toggle_key = toggle_opening * 2
+    square_opening_letter, square_closing_letter, square_opening, square_closing = rules.square_brackets
 
-def interpret_line_RU(line, lang, mode = None):
-    '''
-    precess line of chars and fills char and labeling_char attributes of chars according to language rules
-    :param line: list of LineChar. LineChar must have spaces_before, char and labeling_char attributes
-    :param lang: 'RU' etc.
-    :return: None
-    '''
     if mode is None:
         mode = defaultdict(bool)
     else:
         mode = defaultdict(bool, mode)
-    digit_mode = mode['digit_mode']
-    frac_mode = mode['frac_mode']
-    math_mode = mode['math_mode']
-    math_lang = mode['math_lang']
-    if not math_lang:
-        math_lang = ''
-    caps_mode = mode['caps_mode']
     brackets_on = mode['brackets_on']
     if not brackets_on:
         brackets_on = defaultdict(int)
-
-    prev_ch = None
-    for i, ch in enumerate(line.chars):
-        ch.labeling_char = ch.char = lt.int_to_letter(ch.label, ['SYM'])
-        if ch.char == letters.markout_sign:
-            ch.char = ''
-            if i < len(line.chars)-1:
-                line.chars[i+1].spaces_before += ch.spaces_before
-                ch.spaces_before = 0
-        elif ch.char == letters.num_sign:
-            ch.char = ''
-            if digit_mode:
-                ch.spaces_before += 1 # need to separate from previous number or separate fraction part from integer part
-            digit_mode = True
-            math_mode = True
-            if prev_ch is not None and prev_ch.labeling_char == 'н':
-                prev_ch.char = '№'
-        else:
-            if ch.spaces_before:
-                digit_mode = False
-                frac_mode = False
-            ch.char = None
-            if digit_mode:
-                if not frac_mode:
-                    ch.labeling_char = ch.char = lt.int_to_letter(ch.label, ['NUM'])
-                    if ch.char is None:
-                        ch.labeling_char = ch.char = lt.int_to_letter(ch.label, ['NUM_DENOMINATOR'])
-                        if ch.char is not None:
-                            if ch.char == '/0' and prev_ch.labeling_char == '0':
-                                prev_ch.char = ''
-                                ch.char = '%'
-                            else:
-                                ch.labeling_char = ch.char = None #frac_mode = True 
-                else:
-                    ch.labeling_char = ch.char = lt.int_to_letter(ch.label, ['NUM_DENOMINATOR'])
-                    if ch.char is not None:
-                        ch.char = ch.char[1:]
-            if ch.char is None:
+    for line in lines:
+        digit_mode = mode['digit_mode']
+        frac_mode = mode['frac_mode']
+        math_mode = mode['math_mode']
+        math_lang = mode['math_lang']
+        if not math_lang:
+            math_lang = ''
+        caps_mode = mode['caps_mode']
+
+        chars = line.chars
+        last_i = len(chars) - 1
+        prev_ch = None
+        for i, ch in enumerate(chars):
+            label = ch.label
+            ch.labeling_char = ch.char = sym_letters[label]
+            if ch.char == letters.markout_sign:
+                ch.char = ''
+                if i < last_i:
+                    chars[i+1].spaces_before += ch.spaces_before
+                    ch.spaces_before = 0
+            elif ch.char == letters.num_sign:
+                ch.char = ''
+                if digit_mode:
+                    ch.spaces_before += 1 # need to separate from previous number or separate fraction part from integer part
+                digit_mode = True
+                math_mode = True
+                if prev_ch is not None and prev_ch.labeling_char == number_prefix_labeling_char:
+                    prev_ch.char = number_prefix_char
+            else:
                 if ch.spaces_before:
-                    math_lang = ''
-                if math_lang:
-                    ch.labeling_char = ch.char = lt.int_to_letter(ch.label, [math_lang.upper()])
-                    if ch.char is not None:
-                        if math_lang.isupper():
-                            ch.char = ch.char.upper()
-                        digit_mode = False
-                        if not ch.char.isalpha():
-                            math_lang = ''
+                    digit_mode = False
+                    frac_mode = False
+                ch.char = None
+                if digit_mode:
+                    if not frac_mode:
+                        ch.labeling_char = ch.char = num_letters[label]
+                        if ch.char is None:
+                            ch.labeling_char = ch.char = denominator_letters[label]
+                            if ch.char is not None:
+                                if ch.char == '/0' and prev_ch.labeling_char == '0':
+                                    prev_ch.char = ''
+                                    ch.char = '%'
+                                else:
+                                    ch.labeling_char = ch.char = None #frac_mode = True
                     else:
+                        ch.labeling_char = ch.char = denominator_letters[label]
+                        if ch.char is not None:
+                            ch.char = ch.char[1:]
+                if ch.char is None:
+                    if ch.spaces_before:
                         math_lang = ''
-            if ch.char is None:
-                if (ch.spaces_before
-                    or not prev_ch
-                    or prev_ch and not prev_ch.char.isalpha()
-                    or math_mode and not math_lang and lt.int_to_letter(ch.label, ['MATH_RU']) == '..'
-                ):
-                    if lt.int_to_letter(ch.label, ['MATH_RU']) in {'en', 'EN'}:
-                        math_lang = lt.int_to_letter(ch.label, ['MATH_RU'])
-                        ch.char = ''
-            if math_mode and ch.char is None:
-                frac_mode = False
-                if not math_lang and (ch.spaces_before or lt.int_to_letter(ch.label, ['MATH_RU']) == '..'):
-                    # without spaces_before dot and comma after number is interpreted as mathematical sign :
-                    # dot (..) is not preceded by a space
-                    ch.labeling_char = ch.char = lt.int_to_letter(ch.label, ['MATH_RU'])
-                    if ch.char is not None:
-                        if ch.char == '..':
-                            if i < len(line.chars)-1 and line.chars[i+1].spaces_before == 0 and lt.int_to_letter(line.chars[i+1].label, ['NUM']) is not None:
-                                ch.char = '.'
-                            else:
-                                ch.char = '*'
-                        elif ch.char == '::':
-                            ch.char = ':'
-                        ch.spaces_before = max(0, ch.spaces_before-1)
-            if ch.char is None:
-                ch.labeling_char = ch.char = lt.int_to_letter(ch.label, [lang, 'SYM'])
-                if ch.char not in {',', '.', '(', ')'}:
-                    math_mode = False
-                    math_lang = ''
-                    digit_mode = False
+                    if math_lang:
+                        math_lang_letters = rules.math_lang_letters.get(math_lang)
+                        ch.labeling_char = ch.char = (math_lang_letters[label] if math_lang_letters is not None
+                                                      else lt.int_to_letter(label, [math_lang.upper()]))
+                        if ch.char is not None:
+                            if math_lang.isupper():
+                                ch.char = ch.char.upper()
+                            digit_mode = False
+                            if not ch.char.isalpha():
+                                math_lang = ''
+                        else:
+                            math_lang = ''
+                math_char = math_letters[label]
+                if ch.char is None:
+                    if (ch.spaces_before
+                        or not prev_ch
+                        or prev_ch and not prev_ch.char.isalpha()
+                        or math_mode and not math_lang and math_char == '..'
+                    ):
+                        if math_char in rules.math_lang_signs:
+                            math_lang = math_char
+                            ch.char = ''
+                if math_mode and ch.char is None:
                     frac_mode = False
-            if not math_mode:
-                if prev_ch and prev_ch.char in {",", ";"}:
-                    prev_ch.char += " "
-            if ch.char == '()':
-                if brackets_on['(('] == 0:
-                    ch.char = '('
-                    brackets_on['(('] = 1
-                else:
-                    ch.char = ')'
-                    brackets_on['(('] = 0
-            elif ch.char == 'ъ' and (ch.spaces_before or prev_ch is None or not prev_ch.char.isalpha()):
-                ch.char = '['
-                brackets_on['['] += 1
-            elif ch.char == 'ь' and i < len(line.chars)-1 and (line.chars[i+1].spaces_before or True # TODO
-                                                                ) and brackets_on['['] > 0:
-                ch.char = ']'
-                brackets_on['['] -= 1
-            if ch.char is None:
-                ch.labeling_char = '~' + lt.int_to_label123(ch.label)
-                ch.char = ch.labeling_char + '~'
-            if caps_mode:
-                ch.char = ch.char.upper()
-                caps_mode = False
-            if ch.char == letters.caps_sign:
-                caps_mode = True
-                ch.char = ''
-            if ch.char == 'EN':
-                caps_mode = True
-                ch.char = ''  # TODO
-        prev_ch = ch
+                    if not math_lang and (ch.spaces_before or math_char == '..'):
+                        # without spaces_before dot and comma after number is interpreted as mathematical sign :
+                        # dot (..) is not preceded by a space
+                        ch.labeling_char = ch.char = math_char
+                        if ch.char is not None:
+                            if ch.char == '..':
+                                if i < last_i and chars[i+1].spaces_before == 0 and num_letters[chars[i+1].label] is not None:
+                                    ch.char = '.'
+                                else:
+                                    ch.char = '*'
+                            elif ch.char == '::':
+                                ch.char = ':'
+                            ch.spaces_before = max(0, ch.spaces_before-1)
+                if ch.char is None:
+                    ch.labeling_char = ch.char = text_letters[label]
+                    if ch.char not in rules.math_chars:
+                        math_mode = False
+                        math_lang = ''
+                        digit_mode = False
+                        frac_mode = False
+                if not math_mode:
+                    if prev_ch and prev_ch.char in rules.space_after_chars:
+                        prev_ch.char += " "
+                if ch.char == toggle_bracket:
+                    if brackets_on[toggle_key] == 0:
+                        ch.char = toggle_opening
+                        brackets_on[toggle_key] = 1
+                    else:
+                        ch.char = toggle_closing
+                        brackets_on[toggle_key] = 0
+                elif ch.char == square_opening_letter and (ch.spaces_before or prev_ch is None or not prev_ch.char.isalpha()):
+                    ch.char = square_opening
+                    brackets_on[square_opening] += 1
+                elif ch.char == square_closing_letter and i < last_i and (chars[i+1].spaces_before or True # TODO
+                                                                         ) and brackets_on[square_opening] > 0:
+                    ch.char = square_closing
+                    brackets_on[square_opening] -= 1
+                if ch.char is None:
+                    ch.labeling_char = '~' + lt.int_to_label123(label)
+                    ch.char = ch.labeling_char + '~'
+                if caps_mode:
+                    ch.char = ch.char.upper()
+                    caps_mode = False
+                if ch.char == letters.caps_sign:
+                    caps_mode = True
+                    ch.char = ''
+                if ch.char == 'EN':
+                    caps_mode = True
+                    ch.char = ''  # TODO
+            prev_ch = ch
 
     return {
         #'digit_mode': digit_mode,
@@ -266,40 +458,70 @@ def interpret_line_RU(line, lang, mode = None):
     }
 
 
-interpret_line_funcs = {
-    'RU': interpret_line_RU,
-}
+def interpret_line_RU(line, lang, mode = None):
+    '''
+    precess line of chars and fills char and labeling_char attributes of chars according to language rules
+    :param line: list of LineChar. LineChar must have spaces_before, char and labeling_char attributes
+    :param lang: 'RU' etc.
+    :return: None
+    '''
+    return interpret_lines([line], lang, mode)
+
+
+interpret_line_funcs = {lang: interpret_line_RU for lang in interpretation_rules}
 
 
 def filter_lonely_rects_for_lines(lines):
     allowed_lonely = {} # lt.label010_to_int('111000'), lt.label010_to_int('000111'), lt.label010_to_int('111111')
     filtered_chars = []
     for ln in lines:
-        while len(ln.chars) and (ln.chars[0].label not in allowed_lonely and len(ln.chars)>1 and ln.chars[1].spaces_before > 1 or len(ln.chars) == 1):
-            filtered_chars.append(ln.chars[0])
-            ln.chars = ln.chars[1:]
-            if len(ln.chars):
-                ln.chars[0].spaces_before = 0
-        while len(ln.chars) and (ln.chars[-1].label not in allowed_lonely and len(ln.chars)>1 and ln.chars[-1].spaces_before > 1 or len(ln.chars) == 1):
-            filtered_chars.append(ln.chars[-1])
-            ln.chars = ln.chars[:-1]
+        # chars are removed by moving start and end indexes, line is sliced once
+        chars = ln.chars
+        start, end = 0, len(chars)
+        while start < end and (end - start == 1 or chars[start].label not in allowed_lonely and chars[start + 1].spaces_before > 1):
+            filtered_chars.append(chars[start])
+            start += 1
+            if start < end:
+                chars[start].spaces_before = 0
+        while start < end and (end - start == 1 or chars[end - 1].label not in allowed_lonely and chars[end - 1].spaces_before > 1):
+            filtered_chars.append(chars[end - 1])
+            end -= 1
+        if start or end < len(chars):
+            ln.chars = chars[start:end]
     return [ln for ln in lines if len(ln.chars)], filtered_chars
 
 
-def boxes_to_lines(boxes, labels, lang, filter_lonely = True):
+LINE_CANDIDATE_EPS = 1e-3  # margin of vectorized preselection of lines, final decision is done by Line.check_and_append
+
+
+def boxes_to_lines(boxes, labels, lang, filter_lonely = True, scores = None, line_thr = None):
     '''
     :param boxes: list of (left, tor, right, bottom)
+    :param scores: optional list of detection scores, stored to LineChar.score
+    :param line_thr: Line.LINE_THR to use, its default if None
     :return: text: list of strings
     '''
     VERTICAL_SPACING_THR = 2.3
+    if line_thr is None:
+        line_thr = Line.LINE_THR
 
-    boxes = list(zip(boxes, labels))
+    boxes = list(zip(boxes, labels, scores if scores is not None else [None] * len(labels)))
     lines = []
     boxes = sorted(boxes, key=lambda b: b[0][0])
+    # current x, y, slip, h of every line, to select lines that can accept a box without calling all of them
+    lines_params = np.zeros((len(boxes), 4), dtype=np.float64)
     for b in boxes:
         found_line = None
-        for ln in lines:
+        x = (b[0][0] + b[0][2])/2
+        y = (b[0][1] + b[0][3])/2
+        params = lines_params[:len(lines)]
+        is_candidate = (np.abs(params[:, 1] + params[:, 2] * (x - params[:, 0]) - y)
+                        < params[:, 3] * line_thr + LINE_CANDIDATE_EPS)
+        for line_idx in np.flatnonzero(is_candidate):
+            ln = lines[line_idx]
             if ln.check_and_append(box=b[0], label=b[1]):
+                ln.chars[-1].score = b[2]
+                lines_params[line_idx] = ln.x, ln.y, ln.slip, ln.h
                 # to handle seldom cases when one char can be related to several lines mostly because of errorneous outlined symbols
                 if (found_line and (found_line.chars[-1].x - found_line.chars[-2].x) < (ln.chars[-1].x - ln.chars[-2].x)):
                     ln.chars.pop()
@@ -308,22 +530,21 @@ def boxes_to_lines(boxes, labels, lang, filter_lonely = True):
                         found_line.chars.pop()
                     found_line = ln
         if found_line is None:
-            lines.append(Line(box=b[0], label=b[1]))
+            ln = Line(box=b[0], label=b[1], line_thr=line_thr)
+            ln.chars[0].score = b[2]
+            lines_params[len(lines)] = ln.x, ln.y, ln.slip, ln.h
+            lines.append(ln)
 
     lines = _sort_lines(lines)
-    interpret_line_f = interpret_line_funcs[lang]
-    interpret_line_mode = None
     prev_line = None
+    refine_page(lines)
     for ln in lines:
-        ln.refine()
-
         if prev_line is not None:
             prev_y, y = get_compareble_y(prev_line, ln)
             if (y - prev_y) > VERTICAL_SPACING_THR * ln.h:
                 ln.has_space_before = True
         prev_line = ln
-
-        interpret_line_mode = interpret_line_f(ln, lang, mode = interpret_line_mode)
+    interpret_lines(lines, lang)
     if filter_lonely:
         lines, _ = filter_lonely_rects_for_lines(lines)
     return lines
@@ -372,7 +593,6 @@ def text_to_lines(text, lang = 'RU'):
     :return: list of Line
     '''
     text_lines = text.splitlines()
-    interpret_line_mode = None
     has_space_before = False
     lines = []
     for tln in text_lines:
@@ -383,10 +603,7 @@ def text_to_lines(text, lang = 'RU'):
             ln.has_space_before = has_space_before
             has_space_before = False
             lines.append(ln)
-    interpret_line_f = interpret_line_funcs[lang]
-    interpret_line_mode = None
-    for ln in lines:
-        interpret_line_mode = interpret_line_f(ln, lang, mode = interpret_line_mode)
+    interpret_lines(lines, lang)
     return lines
 
 
@@ -406,6 +623,25 @@ def lines_to_text(lines):
     return '\n'.join(out_text)
 
 
+# optional post-correction of interpreted text: lang -> name of transliteration table
+text_corrections = {
+    'RU': 'SINHALA_CORRECTIONS',
+}
+
+
+def correct_text(text_lines, lang):
+    '''
+    Applies language post-correction to interpreted text. Text of languages without correction is returned as is.
+    :param text_lines: list of str (lines of text, without '\n')
+    :return: list of str
+    '''
+    table_name = text_corrections.get(lang)
+    if table_name is None or not text_lines:
+        return text_lines
+    # replacements don't span lines, so text is processed at once
+    return transliteration.get_transliterator(table_name)('\n'.join(text_lines)).split('\n')
+
+
 def validate_postprocess(in_text, out_text):
     '''
     :return: validates that  in_text -> out_text
@@ -421,6 +657,9 @@ def validate_postprocess(in_text, out_text):
 MIN_RECTS = 10
 MAX_ROTATION = 0.2
 MIN_ROTATION = 0.02
+RANSAC_ITERATIONS = 256  # iteration budget of every RANSAC fit of find_perspective_transformation
+RANSAC_SLOPE_TOL = 0.01  # tolerance of text line slope
+MIN_MARGIN_INLIERS = 0.3  # min part of text lines that should start (end) at the margin
 
 def center_of_char(ch):
     """
@@ -664,6 +903,152 @@ def find_transformation(lines, img_size_wh):
     return hom
 
 
+def _ransac_line(u, v, tol, n_iterations, rng):
+    """
+    Robust fit of v = a*u + b. All n_iterations hypotheses (lines through random pairs of points) are scored at once,
+    the best one is refined by least squares over its inliers.
+    :param u, v: np.array of points coordinates
+    :param tol: max abs(v - a*u - b) of inliers
+    :return: (a, b), inliers mask; None, None if there are not enough points
+    """
+    i = rng.randint(len(u), size=n_iterations)
+    j = rng.randint(len(u), size=n_iterations)
+    valid = u[j] != u[i]
+    i, j = i[valid], j[valid]
+    if len(i) == 0:
+        return None, None
+    a = (v[j] - v[i]) / (u[j] - u[i])
+    b = v[i] - a * u[i]
+    inliers = np.abs(v[None, :] - a[:, None] * u[None, :] - b[:, None]) < tol
+    best = inliers.sum(axis=1).argmax()
+    mask = inliers[best]
+    a, b = a[best], b[best]
+    if np.ptp(u[mask]) > 0:
+        a, b = np.polyfit(u[mask], v[mask], 1)
+    return (a, b), mask
+
+
+def _slips_to_point(v, x, y):
+    """
+    :param v: homogeneous points (..., 3)
+    :return: slopes of lines from points (x, y) to v
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (v[..., 1] - v[..., 2] * y) / (v[..., 0] - v[..., 2] * x)
+
+
+def _ransac_vanishing_point(x, y, slips, weights, tol, n_iterations, rng):
+    """
+    Robust estimation of the point where all text lines y = y_i + slip_i*(x - x_i) cross (at infinity if they are
+    parallel). Hypotheses are cross points of random pairs of lines, inliers are lines which slopes differ from
+    the slope of line from (x_i, y_i) to the point less than tol. Coords should be normalized to ~1.
+    :return: homogeneous point (3,), inliers mask; None, None if there are no hypotheses
+    """
+    lines = np.stack([slips, -np.ones_like(slips), y - slips * x], axis=1)  # a*x + b*y + c = 0
+    i = rng.randint(len(x), size=n_iterations)
+    j = rng.randint(len(x), size=n_iterations)
+    valid = i != j
+    if not valid.any():
+        return None, None
+    points = np.cross(lines[i[valid]], lines[j[valid]])
+    inliers = np.abs(_slips_to_point(points[:, None, :], x[None, :], y[None, :]) - slips[None, :]) < tol
+    mask = inliers[inliers.sum(axis=1).argmax()]
+    # least squares point over inliers: smallest singular vector
+    weighted = lines[mask] / np.linalg.norm(lines[mask], axis=1, keepdims=True) * weights[mask, None]
+    return np.linalg.svd(weighted)[2][-1], mask
+
+
+def _margin_line(x, y, tol, n_iterations, rng):
+    """
+    Fits x = a*y + b to line ends
+    :return: (a, b) or None if too few lines are aligned at the margin
+    """
+    line, mask = _ransac_line(y, x, tol, n_iterations, rng)
+    if line is None or mask.sum() < max(3, MIN_MARGIN_INLIERS * len(x)) or abs(line[0]) > MAX_ROTATION:
+        return None
+    return line
+
+
+def _cross_margin(x0, y0, slip, margin):
+    """
+    :return: cross point of text line y = y0 + slip*(x - x0) and margin line x = a*y + b
+    """
+    a, b = margin
+    x = (a * (y0 - slip * x0) + b) / (1 - a * slip)
+    return x, y0 + slip * (x - x0)
+
+
+def find_perspective_transformation(lines, img_size_wh, n_iterations=RANSAC_ITERATIONS, seed=0):
+    """
+    Finds perspective transform that makes text lines horizontal and left and right margins vertical (i.e. of a
+    photo taken at an angle). Under perspective all text lines cross at a vanishing point, and line starts (ends) lie
+    on a margin line. They are fit by RANSAC rejecting wrong lines and chars out of margins, so run time is bounded
+    by n_iterations. Top and bottom text lines and margins form the page frame.
+    If right margin is not aligned, it is assumed to be parallel to the left one.
+    :param lines: list of Line
+    :param img_size_wh: image size
+    :return: 3x3 homography matrix for transform_image, transform_rects etc. or None if the page can't be aligned
+        or needs no alignment
+    """
+    page = PageArrays(lines)
+    if len(page) < MIN_RECTS:
+        return None
+    rng = np.random.RandomState(seed)
+    boxes = page.refined_boxes
+    cx = (boxes[:, 0] + boxes[:, 2]) / 2
+    cy = (boxes[:, 1] + boxes[:, 3]) / 2
+    char_w = np.median(boxes[:, 2] - boxes[:, 0])
+    # least squares fit of every text line
+    ids = page.line_ids
+    n = np.bincount(ids, minlength=len(lines)).astype(np.float64)
+    n_safe = np.maximum(n, 1)
+    mean_x = np.bincount(ids, cx, len(lines)) / n_safe
+    mean_y = np.bincount(ids, cy, len(lines)) / n_safe
+    var_x = np.bincount(ids, cx * cx, len(lines)) / n_safe - mean_x ** 2
+    cov_xy = np.bincount(ids, cx * cy, len(lines)) / n_safe - mean_x * mean_y
+    good = (n >= MIN_RECTS) & (var_x > 0)
+    slips = np.where(good, cov_xy / np.where(good, var_x, 1), 0)
+    good &= np.abs(slips) < MAX_ROTATION
+    if good.sum() < 2:
+        return None
+    # text lines of a page cross at a vanishing point
+    scale = max(img_size_wh)
+    weights = np.sqrt(n * np.maximum(var_x, 0))[good] / scale  # ~ precision of slopes
+    vanishing_point, rows_mask = _ransac_vanishing_point(mean_x[good] / scale, mean_y[good] / scale, slips[good],
+                                                         weights, RANSAC_SLOPE_TOL, n_iterations, rng)
+    if vanishing_point is None or rows_mask.sum() < 2:
+        return None
+    rows = np.flatnonzero(good)[rows_mask]
+    first_chars = page.is_line_start()
+    last_chars = np.append(first_chars[1:], True)
+    row_is_used = np.zeros(len(lines), dtype=bool)
+    row_is_used[rows] = True
+    starts = first_chars & row_is_used[ids]
+    ends = last_chars & row_is_used[ids]
+    left = _margin_line(cx[starts], cy[starts], char_w, n_iterations, rng)
+    if left is None:
+        return None
+    right = _margin_line(cx[ends], cy[ends], char_w, n_iterations, rng)
+    if right is None:
+        right = (left[0], np.max(cx[ends] - left[0] * cy[ends]))
+    top, bottom = rows[np.argmin(mean_y[rows])], rows[np.argmax(mean_y[rows])]
+    src_points = []
+    for row in (top, bottom):
+        slip = _slips_to_point(vanishing_point, mean_x[row] / scale, mean_y[row] / scale)
+        for margin in (left, right):
+            src_points.append(_cross_margin(mean_x[row], mean_y[row], slip, margin))
+    src_points = np.array(src_points)  # top left, top right, bottom left, bottom right
+    l, t = max(src_points[[0, 2], 0].min(), 0), max(src_points[[0, 1], 1].min(), 0)
+    r, b = min(src_points[[1, 3], 0].max(), img_size_wh[0]), min(src_points[[2, 3], 1].max(), img_size_wh[1])
+    if r - l < 2 * char_w or b - t < 2 * char_w:
+        return None
+    target_points = np.array([(l, t), (r, t), (l, b), (r, b)])
+    shifts = np.abs(target_points - src_points).max()
+    if shifts < MIN_ROTATION * (r - l) or shifts > MAX_ROTATION * max(r - l, b - t):
+        return None
+    return cv2.getPerspectiveTransform(src_points.astype(np.float32), target_points.astype(np.float32))
+
+
 def transform_image(img, hom):
     """
     transforms img and refined_box'es and original_box'es for chars at lines using homography matrix found by
@@ -681,26 +1066,91 @@ def transform_image(img, hom):
     img = PIL.Image.fromarray(img)
     return img
 
+def compose_transforms(hom1, hom2):
+    """
+    :param hom1, hom2: transform matrices (2x3 affine or 3x3 homography) or None (identity)
+    :return: matrix of transform hom1 followed by hom2. It is 2x3 if both are affine.
+    """
+    if hom1 is None:
+        return hom2
+    if hom2 is None:
+        return hom1
+    full1 = np.vstack([hom1, [0, 0, 1]]) if hom1.shape[0] == 2 else hom1
+    full2 = np.vstack([hom2, [0, 0, 1]]) if hom2.shape[0] == 2 else hom2
+    res = full2 @ full1
+    if hom1.shape[0] == 2 and hom2.shape[0] == 2:
+        res = res[:2]
+    return res
+
+
+class DeferredImage:
+    """
+    Image with a geometric transform applied on demand: pixels are warped (by transform_image) only when the image
+    itself is requested by get(). Transforms are composed without warping.
+    Note that BrailleInference.run always requests the aligned image (it is drawn, saved or recognized again
+    by repeat_on_aligned), so there the warp is only deferred, not avoided.
+    """
+    def __init__(self, img, hom=None):
+        """
+        :param img: PIL image
+        :param hom: transform matrix or None
+        """
+        self.source = img
+        self.hom = hom
+        self._image = img if hom is None else None
+
+    def transformed(self, hom):
+        """
+        :return: DeferredImage with hom applied after transform of this image
+        """
+        return DeferredImage(self.source, compose_transforms(self.hom, hom))
+
+    @property
+    def size(self):
+        return self.source.size  # transform_image keeps image size
+
+    @property
+    def width(self):
+        return self.source.width
+
+    @property
+    def height(self):
+        return self.source.height
+
+    def get(self):
+        """
+        :return: transformed PIL image, it is warped at the first call
+        """
+        if self._image is None:
+            self._image = transform_image(self.source, self.hom)
+        return self._image
+
+
 def transform_lines(lines, hom):
     if hom.shape[0] == 3:
         pts_transform = cv2.perspectiveTransform
     else:
         pts_transform = cv2.transform
-    old_centers = np.array([[center_of_char(ch) for ln in lines for ch in ln.chars]])
-    new_centers = pts_transform(old_centers, hom)
-    shifts = (new_centers - old_centers)[0]
-    i = 0
-    for ln in lines:
-        for ch in ln.chars:
-            ch.refined_box[0] += shifts[i, 0]
-            ch.refined_box[1] += shifts[i, 1]
-            ch.refined_box[2] += shifts[i, 0]
-            ch.refined_box[3] += shifts[i, 1]
-            ch.original_box[0] += shifts[i, 0]
-            ch.original_box[1] += shifts[i, 1]
-            ch.original_box[2] += shifts[i, 0]
-            ch.original_box[3] += shifts[i, 1]
-            i += 1
+    page = PageArrays(lines)
+    if len(page):
+        boxes = page.refined_boxes
+        old_centers = np.stack([(boxes[:, 0] + boxes[:, 2])/2, (boxes[:, 1] + boxes[:, 3])/2], axis=1)[None]
+        new_centers = pts_transform(old_centers, hom)
+        shifts = (new_centers - old_centers)[0][:, [0, 1, 0, 1]]
+        page.refined_boxes += shifts
+        page.original_boxes += shifts
+        page.store_refined_boxes()
+        page.store_original_boxes()
+        for ch, (dx, dy) in zip(page.chars, shifts[:, :2].tolist()):
+            ch.x += dx
+            ch.y += dy
+    if lines:
+        # line position and direction: (x, y) and a point one unit along the line
+        line_points = np.array([[(ln.x, ln.y), (ln.x + 1, ln.y + ln.slip)] for ln in lines], dtype=np.float64)
+        new_points = pts_transform(line_points.reshape(1, -1, 2), hom).reshape(-1, 2, 2)
+        for ln, ((x, y), (x1, y1)) in zip(lines, new_points.tolist()):
+            ln.x, ln.y = x, y
+            ln.slip = (y1 - y) / (x1 - x) if x1 != x else 0
     return lines
 
 def transform_rects(rects, hom):
@@ -719,7 +1169,196 @@ def transform_rects(rects, hom):
     return rects
 
 
+def _check_calc_approximation(n_windows=20000):
+    """
+    Regression test of Line._calc_approximation against the original brute force version and its micro-benchmark
+    """
+    import timeit
+
+    def calc_approximation_reference(calc_chars):
+        if len(calc_chars) <= Line.AVG_APPROX_DIST:
+            return None
+        best_pair = [1e99, None, None, None, None, ]
+        for i in range(len(calc_chars)-Line.AVG_APPROX_DIST):
+            for j in range(i+Line.AVG_APPROX_DIST, len(calc_chars)):
+                a = (calc_chars[j].y - calc_chars[i].y) / (calc_chars[j].x - calc_chars[i].x)
+                b = (calc_chars[j].x * calc_chars[i].y - calc_chars[i].x * calc_chars[j].y) / (calc_chars[j].x - calc_chars[i].x)
+                ks = [k for k in range(len(calc_chars)) if k!=i and k!= j]
+                errors = [abs(calc_chars[k].x * a + b - calc_chars[k].y) for k in ks]
+                min_err = min(errors)
+                if min_err < best_pair[0]:
+                    idx_if_min = min(range(len(errors)), key=errors.__getitem__)
+                    best_pair = min_err, i, j, ks[idx_if_min], a, b
+        err, i, j, k, a, b = best_pair
+        w = (calc_chars[i].w + calc_chars[j].w + calc_chars[k].w) / 3
+        h = (calc_chars[i].h + calc_chars[j].h + calc_chars[k].h) / 3
+        return err, a, b, w, h
+
+    rng = np.random.RandomState(0)
+    windows = []
+    for n in rng.randint(1, Line.AVG_PERIOD + 1, n_windows):
+        xs = np.cumsum(rng.uniform(5, 40, n))
+        ys = 100 + 0.03 * xs + rng.normal(0, 1, n)
+        if rng.rand() < 0.1:
+            ys = np.round(ys)  # ties
+        windows.append([LineChar([x - 7, y - 10, x + 7, y + 10], 1) for x, y in zip(xs.tolist(), ys.tolist())])
+    ln = Line([0, 0, 14, 20], 1)
+    for calc_chars in windows:
+        assert ln._calc_approximation(calc_chars) == calc_approximation_reference(calc_chars), calc_chars
+    t_ref = timeit.timeit(lambda: [calc_approximation_reference(w) for w in windows], number=1)
+    t_new = timeit.timeit(lambda: [ln._calc_approximation(w) for w in windows], number=1)
+    print("_calc_approximation OK: {:.3f}s -> {:.3f}s for {} windows".format(t_ref, t_new, n_windows))
+
+
+def _check_perspective_transformation(n_pages=20):
+    """
+    Checks that find_perspective_transformation undoes perspective distortion of synthetic pages and compares its run
+    time with find_transformation_full
+    """
+    import timeit
+    rng = np.random.RandomState(0)
+    t_ransac = 0
+    for page_i in range(n_pages):
+        boxes = []
+        for row in range(25):
+            n_chars = 30 if rng.rand() < 0.7 else rng.randint(12, 30)
+            for col in range(n_chars):
+                if rng.rand() < 0.2 and 2 <= col < n_chars - 2 and col % 2:
+                    continue  # space, not making lonely chars filtered by boxes_to_lines
+                x, y = 100 + col * 25 + rng.normal(0, 1), 100 + row * 40 + rng.normal(0, 1)
+                boxes.append((x - 7, y - 10, x + 7, y + 10))
+        rect = np.array([(100, 100), (825, 100), (100, 1060), (825, 1060)], dtype=np.float32)
+        distorted = rect + rng.uniform(-60, 60, size=(4, 2)).astype(np.float32)
+        hom0 = cv2.getPerspectiveTransform(rect, distorted)
+        boxes = transform_rects(boxes, hom0)
+        labels = [1] * len(boxes)
+        lines = boxes_to_lines(boxes, labels, 'RU')
+        t = timeit.default_timer()
+        hom = find_perspective_transformation(lines, (1000, 1200))
+        t_ransac += timeit.default_timer() - t
+        assert hom is not None
+        lines = boxes_to_lines(transform_rects(boxes, hom), labels, 'RU')
+        assert len(lines) == 25, len(lines)
+        slips = [np.polyfit([ch.x for ch in ln.chars], [ch.y for ch in ln.chars], 1)[0]
+                 for ln in lines if len(ln.chars) >= 20]  # short lines are too noisy
+        assert np.abs(slips).max() < 0.005, (page_i, slips)
+        left_x = [ln.chars[0].x for ln in lines]
+        assert np.std(left_x) < 2, (page_i, left_x)
+    t = timeit.default_timer()
+    find_transformation_full(lines)
+    t_full = timeit.default_timer() - t
+    print("find_perspective_transformation OK: {:.4f}s per page, find_transformation_full: {:.3f}s".format(
+        t_ransac / n_pages, t_full))
+
+
+def _check_deferred_transforms():
+    """
+    Checks that composed transforms act as sequential ones and that DeferredImage warps pixels only on request
+    """
+    import PIL.Image
+    rng = np.random.RandomState(0)
+    rects = [(x, y, x + 14, y + 20) for x, y in rng.uniform(50, 500, size=(100, 2)).tolist()]
+    rotation = cv2.getRotationMatrix2D((300, 300), 3., 0.98)
+    perspective = cv2.getPerspectiveTransform(
+        np.float32([(0, 0), (600, 0), (0, 600), (600, 600)]), np.float32([(10, 5), (590, 20), (0, 610), (605, 580)]))
+    for hom1, hom2 in ((rotation, rotation), (rotation, perspective), (perspective, rotation)):
+        composed = compose_transforms(hom1, hom2)
+        assert composed.shape[0] == (2 if hom1.shape[0] == hom2.shape[0] == 2 else 3)
+        assert np.allclose(transform_rects(rects, composed), transform_rects(transform_rects(rects, hom1), hom2))
+    img = PIL.Image.fromarray(rng.randint(0, 255, size=(600, 500, 3), dtype=np.uint8))
+    deferred = DeferredImage(img).transformed(rotation).transformed(rotation)
+    assert deferred._image is None and deferred.size == img.size
+    assert np.array_equal(np.asarray(deferred.get()), np.asarray(transform_image(img, compose_transforms(rotation, rotation))))
+    assert deferred.get() is deferred.get()
+
+    ln = Line([100, 110, 114, 130], 1)
+    for x in range(120, 400, 20):
+        ln.check_and_append([x, 100 + 0.1 * x, x + 14, 120 + 0.1 * x], 1)
+    transform_lines([ln], rotation)
+    for ch in ln.chars:
+        assert np.allclose((ch.x, ch.y), ((ch.original_box[0] + ch.original_box[2]) / 2,
+                                          (ch.original_box[1] + ch.original_box[3]) / 2))
+    # line direction and position are moved with chars
+    first, last = ln.chars[1], ln.chars[-1]
+    assert np.isclose(ln.slip, (last.y - first.y) / (last.x - first.x))
+    assert np.isclose(ln.y + ln.slip * (last.x - ln.x), last.y)
+    print("deferred transforms OK")
+
+
+def _check_filter_lonely_rects_for_lines(n_lines=20000):
+    """
+    Compares filter_lonely_rects_for_lines with the original version that sliced ln.chars at every removed char
+    """
+    import copy
+    import timeit
+
+    def filter_lonely_rects_for_lines_reference(lines):
+        allowed_lonely = {}
+        filtered_chars = []
+        for ln in lines:
+            while len(ln.chars) and (ln.chars[0].label not in allowed_lonely and len(ln.chars)>1 and ln.chars[1].spaces_before > 1 or len(ln.chars) == 1):
+                filtered_chars.append(ln.chars[0])
+                ln.chars = ln.chars[1:]
+                if len(ln.chars):
+                    ln.chars[0].spaces_before = 0
+            while len(ln.chars) and (ln.chars[-1].label not in allowed_lonely and len(ln.chars)>1 and ln.chars[-1].spaces_before > 1 or len(ln.chars) == 1):
+                filtered_chars.append(ln.chars[-1])
+                ln.chars = ln.chars[:-1]
+        return [ln for ln in lines if len(ln.chars)], filtered_chars
+
+    def dump(res):
+        lines, filtered = res
+        return ([[(ch.label, ch.spaces_before) for ch in ln.chars] for ln in lines],
+                [(ch.label, ch.spaces_before) for ch in filtered])
+
+    rng = np.random.RandomState(0)
+    lines = []
+    for _ in range(n_lines):
+        ln = Line([0, 0, 1, 1], 1)
+        ln.chars = [LineChar([0, 0, 1, 1], i) for i in range(rng.randint(1, 60))]
+        for ch in ln.chars:
+            ch.spaces_before = int(rng.choice([0, 0, 0, 1, 2, 3]))
+        lines.append(ln)
+    lines_copy = copy.deepcopy(lines)
+    t = timeit.default_timer()
+    expected = dump(filter_lonely_rects_for_lines_reference(lines_copy))
+    t_ref = timeit.default_timer() - t
+    t = timeit.default_timer()
+    res = filter_lonely_rects_for_lines(lines)
+    t_new = timeit.default_timer() - t
+    assert dump(res) == expected
+    print("filter_lonely_rects_for_lines OK: {:.3f}s -> {:.3f}s for {} lines".format(t_ref, t_new, n_lines))
+
+
+def _benchmark_interpretation(n_lines=3000, line_len=40):
+    """
+    Measures cost of interpret_lines per char on a long document of random letters, digits and signs
+    """
+    import timeit
+    rng = np.random.RandomState(0)
+    labels = sorted(set(lt.label123_to_int(lbl123) for d in ('RU', 'SYM', 'NUM') for lbl123 in letters.letter_dicts[d])
+                    - set(lt.label123_to_int(lbl123) for lbl123 in letters.letter_dicts['MATH_RU']))
+    lines = []
+    for _ in range(n_lines):
+        ln = Line([0, 0, 1, 1], labels[rng.randint(len(labels))])
+        for _ in range(line_len - 1):
+            ch = LineChar([0, 0, 1, 1], labels[rng.randint(len(labels))])
+            ch.spaces_before = int(rng.rand() < 0.15)
+            ln.chars.append(ch)
+        lines.append(ln)
+    t = timeit.default_timer()
+    interpret_lines(lines, 'RU')
+    t = timeit.default_timer() - t
+    print("interpret_lines: {:.3f}s for {} chars, {:.2f} us/char".format(t, n_lines * line_len, t / (n_lines * line_len) * 1e6))
+
+
 if __name__ == '__main__':
+    _check_calc_approximation()
+    _check_perspective_transformation()
+    _check_deferred_transforms()
+    _check_filter_lonely_rects_for_lines()
+    _benchmark_interpretation()
+
     #OK
     validate_postprocess('''аб«~6~и»вг''', '''аб«i»вг''')
     validate_postprocess('''~46~и вг''', '''I вг''')
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# coding: utf-8
+'''
+Compact single-file storage of recognition results of a task (*.rec)
+
+Replaces set of loose files (<stem>.marked.jpg, .marked.txt, .marked.brl, .labeled.json, .labeled.jpg, .protocol.txt)
+with one record file.
+
+File layout:
+    MAGIC (4 bytes), version (uint16), reserved (uint16), index length (uint32),
+    index: utf-8 JSON {field name: [kind, dtype, shape, offset, nbytes]},
+    data blocks, every one aligned to ALIGNMENT bytes. offset is counted from the start of the 1st data block.
+Field kinds:
+    'array' - numpy array (can be memory-mapped without reading the whole file)
+    'text' - str
+    'json' - json serializable object
+    'bytes' - raw bytes (i.e. encoded jpg image)
+
+Fields of a record can be referenced as '<path to .rec file>#<field name>' (see field_ref, read_field_ref).
+'''
+import io
+import json
+import os
+import struct
+from pathlib import Path
+
+import numpy as np
+import PIL.Image
+
+MAGIC = b'ABRR'
+VERSION = 1
+ALIGNMENT = 8
+RECORD_SUFFIX = '.rec'
+_HEADER = struct.Struct('<4sHHI')
+_REF_SEPARATOR = '#'
+
+
+def _aligned(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _encode_field(value):
+    '''
+    :return: kind, dtype, shape, data bytes
+    '''
+    if isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        return 'array', value.dtype.str, list(value.shape), value.tobytes()
+    if isinstance(value, str):
+        return 'text', None, None, value.encode('utf-8')
+    if isinstance(value, (bytes, bytearray)):
+        return 'bytes', None, None, bytes(value)
+    return 'json', None, None, json.dumps(value, sort_keys=False).encode('utf-8')
+
+
+def image_to_bytes(img, format='JPEG'):
+    '''
+    Encodes PIL image the same way as PIL.Image.save(<filename>.jpg) does
+    '''
+    buf = io.BytesIO()
+    img.save(buf, format=format)
+    return buf.getvalue()
+
+
+def write_record(path, fields):
+    '''
+    Writes record file. File is written to a temporary file and then renamed, so readers never see partial file.
+    :param path: path to .rec file
+    :param fields: dict: field name -> value (np.ndarray, str, bytes or json serializable object). None values are skipped
+    :return: path
+    '''
+    index = dict()
+    blocks = []
+    offset = 0
+    for name, value in fields.items():
+        if value is None:
+            continue
+        kind, dtype, shape, data = _encode_field(value)
+        index[name] = [kind, dtype, shape, offset, len(data)]
+        blocks.append((offset, data))
+        offset = _aligned(offset + len(data))
+    index_bytes = json.dumps(index).encode('utf-8')
+    data_start = _aligned(_HEADER.size + len(index_bytes))
+    tmp_path = str(path) + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, 0, len(index_bytes)))
+        f.write(index_bytes)
+        for block_offset, data in blocks:
+            f.seek(data_start + block_offset)
+            f.write(data)
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, str(path))
+    return path
+
+
+class ResultRecord:
+    '''
+    Read access to a record file. Only header and index are read when opened,
+    fields are read (or memory-mapped for arrays) when requested.
+    '''
+    def __init__(self, path):
+        self.path = str(path)
+        with open(self.path, 'rb') as f:
+            magic, version, _, index_len = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != MAGIC:
+                raise ValueError("not a result record file: " + self.path)
+            if version > VERSION:
+                raise ValueError("unsupported result record version {}: {}".format(version, self.path))
+            self.index = json.loads(f.read(index_len).decode('utf-8'))
+        self.data_start = _aligned(_HEADER.size + index_len)
+
+    def keys(self):
+        return self.index.keys()
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def get(self, name, default=None):
+        if name not in self.index:
+            return default
+        return self[name]
+
+    def read_bytes(self, name):
+        kind, dtype, shape, offset, nbytes = self.index[name]
+        with open(self.path, 'rb') as f:
+            f.seek(self.data_start + offset)
+            return f.read(nbytes)
+
+    def __getitem__(self, name):
+        kind, dtype, shape, offset, nbytes = self.index[name]
+        if kind == 'array':
+            if nbytes == 0:
+                return np.empty(shape, dtype=dtype)
+            return np.memmap(self.path, dtype=dtype, mode='r', offset=self.data_start + offset, shape=tuple(shape))
+        data = self.read_bytes(name)
+        if kind == 'text':
+            return data.decode('utf-8')
+        if kind == 'json':
+            return json.loads(data.decode('utf-8'))
+        return data
+
+    def image(self, name):
+        '''
+        :return: PIL image decoded from 'bytes' field
+        '''
+        return PIL.Image.open(io.BytesIO(self.read_bytes(name)))
+
+
+def field_ref(record_path, name):
+    '''
+    :return: str reference to the field of a record: '<record_path>#<name>'
+    '''
+    return str(record_path) + _REF_SEPARATOR + name
+
+
+def is_field_ref(ref):
+    return (RECORD_SUFFIX + _REF_SEPARATOR) in str(ref)
+
+
+def split_field_ref(ref):
+    '''
+    :return: record path, field name
+    '''
+    record_path, name = str(ref).rsplit(_REF_SEPARATOR, 1)
+    return record_path, name
+
+
+def read_field_ref(ref):
+    record_path, name = split_field_ref(ref)
+    return ResultRecord(record_path)[name]
+
+
+def read_result_text(path_or_ref):
+    '''
+    Reads recognized text (or braille) either from a legacy .txt/.brl file or from a record field reference
+    :return: text as str, lines delimited by '\n' with trailing '\n' as in legacy files
+    '''
+    if is_field_ref(path_or_ref):
+        return read_field_ref(path_or_ref)
+    with open(path_or_ref, encoding='utf-8') as f:
+        return ''.join(f.readlines())
+
+
+def export_legacy_files(record_path, results_dir, target_stem, reverse_page=False, save_development_info=True):
+    '''
+    Produces legacy result files from a record on demand
+    :return: marked_image_path, recognized_text_path, recognized_braille_path, text lines - as BrailleInference.save_results
+    '''
+    rec = ResultRecord(record_path)
+    suff = '.rev' if reverse_page else ''
+    results_dir = Path(results_dir)
+    os.makedirs(results_dir, exist_ok=True)
+    if save_development_info:
+        if not reverse_page and 'protocol' in rec:
+            with open(results_dir / (target_stem + '.protocol.txt'), 'w') as f:
+                json.dump(rec['protocol'], f, sort_keys=False, indent=4)
+        if 'image' + suff in rec:
+            (results_dir / (target_stem + '.labeled' + suff + '.jpg')).write_bytes(rec.read_bytes('image' + suff))
+        if 'dict' + suff in rec:
+            with open(results_dir / (target_stem + '.labeled' + suff + '.json'), 'w') as f:
+                json.dump(rec['dict' + suff], f, sort_keys=False, indent=4)
+    marked_image_path = results_dir / (target_stem + '.marked' + suff + '.jpg')
+    recognized_text_path = results_dir / (target_stem + '.marked' + suff + '.txt')
+    recognized_braille_path = results_dir / (target_stem + '.marked' + suff + '.brl')
+    marked_image_path.write_bytes(rec.read_bytes('labeled_image' + suff))
+    text = rec['text' + suff]
+    with open(recognized_text_path, encoding='utf-8', mode='w') as f:
+        f.write(text)
+    with open(recognized_braille_path, encoding='utf-8', mode='w') as f:
+        f.write(rec['braille' + suff])
+    return str(marked_image_path), str(recognized_text_path), str(recognized_braille_path), text.splitlines()
+
+
+if __name__ == '__main__':
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fn = Path(tmp_dir) / ('test' + RECORD_SUFFIX)
+        boxes = np.arange(12, dtype=np.float32).reshape(3, 4)
+        write_record(fn, {'boxes': boxes, 'labels': np.array([1, 2, 63], dtype=np.uint8), 'empty': np.zeros((0, 4)),
+                          'text': 'аб\nв\n', 'protocol': {'ver': 1}, 'raw': b'\x00\x01', 'skipped': None})
+        rec = ResultRecord(fn)
+        assert (rec['boxes'] == boxes).all()
+        assert rec['labels'].tolist() == [1, 2, 63]
+        assert rec['empty'].shape == (0, 4)
+        assert rec['text'] == 'аб\nв\n'
+        assert rec['protocol'] == {'ver': 1}
+        assert rec['raw'] == b'\x00\x01'
+        assert 'skipped' not in rec
+        ref = field_ref(fn, 'text')
+        assert is_field_ref(ref) and read_result_text(ref) == 'аб\nв\n'
+    print('OK')
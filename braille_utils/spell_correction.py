@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# coding: utf-8
+'''
+Dictionary based correction of recognized words.
+
+Word list is loaded once from a local file into a deletion index (SymSpell approach): every dictionary word is
+indexed by all strings produced by deleting up to max_distance chars from its prefix. Candidates for a word are
+found by looking up its own deletes, so no distances to the whole dictionary are computed.
+Only suspicious words are corrected: ones containing unrecognized chars ('~?~') or chars with low detection score.
+
+Word list file: utf-8 text, one word per line, optionally followed by its frequency: "<word> <count>".
+Words are preferred by edit distance, then by frequency, then by order in the file.
+'''
+import functools
+import unicodedata
+
+UNKNOWN_CHAR = '~?~'  # text of an unrecognized char, see BrailleInference.draw_results
+_PLACEHOLDER = '\ufffd'  # UNKNOWN_CHAR is replaced by single char while looking for corrections
+
+
+def load_word_list(path):
+    '''
+    :return: dict {word: count} in file order
+    '''
+    words = dict()
+    with open(path, encoding='utf-8') as f:
+        for row in f:
+            fields = row.split()
+            if not fields:
+                continue
+            count = int(fields[1]) if len(fields) > 1 else 1
+            words[fields[0]] = words.get(fields[0], 0) + count
+    return words
+
+
+def edit_distance(s1, s2, max_distance):
+    '''
+    Levenshtein distance
+    :return: distance or max_distance+1 if it is greater than max_distance
+    '''
+    if abs(len(s1) - len(s2)) > max_distance:
+        return max_distance + 1
+    prev = list(range(len(s2) + 1))
+    for i, c1 in enumerate(s1, 1):
+        cur = [i]
+        for j, c2 in enumerate(s2, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (c1 != c2)))
+        if min(cur) > max_distance:
+            return max_distance + 1
+        prev = cur
+    return min(prev[-1], max_distance + 1)
+
+
+def _deletes(word, max_distance):
+    '''
+    :return: set of strings produced by deleting up to max_distance chars from word, including word itself
+    '''
+    result = {word}
+    edge = {word}
+    for _ in range(max_distance):
+        edge = {w[:i] + w[i + 1:] for w in edge for i in range(len(w))} - result
+        result |= edge
+    return result
+
+
+def _is_word_char(ch):
+    # combining marks and zero width joiner are parts of Sinhala letters
+    return ch.isalnum() or unicodedata.category(ch)[0] == 'M' or ch in ('\u200d', _PLACEHOLDER)
+
+
+def _split_word(token):
+    '''
+    :return: leading punctuation, word, trailing punctuation
+    '''
+    start = 0
+    while start < len(token) and not _is_word_char(token[start]):
+        start += 1
+    end = len(token)
+    while end > start and not _is_word_char(token[end - 1]):
+        end -= 1
+    return token[:start], token[start:end], token[end:]
+
+
+def line_word_scores(ln):
+    '''
+    :param ln: Line (see postprocess.boxes_to_lines)
+    :return: list of min detection score of chars of every word of the line text, None if scores are unknown.
+        Words are split by ' ' as in SpellCorrector.correct_lines, char text can contain spaces or be empty.
+    '''
+    scores = []
+    score, in_word = None, False
+    for ch in ln.chars:
+        for c in ' ' * ch.spaces_before + ch.char:
+            if c == ' ':
+                if in_word:
+                    scores.append(score)
+                    score, in_word = None, False
+            else:
+                in_word = True
+                if ch.score is not None:
+                    score = ch.score if score is None else min(score, ch.score)
+    if in_word:
+        scores.append(score)
+    return scores
+
+
+class SpellCorrector:
+    '''
+    Corrects suspicious words of recognized text by the nearest word of a word list.
+    '''
+    def __init__(self, words, max_distance=1, prefix_length=7, score_thr=0.5, cache_size=100000):
+        '''
+        :param words: dict {word: count} (see load_word_list) or iterable of words
+        :param max_distance: max edit distance of a correction
+        :param prefix_length: only this number of first chars of words are indexed, limiting index size
+        :param score_thr: words having chars with score below it are corrected
+        :param cache_size: size of LRU cache of corrected words
+        '''
+        if not isinstance(words, dict):
+            words = {w: 1 for w in words}
+        self.words = words
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+        self.score_thr = score_thr
+        self.index = dict()  # delete -> list of words, in file order
+        for word in words:
+            for d in _deletes(word[:prefix_length], max_distance):
+                self.index.setdefault(d, []).append(word)
+        self._rank = {w: i for i, w in enumerate(words)}
+        self.correct_word = functools.lru_cache(maxsize=cache_size)(self._correct_word)
+
+    def candidates(self, word):
+        '''
+        :param word: word, unknown chars are denoted by UNKNOWN_CHAR
+        :return: list of (distance, word) within max_distance, best first
+        '''
+        word = word.replace(UNKNOWN_CHAR, _PLACEHOLDER)
+        found = dict()
+        for d in _deletes(word[:self.prefix_length], self.max_distance):
+            for candidate in self.index.get(d, ()):
+                if candidate not in found:
+                    found[candidate] = edit_distance(word, candidate, self.max_distance)
+        return sorted(((dist, w) for w, dist in found.items() if dist <= self.max_distance),
+                      key=lambda dw: (dw[0], -self.words[dw[1]], self._rank[dw[1]]))
+
+    def _correct_word(self, word):
+        if word in self.words:
+            return word
+        candidates = self.candidates(word)
+        return candidates[0][1] if candidates else word
+
+    def is_suspicious(self, word, score):
+        return UNKNOWN_CHAR in word or (score is not None and score < self.score_thr)
+
+    def correct_lines(self, text_lines, word_scores=None):
+        '''
+        Corrects suspicious words of text
+        :param text_lines: list of str
+        :param word_scores: optional list (for every line) of lists of word scores (see line_word_scores).
+            Scores of a line are ignored if number of words doesn't match the line text.
+        :return: list of str
+        '''
+        result = []
+        for i, text in enumerate(text_lines):
+            scores = word_scores[i] if word_scores is not None else None
+            tokens = text.split(' ')
+            words = [t for t in tokens if t]
+            if scores is None or len(scores) != len(words):
+                scores = [None] * len(words)
+            scores = iter(scores)
+            out = []
+            for token in tokens:
+                if token:
+                    score = next(scores)
+                    prefix, word, suffix = _split_word(token.replace(UNKNOWN_CHAR, _PLACEHOLDER))
+                    word = word.replace(_PLACEHOLDER, UNKNOWN_CHAR)
+                    if word and self.is_suspicious(word, score):
+                        token = (prefix + self.correct_word(word) + suffix).replace(_PLACEHOLDER, UNKNOWN_CHAR)
+                out.append(token)
+            result.append(' '.join(out))
+        return result
+
+
+@functools.lru_cache(maxsize=None)
+def load_spell_corrector(word_list_path, **kwargs):
+    '''
+    :return: SpellCorrector for the word list file. Loaded once per process.
+    '''
+    return SpellCorrector(load_word_list(word_list_path), **kwargs)
+
+
+if __name__ == '__main__':
+    import random
+    import timeit
+
+    rnd = random.Random(0)
+    alphabet = 'අආකගචජතදනපබමයරලවසහ' + 'ාිු්'
+    dictionary = {''.join(rnd.choice(alphabet) for _ in range(rnd.randint(2, 10))): rnd.randint(1, 100)
+                  for _ in range(2000)}
+    for max_distance in (1, 2):
+        corrector = SpellCorrector(dictionary, max_distance=max_distance, prefix_length=5)
+        for _ in range(200):
+            word = rnd.choice(list(dictionary))
+            for _ in range(rnd.randint(0, max_distance)):
+                pos = rnd.randint(0, len(word))
+                op = rnd.randint(0, 3)
+                if op == 0:
+                    word = word[:pos] + word[pos + 1:]
+                elif op == 1:
+                    word = word[:pos] + rnd.choice(alphabet) + word[pos + 1:]
+                elif op == 2:
+                    word = word[:pos] + rnd.choice(alphabet) + word[pos:]
+                else:
+                    word = word[:pos] + UNKNOWN_CHAR + word[pos + 1:]
+            # index lookup finds the same words as brute force search
+            brute_force = {w for w in dictionary
+                           if edit_distance(word.replace(UNKNOWN_CHAR, _PLACEHOLDER), w, max_distance) <= max_distance}
+            assert {w for d, w in corrector.candidates(word)} == brute_force, word
+
+    from types import SimpleNamespace
+    line = SimpleNamespace(chars=[SimpleNamespace(char=char, spaces_before=spaces, score=score) for char, spaces, score in (
+        ('a', 0, 0.9), (', ', 0, 0.8), ('b', 0, 0.3), ('', 1, 0.1), ('c', 0, None), ('d', 2, 0.7))])  # 'a, b c  d'
+    assert line_word_scores(line) == [0.8, 0.3, None, 0.7]
+    assert len(line_word_scores(line)) == len([t for t in 'a, b c  d'.split(' ') if t])
+
+    corrector = SpellCorrector({'කතා': 10, 'කතාව': 5, 'ගම': 3})
+    assert corrector.correct_lines(['කත~?~ව, ගම.', ' ගත කතා'], [[None, None], [0.1, 0.9]]) == ['කතාව, ගම.', ' ගම කතා']
+    assert corrector.correct_lines(['ගත'], [[0.9]]) == ['ගත']
+    assert corrector.correct_lines(['~?~~?~~?~ !']) == ['~?~~?~~?~ !']
+    assert corrector.correct_lines(['- ගත'], [[0.9, 0.1]]) == ['- ගම']
+
+    corrector = SpellCorrector(dictionary)
+    words = [w[:2] + UNKNOWN_CHAR + w[3:] for w in dictionary]
+    print('{} words: {:.1f} us per word'.format(len(words), timeit.timeit(
+        lambda: corrector.correct_lines([' '.join(words)]), number=1) / len(words) * 1e6))
+    print('OK')
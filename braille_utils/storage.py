@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# coding: utf-8
+'''
+Sharded storage for raw uploads and recognition results.
+
+Objects are named by content hash (raw uploads) or by task id (results) and placed into
+<root>/<2 hex chars>/<2 hex chars>/<object id><suffix>, so no directory holds too many entries
+and names never collide, i.e. no need to probe file system for existing names.
+'''
+import hashlib
+import os
+import shutil
+import uuid
+from pathlib import Path
+
+HASH_ALGORITHM = 'sha256'
+SHARD_LEVELS = 2
+SHARD_WIDTH = 2
+_HEX_DIGITS = set('0123456789abcdef')
+_CHUNK_SIZE = 1 << 20
+
+
+def content_hash(data):
+    '''
+    :param data: bytes
+    :return: hex digest used as object id of content addressed objects
+    '''
+    return hashlib.new(HASH_ALGORITHM, data).hexdigest()
+
+
+def file_hash(path):
+    h = hashlib.new(HASH_ALGORITHM)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ShardedStorage:
+    '''
+    Directory tree of objects sharded by hash prefix
+    '''
+    def __init__(self, root, levels=SHARD_LEVELS, width=SHARD_WIDTH):
+        self.root = Path(root)
+        self.levels = levels
+        self.width = width
+
+    def shard_of(self, object_id):
+        '''
+        :return: relative shard dir for object_id. Hex ids (hashes, uuids) are sharded by their own prefix,
+            other ids by prefix of their hash
+        '''
+        key = object_id.lower()
+        if len(key) < self.levels * self.width or not set(key[:self.levels * self.width]) <= _HEX_DIGITS:
+            key = hashlib.md5(object_id.encode('utf-8')).hexdigest()
+        return Path(*[key[i*self.width: (i+1)*self.width] for i in range(self.levels)])
+
+    def relative_path(self, object_id, suffix=''):
+        return self.shard_of(object_id) / (object_id + suffix)
+
+    def path(self, object_id, suffix=''):
+        '''
+        :return: full path of object. Doesn't check if object exists.
+        '''
+        return self.root / self.relative_path(object_id, suffix)
+
+    def dir_for(self, object_id):
+        '''
+        :return: shard dir for object_id, creating it if necessary
+        '''
+        shard_dir = self.root / self.shard_of(object_id)
+        os.makedirs(shard_dir, exist_ok=True)
+        return shard_dir
+
+    def exists(self, object_id, suffix=''):
+        return self.path(object_id, suffix).is_file()
+
+    def _tmp_path(self):
+        os.makedirs(self.root, exist_ok=True)
+        return self.root / ('.tmp.' + uuid.uuid4().hex)
+
+    def _commit(self, tmp_path, object_id, suffix):
+        target = self.dir_for(object_id) / (object_id + suffix)
+        os.replace(str(tmp_path), str(target))
+        return target
+
+    def put_bytes(self, data, suffix='', object_id=None):
+        '''
+        Stores data. If object_id is None, it is content hash of data.
+        :return: object_id
+        '''
+        if object_id is None:
+            object_id = content_hash(data)
+        tmp_path = self._tmp_path()
+        tmp_path.write_bytes(data)
+        self._commit(tmp_path, object_id, suffix)
+        return object_id
+
+    def put_stream(self, stream, suffix='', object_id=None):
+        '''
+        Stores content of a binary file-like object, computing content hash on the fly if object_id is None.
+        :return: object_id
+        '''
+        h = hashlib.new(HASH_ALGORITHM)
+        tmp_path = self._tmp_path()
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in iter(lambda: stream.read(_CHUNK_SIZE), b''):
+                    h.update(chunk)
+                    f.write(chunk)
+            if object_id is None:
+                object_id = h.hexdigest()
+            self._commit(tmp_path, object_id, suffix)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+        return object_id
+
+    def put_file(self, src_path, suffix=None, object_id=None):
+        '''
+        Copies file into storage. Suffix is taken from src_path by default.
+        :return: object_id
+        '''
+        if suffix is None:
+            suffix = Path(src_path).suffix.lower()
+        if object_id is None:
+            object_id = file_hash(src_path)
+        tmp_path = self._tmp_path()
+        shutil.copyfile(str(src_path), str(tmp_path))
+        self._commit(tmp_path, object_id, suffix)
+        return object_id
+
+
+if __name__ == '__main__':
+    import io
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        storage = ShardedStorage(tmp_dir)
+        data = b'braille'
+        object_id = storage.put_stream(io.BytesIO(data), suffix='.jpg')
+        assert object_id == content_hash(data)
+        assert storage.relative_path(object_id, '.jpg') == Path(object_id[:2], object_id[2:4], object_id + '.jpg')
+        assert storage.path(object_id, '.jpg').read_bytes() == data
+        assert storage.put_bytes(data, suffix='.jpg') == object_id
+        assert storage.shard_of('image.zip.page1') == storage.shard_of('image.zip.page1')
+        assert not [p for p in Path(tmp_dir).iterdir() if p.name.startswith('.tmp')]
+    print('OK')
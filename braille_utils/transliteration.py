@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# coding: utf-8
+'''
+Single pass transliteration of recognized text by a table of string replacements.
+
+A replacement table {key: value} was historically applied as a sequence of str.replace calls in the table order
+(see replace_sequentially), one full pass over the text per table entry. Transliterator compiles the table once
+into a few stages, every stage being a trie of keys (represented as a regular expression, so matching runs in C)
+that rewrites the text in one pass.
+
+Replacements can depend on each other: a later key can match text produced by an earlier replacement
+(i.e. '|ක' -> 'ක්', then 'ක්ර' -> 'ක්‍ර') or keys can compete for the same chars. Such replacements are put into
+consecutive stages, keeping their order. Replacements not overlapping in any way commute, so they are
+applied simultaneously within a stage. The output is exactly the same as of replace_sequentially.
+'''
+import functools
+import re
+
+# Sinhala post-correction of text interpreted by braille rules (moved from web_app/error_correction.py)
+SINHALA_CORRECTIONS = {
+    'අ~?~' : 'අං' ,
+    '|ක' : 'ක්' , 'කආ' : 'කා' , 'කඇ' : 'කැ' , 'කඈ' : 'කෑ' , 'කඉ' : 'කි' , 'කඊ' : 'කී' , 'කඋ' : 'කු' , 'කඌ' : 'කූ' , 'කඑ' : 'කෙ' , 'කඒ' : 'කේ' , 'කඓ' : 'කෛ' , 'කඔ' : 'කො' , 'කඕ' : 'කෝ' , 'කඖ' : 'කෞ' , 'කඅං' : 'කං', 'ක්ර':'ක්‍ර', 'ක්ය':'ක්‍ය',
+    '|ඛ' : 'ඛ්' , 'ඛආ': 'ඛා' , 'ඛඇ' : 'ඛැ' , 'ඛඈ' : 'ඛෑ' , 'ඛඉ' : 'ඛි' , 'ඛඊ' : 'ඛී' , 'ඛඋ' : 'ඛු' , 'ඛඌ' : 'ඛූ' , 'ඛඑ' : 'ඛෙ' , 'ඛඒ' : 'ඛේ' , 'ඛඓ' : 'ඛෛ' , 'ඛඔ' : 'ඛො' , 'ඛඕ' : 'ඛෝ' , 'ඛඖ' : 'ඛෞ' , 'ඛඅං' : 'ඛං', 'ඛ්ර':'ඛ්‍ර', 'ඛ්ය':'ඛ්‍ය',
+    '|ග' : 'ග්' , 'ගආ': 'ගා' , 'ගඇ' : 'ගැ' , 'ගඈ' : 'ගෑ' , 'ගඉ' : 'ගි' , 'ගඊ' : 'ගී' , 'ගඋ' : 'ගු' , 'ගඌ' : 'ගූ' , 'ගඑ' : 'ගෙ' , 'ගඒ' : 'ගේ' , 'ගඓ' : 'ගෛ' , 'ගඔ' : 'ගො' , 'ගඕ' : 'ගෝ' , 'ගඖ' : 'ගෞ' , 'ගඅං' : 'ගං' , 'nmග' : 'ඟ','ග්ර':'ග්‍ර','ග්ය':'ග්‍ය',
+    '|ඝ' : 'ඝ්' , 'ඝආ': 'ඝා' , 'ඝඇ' : 'ඝැ' , 'ඝඈ' : 'ඝෑ' , 'ඝඉ' : 'ඝි' , 'ඝඊ' : 'ඝී' , 'ඝඋ' : 'ඝු' , 'ඝඌ' : 'ඝූ' , 'ඝඑ' : 'ඝෙ' , 'ඝඒ' : 'ඝේ' , 'ඝඓ' : 'ඝෛ' , 'ඝඔ' : 'ඝො' , 'ඝඕ' : 'ඝෝ' , 'ඝඖ' : 'ඝෞ' , 'ඝඅං' : 'ඝං','ඝ්ර':'ඝ්‍ර', 'ඝ්ය':'ඝ්‍ය',
+    '|ඟ' : 'ඟ්' , 'ඟආ': 'ඟා' , 'ඟඇ' : 'ඟැ' , 'ඟඈ' : 'ඟෑ' , 'ඟඉ' : 'ඟි' , 'ඟඊ' : 'ඟී' , 'ඟඋ' : 'ඟු' , 'ඟඌ' : 'ඟූ' , 'ඟඑ' : 'ඟෙ' , 'ඟඒ' : 'ඟේ' , 'ඟඔ' : 'ඟො' , 'ඟඕ' : 'ඟෝ' ,'ඟ්ර':'ඟ්‍ර', 'ඟ්ය':'ඟ්‍ය',
+    '|ච' : 'ච්' , 'චආ': 'චා' , 'චඇ' : 'චැ' , 'චඈ' : 'චෑ' , 'චඉ' : 'චි' , 'චඊ' : 'චී' , 'චඋ' : 'චු' , 'චඌ' : 'චූ' , 'චඑ' : 'චෙ' , 'චඒ' : 'චේ' , 'චඓ' : 'චෛ' , 'චඔ' : 'චො' , 'චඕ' : 'චෝ' , 'චඖ' : 'චෞ' , 'චඅං' : 'චං','ච්ර':'ච්‍ර', 'ච්ය':'ච්‍ය',
+    '|ඡ' : 'ඡ්' , 'ඡආ': 'ඡා' , 'ඡඇ' : 'ඡැ' , 'ඡඈ' : 'ඡෑ' , 'ඡඉ' : 'ඡි' , 'ඡඊ' : 'ඡී' , 'ඡඋ' : 'ඡු' , 'ඡඌ' : 'ඡූ' , 'ඡඑ' : 'ඡෙ' , 'ඡඒ' : 'ඡේ' , 'ඡඓ' : 'ඡෛ' , 'ඡඔ' : 'ඡො' , 'ඡඕ' : 'ඡෝ' , 'ඡඖ' : 'ඡෞ' , 'ඡඅං' : 'ඡං','ඡ්ර':'ඡ්‍ර', 'ඡ්ය':'ඡ්‍ය',
+    '|ජ' : 'ජ්' , 'ජආ': 'ජා' , 'ජඇ' : 'ජැ' , 'ජඈ' : 'ජෑ' , 'ජඉ' : 'ජි' , 'ජඊ' : 'ජී' , 'ජඋ' : 'ජු' , 'ජඌ' : 'ජූ' , 'ජඑ' : 'ජෙ' , 'ජඒ' : 'ජේ' , 'ජඓ' : 'ජෛ' , 'ජඔ' : 'ජො' , 'ජඕ' : 'ජෝ' , 'ජඖ' : 'ජෞ' , 'ජඅං' : 'ජං','ජ්ර':'ජ්‍ර', 'ජ්ය':'ජ්‍ය',
+    '|ඤ' : 'ඤ් ' , 'ඤආ': 'ඤා' , 'ඤඇ' : 'ඤැ' , 'ඤඈ' : 'ඤෑ' , 'ඤඉ' : 'ඤි' , 'ඤඊ' : 'ඤී' , 'ඤඋ' : 'ඤු' , 'ඤඌ' : 'ඤූ' , 'ඤඑ' : 'ඤෙ' , 'ඤඒ' : 'ඤේ' , 'ඤඓ' : 'ඤෛ' , 'ඤඔ' : 'ඤො' , 'ඤඕ' : 'ඤෝ' , 'ඤඖ' : 'ඤෞ' , 'ඤඅං' : 'ඤං','ඤ්ර':'ඤ්‍ර', 'ඤ්ය':'ඤ්‍ය',
+    '|ට':'ට්','ටආ': 'ටා','ටඇ': 'ටැ','ටඈ': 'ටෑ','ටඉ': 'ටි','ටඊ': 'ටී','ටඋ': 'ටු','ටඌ': 'ටූ','ටඑ': 'ටෙ','ටඒ': 'ටේ','ටඔ': 'ටො','ටඕ': 'ටෝ','ටඖ': 'ටෞ','ටඓ': 'ටෛ','ට්ර':'ට්‍ර', 'ට්ය':'ට්‍ය',
+    '|ඨ':'ඨ්','ඨආ': 'ඨා','ඨඇ': 'ඨැ','ඨඈ': 'ඨෑ','ඨඋ': 'ඨු','ඨඌ': 'ඨූ','ඨඉ': 'ඨි','ඨඊ': 'ඨී','ඨඑ': 'ඨෙ','ඨඒ': 'ඨේ','ඨඓ': 'ඨෛ','ඨඔ': 'ඨො','ඨඕ': 'ඨෝ','ඨඖ': 'ඨෞ','ඨ්ර':'ඨ්‍ර', 'ඨ්ය':'ඨ්‍ය',
+    '|ඩ':'ඩ්','ඩආ': 'ඩා','ඩඇ': 'ඩැ','ඩඈ': 'ඩෑ','ඩඉ': 'ඩි','ඩඊ': 'ඩී','ඩඋ': 'ඩු','ඩඌ': 'ඩූ','ඩඑ': 'ඩෙ','ඩඒ': 'ඩේ','ඩඓ': 'ඩෛ','ඩඔ': 'ඩො','ඩඕ': 'ඩෝ','ඩඖ': 'ඩෞ','ඩ්ර':'ඩ්‍ර', 'ඩ්ය':'ඩ්‍ය',
+    '|ඪ':'ඪ්','ඪආ': 'ඪා','ඪඇ': 'ඪැ','ඪ ඈ': 'ඪෑ',
+    '|ණ':'ණ්','ණආ': 'ණා','ණඇ': 'ණැ','ණඈ': 'ණෑ','ණඉ': 'ණි','ණඊ': 'ණී','ණඋ': 'ණු','ණ ඌ': 'ණූ','ණඑ': 'ණෙ','ණඒ': 'ණේ','ණඔ': 'ණො','ණඕ': 'ණෝ','ණඖ': 'ණෞ','ණඓ': 'ණෛ','ණ්ර':'ණ්‍ර', 'ණ්ය':'ණ්‍ය',
+    '|ත':'ත්','තආ': 'තා','තඇ': 'තැ','තඈ': 'තෑ','තඉ': 'ති','තඊ': 'තී','තඋ': 'තු','තඌ': 'තූ','තඑ': 'තෙ','තඒ': 'තේ','තඔ': 'තො','තඕ': 'තෝ','තඖ': 'තෞ','තඓ': 'තෛ','ත්ර':'ත්‍ර', 'ත්ය':'ත්‍ය',
+    '|ථ':'ථ්','ථආ': 'ථා','ථඇ': 'ථැ','ථඈ': 'ථෑ','ථඉ': 'ථි','ථඊ': 'ථී','ථඋ': 'ථු','ථඌ': 'ථූ','ථඑ': 'ථෙ','ථඒ': 'ථේ','ථඔ': 'ථො','ථඕ': 'ථෝ','ථඖ': 'ථෞ','ථඓ': 'ථෛ','ථ්ර':'ථ්‍ර', 'ථ්ය':'ථ්‍ය',
+    '|ද':'ද්','දආ': 'දා','දඇ': 'දැ','දඈ': 'දෑ','දඉ': 'දි','දඊ': 'දී','දඋ': 'දු','දඌ': 'දූ','දඑ': 'දෙ','දඒ': 'දේ','දඔ': 'දො','දඕ': 'දෝ','දඖ': 'දෞ','දඓ': 'දෛ','ද්ර':'ද්‍ර', 'ද්ය':'ද්‍ය','nmද':'ඳ',
+    '|ධ':'ධ්','ධආ': 'ධා','ධඇ': 'ධැ','ධඈ': 'ධෑ','ධඉ': 'ධි','ධඊ': 'ධී','ධඋ': 'ධු','ධඌ': 'ධූ','ධඑ': 'ධෙ','ධඒ': 'ධේ','ධඔ': 'ධො','ධඕ': 'ධෝ','ධඖ': 'ධෞ','ධඓ': 'ධෛ','ධ්ර':'ධ්‍ර', 'ධ්ය':'ධ්‍ය',
+    '|න':'න්','නආ': 'නා','නඇ': 'නැ','නඈ': 'නෑ','නඉ': 'නි','නඊ': 'නී','නඋ': 'නු','නඌ': 'නූ','නඑ': 'නෙ','නඒ': 'නේ','නඔ': 'නො','නඕ': 'නෝ','නඖ': 'නෞ','නඓ': 'නෛ','න්ර':'න්‍ර', 'න්ය':'න්‍ය',
+    'ඳආ':'ඳා','ඳඇ':'ඳැ','ඳඈ':'ඳෑ','ඳඉ':'ඳි','ඳඊ':'ඳී','ඳඋ':'ඳු','ඳඌ':'ඳූ','ඳඑ':'ඳෙ','ඳඒ':'ඳේ','ඳඔ':'ඳො','ඳඕ':'ඳෝ',
+    'ඹආ':'ඹා','ඹඇ':'ඹැ','ඹඈ':'ඹෑ','ඹඉ':'ඹි','ඹඊ':'ඹී','ඹඋ':'ඹු','ඹඌ':'ඹූ','ඹඑ':'ඹෙ','ඹඒ':'ඹේ','ඹඔ':'ඹො','ඹඕ':'ඹෝ',
+    '|ප':'ප්','පආ':'පා','පඇ':'පැ','පඈ':'පෑ','පඉ':'පි','පඊ':'පී','පඋ':'පු','පඌ':'පූ','පඑ':'පෙ','පඒ':'පේ','පඓ':'පෛ','පඔ':'පො','පඕ':'පෝ','පඖ':'පෞ','ප්ර':'ප්‍ර', 'ප්ය':'‍ප්‍ය',
+    '|ඵ':'ඵ්','ඵආ': 'ඵා','ඵඇ': 'ඵැ','ඵඈ': 'ඵෑ','ඵඉ': 'ඵි','ඵඊ': 'ඵී','ඵඋ': 'ඵු','ඵඌ': 'ඵූ','ඵඑ': 'ඵෙ','ඵඒ': 'ඵේ','ඵඔ': 'ඵො','ඵඕ': 'ඵෝ','ඵඖ': 'ඵෞ','ඵඓ': 'ඵෛ','ඵ්ර':'ඵ්‍ර', 'ඵ්ය':'ඵ්‍ය',
+    '|බ':'බ්','බආ': 'බා','බඇ': 'බැ','බඈ': 'බෑ','බඉ': 'බි','බඊ': 'බී','බඋ': 'බු','බඌ': 'බූ','බඑ': 'බෙ','බඒ': 'බේ','බඔ': 'බො','බඕ': 'බෝ','බඖ': 'බෞ','බඓ': 'බෛ','බ්ර':'බ්‍ර', 'බ්ය':'බ්‍ය','nmබ':'ඹ',
+    '|භ':'භ්','භආ': 'භා','භඇ': 'භැ','භඈ': 'භෑ','භඉ': 'භි','භඊ': 'භී','භඋ': 'භු','භඌ': 'භූ','භඑ': 'භෙ','භඒ': 'භේ','භඔ': 'භො','භඕ': 'භෝ','භඖ': 'භෞ','භඓ': 'භෛ','භ්ර':'භ්‍ර', 'භ්ය':'භ්‍ය',
+    '|ම':'ම්','මආ': 'මා','මඇ': 'මැ','මඈ': 'මෑ','මඉ': 'මි','මඊ': 'මී','මඋ': 'මු','මඌ': 'මූ','මඑ': 'මෙ','මඒ': 'මේ','මඔ': 'මො','මඕ': 'මෝ','මඖ': 'මෞ','මඓ': 'මෛ','ම්ර':'ම්‍ර', 'ම්ය':'ම්‍ය',
+    '|ය':'ය්','යආ':'යා','යඇ':'යැ','යඈ':'යෑ','යඉ':'යි','යඊ':'යී','යඋ':'යු','යඌ':'යූ','යඑ':'යෙ','යඒ':'යේ','යඓ':'යෛ','යඔ':'යො','යඕ':'යෝ','යඖ':'යෞ','ය්ර':'ය්‍ර', 'ය්ය':'ය්‍ය',
+    '|ර':'ර්','රආ':'රා','රඇ':'රැ','රඈ':'රෑ','රඉ':'රි','රඊ':'රී','රඋ':'රු','රඌ':'රූ','රඑ':'රෙ','රඒ':'රේ','රඓ':'රෛ','රඔ':'රො','රඕ':'රෝ','රඖ':'රෞ',
+    '|ල':'ල්','ලආ': 'ලා','ලඇ': 'ලැ','ලඈ': 'ලෑ','ලඉ': 'ලි','ලඊ': 'ලී','ලඋ': 'ලු','ලඌ': 'ලූ','ලඑ': 'ලෙ','ලඒ': 'ලේ','ලඔ': 'ලො','ලඕ': 'ලෝ','ලඖ': 'ලෞ','ලඓ': 'ලෛ','ල්ය':'ල්‍ය',
+    '|ව' : 'ව් ' , 'වආ': 'වා' , 'වඇ' : 'වැ' , 'වඈ' : 'වෑ' , 'වඉ' : 'වි' , 'වඊ' : 'වී' , 'වඋ' : 'වු' , 'වඌ' : 'වූ' , 'වඑ' : 'වෙ' , 'වඒ' : 'වේ' , 'වඓ' : 'වෛ' , 'වඔ' : 'වො' , 'වඕ' : 'වෝ' , 'වඖ' : 'වෞ' , 'වඅං' : 'වං','ව්ර':'ව්‍ර', 'ව්ය':'ව්‍ය',
+    '|ශ':'ශ්','ශආ':'ශා','ශඇ':'ශැ','ශඈ':'ශෑ','ශඉ':'ශි','ශඊ':'ශී','ශඋ':'ශු','ශඌ':'ශූ','ශඑ':'ශෙ','ශඒ':'ශේ','ශඔ':'ශො','ශඕ':'ශෝ','ශ්ර':'ශ්‍ර', 'ශ්ය':'ශ්‍ය',
+    '|ෂ':'ෂ්','ෂආ':'ෂා','ෂඇ':'ෂැ','ෂඈ':'ෂෑ','ෂඉ':'ෂි','ෂඊ':'ෂී','ෂඋ':'ෂු','ෂඌ':'ෂූ','ෂඑ':'ෂෙ','ෂඒ':'ෂේ','ෂඔ':'ෂො','ෂඕ':'ෂෝ','ෂ්ර':'ෂ්‍ර', 'ෂ්ය':'ෂ්‍ය',
+    '|ස':'ස්','සආ':'සා','සඇ':'සැ','සඈ':'සෑ','සඉ':'සි','සඊ':'සී','සඋ':'සු','සඌ':'සූ','සඑ':'සෙ','සඒ':'සේ','සඔ':'සො','සඕ':'සෝ','සඖ':'සෞ','ස්ර':'ස්‍ර', 'ස්ය':'ස්‍ය',
+    '|හ':'හ්','හආ':'හා','හඇ':'හැ','හඈ':'හෑ','හඉ':'හි','හඊ':'හී','හඋ':'හු','හඌ':'හූ','හඑ':'හෙ','හඒ':'හේ','හඓ':'හෛ','හඔ':'හො','හඕ':'හෝ','හඖ':'හෞ','හ්ර':'හ්‍ර', 'හ්ය':'හ්‍ය',
+    '|ළ':'ළ්','ළආ':'ළා','ළඇ':'ළැ','ළඈ':'ළෑ','ළඉ':'ළි','ළඊ':'ළී','ළඋ':'ළු','ළඌ':'ළුු','ළඑ':'ළෙ','ළඒ':'ළේ','ළඓ':'ළෛ','ළඔ':'ළො','ළඕ':'ළෝ','ළඖ':'ළෞ',
+    '|ෆ':'ෆ්','ෆආ':'ෆා','ෆඇ':'ෆැ','ෆඈ':'ෆෑ','ෆඉ':'ෆි','ෆඊ':'ෆී','ෆඋ':'ෆු','ෆඌ':'ෆූ','ෆඑ':'ෆෙ','ෆඒ':'ෆේ','ෆඓ':'ෆෛ','ෆඔ':'ෆො','ෆඕ':'ෆෝ','ෆඖ':'ෆෞ','ෆ්ර':'ෆ්‍ර', 'ෆ්ය':'ෆ්‍ය',
+    'සි~?~' : 'සිං' ,
+}
+
+
+def replace_sequentially(text, table):
+    '''
+    Reference implementation: applies replacements of the table one by one, each to the whole text
+    :param text: str
+    :param table: dict {key: value}, applied in dict order
+    :return: str
+    '''
+    for key, value in table.items():
+        text = text.replace(key, value)
+    return text
+
+
+def _overlap(s1, s2):
+    '''
+    :return: True if occurrences of s1 and s2 in a text can share chars
+    '''
+    if not s1 or not s2:
+        return True  # empty value joins its neighbours
+    if s1 in s2 or s2 in s1:
+        return True
+    return any(s1.endswith(s2[:i]) or s2.endswith(s1[:i]) for i in range(1, min(len(s1), len(s2))))
+
+
+def _trie_regex(keys):
+    '''
+    Regex matching the longest of keys at a position. Built from a trie of keys, so that the text is matched char by
+    char rather than trying keys one by one.
+    '''
+    trie = dict()
+    for key in keys:
+        node = trie
+        for ch in key:
+            node = node.setdefault(ch, dict())
+        node[''] = dict()  # end of key
+
+    def node_regex(node):
+        alternatives = [re.escape(ch) + node_regex(child) for ch, child in sorted(node.items()) if ch]
+        if not alternatives:
+            return ''
+        group = '(?:' + '|'.join(alternatives) + ')'
+        # greedy optional group: longer key is tried first, falling back to the key ending at this node
+        return group + '?' if '' in node else group
+    return node_regex(trie)
+
+
+class Transliterator:
+    '''
+    Replacement table compiled for fast transliteration:
+    Transliterator(table)(text) == replace_sequentially(text, table)
+    '''
+    def __init__(self, table):
+        '''
+        :param table: dict {key: value}. Replacements are applied in dict order as by replace_sequentially
+        '''
+        self.table = {k: v for k, v in table.items() if k}
+        self.stages = [(re.compile(_trie_regex(stage)), stage) for stage in self._split_to_stages(self.table)]
+
+    @staticmethod
+    def _split_to_stages(table):
+        '''
+        Assigns every replacement to the stage next to the last stage containing an earlier replacement it depends on
+        :return: list of dicts {key: value}
+        '''
+        rules = [(key, value, set(key), set(value)) for key, value in table.items()]
+        rule_stages = []
+        for j, (key, value, key_chars, value_chars) in enumerate(rules):
+            stage = 0
+            for i in range(j):
+                if rule_stages[i] < stage:
+                    continue
+                key_i, value_i, key_chars_i, value_chars_i = rules[i]
+                if ((key_chars & key_chars_i and _overlap(key, key_i))
+                        or (key_chars & value_chars_i and _overlap(key, value_i))
+                        or (key_chars_i & value_chars and _overlap(key_i, value))
+                        or not value or not value_i):
+                    stage = rule_stages[i] + 1
+            rule_stages.append(stage)
+        stages = [dict() for _ in range(max(rule_stages, default=-1) + 1)]
+        for (key, value, _, _), stage in zip(rules, rule_stages):
+            stages[stage][key] = value
+        return stages
+
+    def __call__(self, text):
+        '''
+        :param text: str
+        :return: transliterated text
+        '''
+        for pattern, replacements in self.stages:
+            text = pattern.sub(lambda m: replacements[m.group(0)], text)
+        return text
+
+
+@functools.lru_cache(maxsize=None)
+def get_transliterator(name):
+    '''
+    :param name: name of the table in this module, i.e. 'SINHALA_CORRECTIONS'
+    :return: Transliterator, compiled on first use
+    '''
+    return Transliterator(globals()[name])
+
+
+if __name__ == '__main__':
+    import random
+    import timeit
+    from pathlib import Path
+
+    transliterator = get_transliterator('SINHALA_CORRECTIONS')
+    table = transliterator.table
+    # corpus: text corrected before + random texts made of keys, values and chars of the table
+    corpus = [(Path(__file__).parent.parent / 'web_app' / 'final_results' / 'test2.txt').read_text(encoding='utf-8')]
+    rnd = random.Random(0)
+    pieces = list(table) + list(table.values()) + sorted(set(''.join(table))) + [' ', '\n', '~?~']
+    corpus += [''.join(rnd.choice(pieces) for _ in range(rnd.randint(1, 8))) for _ in range(100000)]
+    for text in corpus:
+        assert transliterator(text) == replace_sequentially(text, table), text
+    book = ''.join(rnd.choice(pieces[:len(table)] + [' '] * 30) for _ in range(200000))
+    t_seq = timeit.timeit(lambda: replace_sequentially(book, table), number=3)
+    t_tr = timeit.timeit(lambda: transliterator(book), number=3)
+    print('{} stages, {} chars: sequential {:.3f}s, staged {:.3f}s'.format(
+        len(transliterator.stages), len(book), t_seq / 3, t_tr / 3))
+    print('OK')
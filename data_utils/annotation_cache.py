@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# coding: utf-8
+'''
+Disk cache of parsed annotations (DSBI txt or LabelMe JSON).
+
+Every annotation is stored once as float64 array (N, 5): left, top, right, bottom, label per row (see
+data.read_annotation). Cache key is annotation file path, size and mtime and parser params, so changed files or
+settings (i.e. rect_margin) are parsed again. Cache files are memory-mapped .npy files (see image_cache.LruArrayCache
+shared_dir), so the cache dir can be shared by DataLoader workers and by training and validation runs.
+'''
+import os
+import numpy as np
+
+from data_utils import image_cache
+
+ANNOTATION_CACHE_VERSION = 1  # increment if parsing of annotations changes
+
+_caches = dict()  # cache dir -> LruArrayCache
+
+
+def annotation_key(label_filename, parser_params):
+    '''
+    :param parser_params: tuple of parser parameters results depend on
+    '''
+    st = os.stat(label_filename)
+    return (os.path.abspath(label_filename), st.st_size, st.st_mtime_ns) + tuple(parser_params) + (ANNOTATION_CACHE_VERSION,)
+
+
+def rects_to_array(rects):
+    '''
+    :param rects: list of (left, top, right, bottom, label)
+    :return: float64 array (N, 5)
+    '''
+    return np.array(rects, dtype=np.float64).reshape(-1, 5)
+
+
+def array_to_rects(array):
+    '''
+    :return: list of (left, top, right, bottom, label), label is int
+    '''
+    return [tuple(r[:4]) + (int(r[4]),) for r in np.asarray(array).tolist()]
+
+
+def cached_annotation(label_filename, parser_params, parse_fn, cache_dir):
+    '''
+    :param label_filename: annotation file
+    :param parser_params: tuple of parser parameters results depend on, part of the cache key
+    :param parse_fn: function() parsing annotation file, returns list of (left, top, right, bottom, label)
+        or float64 array (N, 5)
+    :param cache_dir: cache dir, annotation is parsed without caching if None
+    :return: list of (left, top, right, bottom, label), label is int
+    '''
+    if cache_dir is None:
+        return array_to_rects(rects_to_array(parse_fn()))
+    cache = _caches.get(cache_dir)
+    if cache is None:
+        cache = image_cache.LruArrayCache(max_bytes=0, shared_dir=cache_dir)
+        _caches[cache_dir] = cache
+    key = annotation_key(label_filename, parser_params)
+    cached = cache.get(key)
+    if cached is not None:
+        return array_to_rects(cached[0])
+    array = rects_to_array(parse_fn())
+    cache.put(key, array)
+    return array_to_rects(array)
+
+
+def cache_stats():
+    '''
+    :return: dict cache dir -> stats (see image_cache.LruArrayCache.stats)
+    '''
+    return {cache_dir: cache.stats() for cache_dir, cache in _caches.items()}
+
+
+if __name__ == '__main__':
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        label_fn = os.path.join(tmp_dir, 'a.txt')
+        with open(label_fn, 'w') as f:
+            f.write('x')
+        rects = [(0.1, 0.2, 0.3, 0.4, 5), (0.5, 0.6, 0.7, 0.8, 63)]
+        calls = []
+        def parse():
+            calls.append(1)
+            return rects
+        cache_dir = os.path.join(tmp_dir, 'cache')
+        for margin in (0.3, 0.3, 0.2):
+            assert cached_annotation(label_fn, (margin,), parse, cache_dir) == rects
+        assert len(calls) == 2  # parsed once for every margin
+        _caches.clear()  # i.e. another process
+        assert cached_annotation(label_fn, (0.3,), lambda: [], cache_dir)[1] == (0.5, 0.6, 0.7, 0.8, 63)
+        assert cache_stats()[cache_dir]['shared_hits'] == 1
+        os.utime(label_fn, ns=(0, 0))  # file changed
+        assert cached_annotation(label_fn, (0.3,), lambda: [], cache_dir) == []
+        assert cached_annotation(label_fn, (0.3,), lambda: [], None) == []
+    print('OK')
@@ -16,7 +16,10 @@ import torch
 import torchvision.transforms.functional as F
 import cv2
 
+from data_utils import annotation_cache
 from data_utils import dsbi
+from data_utils import image_cache
+from data_utils import pack_dataset
 from braille_utils import label_tools as lt
 import local_config
 
@@ -151,6 +154,10 @@ class BrailleDataset(torch.utils.data.ConcatDataset):
         :param mode: augmentation and output mode ('train', 'debug', 'inference')
         :param verbose: if != 0 enables debug print
         '''
+        self.image_cache = image_cache.create_cache(params, 'image', shareable=True)
+        self.aug_cache = image_cache.create_cache(params, 'aug')
+        self.worker_counters = None  # see enable_worker_stats
+        caches = (self.image_cache, self.aug_cache)
         sub_datasets = []
         for list_file_name in list_file_names:
             if isinstance(list_file_name, (tuple, list)):
@@ -160,20 +167,44 @@ class BrailleDataset(torch.utils.data.ConcatDataset):
             else:
                 sample_weight = 1
                 list_params = {}
-            while sample_weight >= 1:
-                sub_datasets.append(BrailleSubDataset(params, list_file_name, mode, verbose, 1, list_params))
-                sample_weight -= 1
-            if sample_weight > 1e-10:
-                sub_datasets.append(BrailleSubDataset(params, list_file_name, mode, verbose, sample_weight, list_params))
+            sub_datasets.append(BrailleSubDataset(params, list_file_name, mode, verbose, sample_weight, list_params,
+                                                  caches))
 
         super(BrailleDataset, self).__init__(sub_datasets)
 
+    def __getitem__(self, idx):
+        res = super(BrailleDataset, self).__getitem__(idx)
+        if self.worker_counters is not None:
+            worker_info = torch.utils.data.get_worker_info()
+            if worker_info is not None:
+                self.worker_counters[worker_info.id] = torch.tensor(
+                    [self.image_cache.counters(), self.aug_cache.counters()], dtype=torch.int64)
+        return res
+
+    def enable_worker_stats(self, num_workers):
+        '''
+        Makes DataLoader workers publish counters of their caches to shared memory, so cache_stats
+        in the main process sums caches of all workers. Must be called before workers are started.
+        '''
+        self.worker_counters = torch.zeros(num_workers, 2, len(image_cache.STATS_COUNTERS),
+                                           dtype=torch.int64).share_memory_()
+
+    def cache_stats(self):
+        '''
+        :return: dict: cache name -> stats (see image_cache.LruArrayCache.stats)
+        '''
+        if self.worker_counters is None:
+            return {'image': self.image_cache.stats(), 'aug': self.aug_cache.stats()}
+        counters = self.worker_counters.sum(dim=0).tolist()
+        return {'image': image_cache.stats_from_counters(counters[0]),
+                'aug': image_cache.stats_from_counters(counters[1])}
+
 class BrailleSubDataset:
     '''
     Provides subset of data for BrailleSubDataset defined by one list file
     '''
 
-    def __init__(self, params, list_file_name, mode, verbose, sample_weight, list_params):
+    def __init__(self, params, list_file_name, mode, verbose, sample_weight, list_params, caches=None):
         '''
         :param params:  params dict
         :param list_file_names: list of files with image files list (relative to local_config.data_path)
@@ -183,78 +214,79 @@ class BrailleSubDataset:
         :param sample_weight: при значениях больше двух - датасет повторяется. При дробных значениях - уменьшается
          видимы размер датасета за счето того, что при запросе одного индекса выдатся последовательно разные элементы.
          дробная часть долна быть кратна 1/n
+         Repeats are made by mapping of indexes, so images and annotations are stored once.
         :param list_params: опиональный параметр - dict, 3-й при в списке в m param. Выдается в батч ввместе с данными об item.
+        :param caches: (decoded images cache, augmented images cache), see image_cache.create_cache.
+            Can be shared by sub datasets. Created from params if None.
         '''
         assert mode in {'train', 'debug', 'inference'}
         self.params = params
         self.mode = mode
         self.image_preprocessor = ImagePreprocessor(params, mode)
 
-        self.image_files = []
-        self.label_files = []
-
         list_file = os.path.join(local_config.data_path, list_file_name)
-        data_dir = os.path.dirname(list_file)
-        with open(list_file, 'r') as f:
-            files = f.readlines()
-        for fn in files:
-            if fn[-1] == '\n':
-                fn = fn[:-1]
-            fn = fn.replace('\\', '/')
-            image_fn, labels_fn = self.filenames_of_item(data_dir, fn)
-            if image_fn:
-                self.image_files.append(image_fn)
-                self.label_files.append(labels_fn)
-            else:
-                print("WARNING: can't load file:", data_dir, fn)
+        self.pack = None
+        if list_file.endswith(pack_dataset.PACK_SUFFIX):
+            self.pack = pack_dataset.PackedDataset(list_file)
+            self.pack.check_params(params)
+            self.image_files = self.pack.image_files
+            self.label_files = [None] * len(self.image_files)
+        else:
+            self.image_files, self.label_files = read_list_file(list_file)
 
         assert len(self.image_files) > 0, list_file
 
-        self.images = [None] * len(self.image_files)
+        if caches is None:
+            caches = image_cache.create_cache(params, 'image', shareable=True), image_cache.create_cache(params, 'aug')
+        self.images, self.aug_images = caches  # decoded images by file name, augmented images and boxes by item
+        self.image_keys = [None] * len(self.image_files)  # key of decoded image in cache, changes if file is changed
         self.rects = [None] * len(self.image_files)
-        self.aug_images = [None] * len(self.image_files)
-        self.aug_bboxes = [None] * len(self.image_files)
         self.REPEAT_PROBABILITY = 0.6
         self.verbose = verbose
-        assert sample_weight <= 1
-        if sample_weight < 1:
+        self.repeats = 0  # number of whole repeats of the list
+        while sample_weight >= 1:
+            self.repeats += 1
+            sample_weight -= 1
+        self.denominator = 0  # every denominator-th item is used in the fractional part
+        if sample_weight > 1e-10:
             assert mode == 'train'
-        self.denominator = int(1/sample_weight)
-        self.call_count = 0
+            self.denominator = int(1/sample_weight)
         self.list_params = list_params
 
     def __len__(self):
-        return len(self.image_files) // self.denominator
+        n = len(self.image_files)
+        return self.repeats * n + (n // self.denominator if self.denominator else 0)
 
     def __getitem__(self, item):
-        if self.denominator > 1:
-            self.call_count = (self.call_count + 1) % self.denominator
-            item = item * self.denominator + self.call_count
-        img = self.images[item]
-        if img is None:
-            img_fn = self.image_files[item]
-            img = PIL.Image.open(img_fn)
-            img = np.asarray(img)
-            img= unify_shape(img)
-            assert len(img.shape) == 3 and img.shape[2] == 3, (img_fn, img.shape)
-            self.images[item] = img
+        n = len(self.image_files)
+        if item < self.repeats * n:
+            item = item % n
+        else:
+            item -= self.repeats * n
+            if self.denominator > 1:
+                # random (not cyclic) choice from a group: cycle counter would be separate in every DataLoader worker
+                item = item * self.denominator + random.randrange(self.denominator)
+        img = self.load_image(item)
         width = img.shape[1]
         height = img.shape[0]
         rects = self.rects[item]
         if rects is None:
-            lbl_fn = self.label_files[item]
-            rects = self.read_annotation(lbl_fn, width, height)
+            if self.pack is not None:
+                rects = self.pack.rects(item)
+            else:
+                lbl_fn = self.label_files[item]
+                rects = self.read_annotation(lbl_fn, width, height)
             rects = [ (min(r[0], r[2]), min(r[1], r[3]), max(r[0], r[2]), max(r[1], r[3])) + r[4:] for r in rects]
             rects = [ r for r in rects if r[0] < r[2] and r[1] < r[3]]
             self.rects[item] = rects
 
-        if (self.aug_images[item] is not None) and (random.random() < self.REPEAT_PROBABILITY):
-            aug_img = self.aug_images[item]
-            aug_bboxes = self.aug_bboxes[item]
+        aug_key = (id(self), item)
+        cached = self.aug_images.get(aug_key)
+        if (cached is not None) and (random.random() < self.REPEAT_PROBABILITY):
+            aug_img, aug_bboxes = cached
         else:
             aug_img, aug_bboxes = self.image_preprocessor.preprocess_and_augment(img, rects)
-            self.aug_images[item] = aug_img
-            self.aug_bboxes[item] = aug_bboxes
+            self.aug_images.put(aug_key, aug_img, aug_bboxes)
 
         if self.verbose >= 2:
             print('BrailleDataset: preparing file '+ self.image_files[item] + '. Total rects: ' + str(len(aug_bboxes)))
@@ -264,7 +296,28 @@ class BrailleSubDataset:
         else:
             return self.image_preprocessor.to_normalized_tensor(aug_img), np.asarray(aug_bboxes).reshape(-1, 5), self.list_params, aug_img
 
-    def filenames_of_item(self, data_dir, fn):
+    def load_image(self, item):
+        '''
+        :return: image as np.array HxWx3, memory-mapped from pack or decoded (and cached)
+        '''
+        if self.pack is not None:
+            return self.pack.image(item)
+        img_fn = self.image_files[item]
+        if self.image_keys[item] is None:
+            st = os.stat(img_fn)
+            self.image_keys[item] = (img_fn, st.st_size, st.st_mtime_ns)
+        cached = self.images.get(self.image_keys[item])
+        if cached is not None:
+            return cached[0]
+        img = PIL.Image.open(img_fn)
+        img = np.asarray(img)
+        img= unify_shape(img)
+        assert len(img.shape) == 3 and img.shape[2] == 3, (img_fn, img.shape)
+        self.images.put(self.image_keys[item], img)
+        return img
+
+    @staticmethod
+    def filenames_of_item(data_dir, fn):
         '''
         Finds appropriate image and label full filenames for list item and validates these files exists
         :param data_dir: dir base for filename from list
@@ -298,15 +351,65 @@ class BrailleSubDataset:
         :param label_filename: annotation file (txt for DSBI or JSON for LabelMe
         :return: list: [(left,top,right,bottom,label), ...] where coords are (0..1), label is int [1..63]
         '''
-        ext = label_filename.rsplit('.', 1)[-1]
-        if ext == 'txt':
-            return dsbi.read_DSBI_annotation(label_filename, width, height,
-                                             self.params.data.get('rect_margin', 0.3),
-                                             self.params.data.get('get_points', False))
-        elif ext == 'json':
-            return read_LabelMe_annotation(label_filename, self.params.data.get('get_points', False))
+        return read_annotation(label_filename, width, height, self.params)
+
+
+def read_list_file(list_file):
+    '''
+    :param list_file: full path of list file, file paths in it are relative to its location
+    :return: list of image filenames, list of label filenames (images without labels are skipped)
+    '''
+    image_files = []
+    label_files = []
+    data_dir = os.path.dirname(list_file)
+    with open(list_file, 'r') as f:
+        files = f.readlines()
+    for fn in files:
+        if fn[-1] == '\n':
+            fn = fn[:-1]
+        fn = fn.replace('\\', '/')
+        image_fn, labels_fn = BrailleSubDataset.filenames_of_item(data_dir, fn)
+        if image_fn:
+            image_files.append(image_fn)
+            label_files.append(labels_fn)
         else:
-            raise ValueError("unsupported label file type: " + ext)
+            print("WARNING: can't load file:", data_dir, fn)
+    return image_files, label_files
+
+
+def read_annotation(label_filename, width, height, params):
+    '''
+    Reads annotation file (DSBI or LabelMe)
+    :param label_filename: annotation file (txt for DSBI or JSON for LabelMe
+    :param width, height: image size
+    :param params: params.data.annotation_cache_dir - dir to cache parsed annotations in (see annotation_cache),
+        no caching if not set
+    :return: list: [(left,top,right,bottom,label), ...] where coords are (0..1), label is int [1..63]
+    '''
+    return read_annotation_file(label_filename, width, height,
+                                rect_margin=params.data.get('rect_margin', 0.3),
+                                get_points=params.data.get('get_points', False),
+                                cache_dir=params.data.get('annotation_cache_dir', None))
+
+
+def read_annotation_file(label_filename, width, height, rect_margin, get_points, cache_dir=None):
+    '''
+    Same as read_annotation with explicit parser params
+    :param cache_dir: dir to cache parsed annotations in (see annotation_cache), no caching if None
+    '''
+    ext = label_filename.rsplit('.', 1)[-1]
+    if ext == 'txt':
+        return annotation_cache.cached_annotation(
+            label_filename, ('DSBI', width, height, rect_margin, get_points),
+            lambda: dsbi.read_DSBI_annotation_array(label_filename, width, height, rect_margin, get_points),
+            cache_dir)
+    elif ext == 'json':
+        return annotation_cache.cached_annotation(
+            label_filename, ('LabelMe', get_points),
+            lambda: read_LabelMe_annotation(label_filename, get_points),
+            cache_dir)
+    else:
+        raise ValueError("unsupported label file type: " + ext)
 
 
 def limiting_scaler(source, dest):
@@ -350,14 +453,31 @@ def read_LabelMe_annotation(label_filename, get_points):
     return rects
 
 
+def worker_init_fn(worker_id):
+    '''
+    Seeds numpy RNG (used by augmentations) of a DataLoader worker. Torch seeds only python and torch RNGs of workers,
+    so numpy RNG would be the same in all workers.
+    '''
+    np.random.seed(torch.initial_seed() % 2**32)
+
+
 def create_dataloader(params, collate_fn, list_file_names, shuffle, mode = 'train', verbose = 0):
     '''
-    :param params: params AttrDict
+    :param params: params AttrDict. params.data.num_workers (0 by default) - number of loading processes,
+        collate_fn must not use CUDA if > 0 (see create_model_retinanet); params.data.prefetch_factor - batches
+        prepared in advance by every worker
     :param collate_fn: converts batch from BrailleDataset output to format required by model
     :return: pytorch DataLoader
     '''
     dataset = BrailleDataset(params, list_file_names=list_file_names, mode=mode, verbose=verbose)
-    loader = torch.utils.data.DataLoader(dataset, params.data.batch_size, shuffle=shuffle, num_workers=0, collate_fn=collate_fn)
+    num_workers = params.data.get('num_workers', 0)
+    worker_params = dict()
+    if num_workers:
+        dataset.enable_worker_stats(num_workers)
+        worker_params = dict(worker_init_fn=worker_init_fn, persistent_workers=True,  # workers keep their caches
+                             prefetch_factor=params.data.get('prefetch_factor', 2), pin_memory=torch.cuda.is_available())
+    loader = torch.utils.data.DataLoader(dataset, params.data.batch_size, shuffle=shuffle, num_workers=num_workers,
+                                         collate_fn=collate_fn, **worker_params)
     return loader
 
 
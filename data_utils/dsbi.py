@@ -4,6 +4,7 @@
 Utils for DSBI dataset (https://github.com/yeluo1994/DSBI)
 """
 import collections
+import numpy as np
 from braille_utils import label_tools as lt
 
 CellInfo = collections.namedtuple('CellInfo', 
@@ -11,6 +12,58 @@ CellInfo = collections.namedtuple('CellInfo',
                                    'left', 'top', 'right', 'bottom',  # symbol corner coordinates in pixels
                                    'label'])  # symbol label either like '246' or '010101' format
 
+def _parse_numbers(line):
+    """
+    Parses space separated numbers without eval
+    :return: np.array of int64 if all numbers are ints, of float64 otherwise
+    """
+    tokens = line.split()
+    try:
+        return np.array(tokens, dtype=np.int64)
+    except ValueError:
+        return np.array(tokens, dtype=np.float64)
+
+
+def read_arrays(file_txt):
+    """
+    Loads Braille annotation from DSBI annotation txt file as arrays
+    :param file_txt: filename of txt file
+    :return: tuple (
+        angle: value from 1st line of annotation file,
+        h_lines: array of horizontal lines Y-coordinates,
+        v_lines: array of vertical lines X-coordinates,
+        cells: int array (N, 8): row, col (1-based) and 6 dots (0 or 1) of every symbol
+    )
+    None, None, None, None for empty annotation
+    """
+    with open(file_txt, 'r') as f:
+        l = f.readlines()
+    if len(l) < 3:
+        return None, None, None, None
+    angle = _parse_numbers(l[0])[0].item()
+    v_lines = _parse_numbers(l[1])
+    assert len(v_lines)%2 == 0, (file_txt, len(v_lines))
+    h_lines = _parse_numbers(l[2])
+    assert len(h_lines)%3 == 0, (file_txt, len(h_lines))
+    cell_lines = [ln for ln in l[3:] if ln.strip()]
+    cell_tokens = [ln.split() for ln in cell_lines]
+    for ln in cell_tokens:
+        assert len(ln) == 8, (file_txt, ln)
+    cells = np.array(cell_tokens, dtype=np.int64).reshape(-1, 8)
+    assert ((cells[:, 2:] == 0) | (cells[:, 2:] == 1)).all(), file_txt
+    assert ((cells[:, 0] >= 1) & (cells[:, 0] <= len(h_lines)//3)).all(), (file_txt, 'row out of range')
+    assert ((cells[:, 1] >= 1) & (cells[:, 1] <= len(v_lines)//2)).all(), (file_txt, 'col out of range')
+    return angle, h_lines, v_lines, cells
+
+
+def _cell_coords(h_lines, v_lines, cells):
+    """
+    :return: left, top, right, bottom arrays of cells
+    """
+    rows, cols = cells[:, 0], cells[:, 1]
+    return v_lines[(cols-1)*2], h_lines[(rows-1)*3], v_lines[(cols-1)*2+1], h_lines[(rows-1)*3+2]
+
+
 def read_txt(file_txt, binary_label = True):
     """
     Loads Braille annotation from DSBI annotation txt file
@@ -25,38 +78,45 @@ def read_txt(file_txt, binary_label = True):
     )
     None, None, None, None for empty annotation
     """
-    with open(file_txt, 'r') as f:
-        l = f.readlines()
-        if len(l) < 3:
-            return None, None, None, None
-        angle = eval(l[0])
-        v_lines = list(map(eval, l[1].split(' ')))
-        assert len(v_lines)%2 == 0, (file_txt, len(v_lines))
-        h_lines = list(map(eval, l[2].split(' ')))
-        assert len(h_lines)%3 == 0, (file_txt, len(h_lines))
-        cells = []
-        for cell_ln in l[3:]:
-            cell_nums = list(cell_ln[:-1].split(' ')) # exclude last '\n'
-            assert len(cell_nums) == 8, (file_txt, cell_ln)
-            row = eval(cell_nums[0])
-            col = eval(cell_nums[1])
-            if binary_label:
-                label = ''.join(cell_nums[2:])
-            else:
-                label = ''
-                for i, c in enumerate(cell_nums[2:]):
-                    if c == '1':
-                        label += str(i+1)
-                    else:
-                        assert c == '0', (file_txt, cell_ln, i, c)
-            left = v_lines[(col-1)*2]
-            right = v_lines[(col-1)*2+1]
-            top = h_lines[(row-1)*3]
-            bottom = h_lines[(row-1)*3+2]
-            cells.append(CellInfo(row=row, col=col,
-                                  left=left, top=top, right=right, bottom=bottom,
-                                  label=label))
-    return angle, h_lines, v_lines, cells
+    angle, h_lines, v_lines, cells_array = read_arrays(file_txt)
+    if cells_array is None:
+        return None, None, None, None
+    cells = []
+    for (row, col, *dots), left, top, right, bottom in zip(cells_array.tolist(),
+                                                           *(c.tolist() for c in _cell_coords(h_lines, v_lines, cells_array))):
+        if binary_label:
+            label = ''.join(str(d) for d in dots)
+        else:
+            label = ''.join(str(i+1) for i, d in enumerate(dots) if d)
+        cells.append(CellInfo(row=row, col=col,
+                              left=left, top=top, right=right, bottom=bottom,
+                              label=label))
+    return angle, h_lines.tolist(), v_lines.tolist(), cells
+
+
+def read_DSBI_annotation_array(label_filename, width, height, rect_margin, get_points):
+    """
+    Same as read_DSBI_annotation, but returns float64 array (N, 5) of rects
+    """
+    _, h_lines, v_lines, cells = read_arrays(label_filename)
+    if cells is None or not len(cells):
+        return np.zeros((0, 5), dtype=np.float64)
+    left, top, right, bottom = _cell_coords(h_lines, v_lines, cells)
+    dots = cells[:, 2:]
+    if get_points:
+        w = np.trunc((right - left) * rect_margin)
+        cell_idx, dot_idx = np.nonzero(dots)  # symbol by symbol, dots in order
+        xc = np.where(dot_idx < 3, left[cell_idx], right[cell_idx])
+        iy = dot_idx % 3
+        yc = np.choose(iy, [top[cell_idx], ((top + bottom) // 2)[cell_idx], bottom[cell_idx]])
+        w = w[cell_idx]
+        return np.stack([(xc - w) / width, (yc - w) / height, (xc + w) / width, (yc + w) / height,
+                         np.zeros_like(w, dtype=np.float64)], axis=1).astype(np.float64)
+    labels = dots @ np.array([1, 2, 4, 8, 16, 32])
+    margin = rect_margin * (right - left)
+    rects = np.stack([(left - margin) / width, (top - margin) / height, (right + margin) / width, (bottom + margin) / height,
+                      labels], axis=1).astype(np.float64)
+    return rects[labels != 0]
 
 
 def read_DSBI_annotation(label_filename, width, height, rect_margin, get_points):
@@ -74,38 +134,5 @@ def read_DSBI_annotation(label_filename, width, height, rect_margin, get_points)
         List of points rects if get_points==True. Each point is a tuple (left, top, right, bottom, label) where
         left..bottom are in [0,1], label is 0. Width and height of point is 2*rect_margin*width of symbol
     """
-    _, _, _, cells = read_txt(label_filename, binary_label=True)
-    if cells is not None:
-        if get_points:
-            rects = []
-            for cl in cells:
-                w = int((cl.right - cl.left) * rect_margin)
-                h = w
-                for i in range(6):
-                    if cl.label[i] == '1':
-                        iy = i % 3
-                        ix = i - iy
-                        if ix == 0:
-                            xc = cl.left
-                        else:
-                            xc = cl.right
-                        left, right = xc - w, xc + w
-                        if iy == 0:
-                            yc = cl.top
-                        elif iy == 1:
-                            yc = (cl.top + cl.bottom) // 2
-                        else:
-                            yc = cl.bottom
-                        top, bottom = yc - h, yc + h
-                        rects.append([left / width, top / height, right / width, bottom / height, 0])
-        else:
-            rects = [(
-                (c.left - rect_margin * (c.right - c.left)) / width,
-                (c.top - rect_margin * (c.right - c.left)) / height,
-                (c.right + rect_margin * (c.right - c.left)) / width,
-                (c.bottom + rect_margin * (c.right - c.left)) / height,
-                lt.label010_to_int(c.label),
-                ) for c in cells if c.label != '000000']
-    else:
-        rects = []
-    return rects
\ No newline at end of file
+    rects = read_DSBI_annotation_array(label_filename, width, height, rect_margin, get_points)
+    return [tuple(r[:4]) + (int(r[4]),) for r in rects.tolist()]
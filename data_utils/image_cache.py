@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# coding: utf-8
+'''
+Byte budgeted LRU cache of images (numpy arrays) for datasets.
+
+Arrays evicted from memory can be spilled to uint8 memory-mapped files in a local dir (byte budgeted and LRU too):
+reading an image back is much cheaper than decoding or augmenting it again.
+Arrays can also be shared by processes (i.e. DataLoader workers) through a dir of memory-mapped .npy files,
+preferably in shared memory (/dev/shm), so every image is decoded and stored once for all workers.
+'''
+import hashlib
+import os
+import shutil
+import tempfile
+import uuid
+import weakref
+from collections import OrderedDict
+import numpy as np
+
+
+class LruArrayCache:
+    '''
+    LRU cache: key -> (array, payload). Size is counted by array.nbytes, payload (i.e. boxes of the image)
+    is kept along with the array.
+    '''
+    def __init__(self, max_bytes=None, spill_dir=None, spill_max_bytes=None, shared_dir=None):
+        '''
+        :param max_bytes: memory budget, unlimited if None
+        :param spill_dir: dir for arrays evicted from memory, nothing is spilled if None. Cache spills into its own
+            temporary subdir of it, removed when the cache is closed or garbage collected or the process exits.
+            Copies of the cache in DataLoader workers spill into the same subdir.
+        :param spill_max_bytes: budget of spilled arrays, unlimited if None
+        :param shared_dir: dir shared by processes. Every array put is written there once
+            and is read (memory-mapped, read only) by any process that doesn't have it in memory. Not budgeted.
+            Keys must be the same for all processes and change when array content changes.
+            Payload is not shared, so it must be None.
+        '''
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = spill_max_bytes
+        self.shared_dir = shared_dir
+        self.items = OrderedDict()  # key -> (array, payload), least recently used first
+        self.nbytes = 0
+        self.spilled = OrderedDict()  # key -> (file path, dtype, shape, payload), least recently used first
+        self.spill_nbytes = 0
+        self.hits = 0
+        self.spill_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._finalizer = None
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+            self.spill_dir = tempfile.mkdtemp(prefix='spill.', dir=spill_dir)
+            self._finalizer = weakref.finalize(self, shutil.rmtree, self.spill_dir, ignore_errors=True)
+        if shared_dir is not None:
+            os.makedirs(shared_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self.items) + len(self.spilled)
+
+    def __contains__(self, key):
+        return key in self.items or key in self.spilled
+
+    def get(self, key):
+        '''
+        :return: (array, payload) or None if key is not cached
+        '''
+        if key in self.items:
+            self.items.move_to_end(key)
+            self.hits += 1
+            return self.items[key]
+        if key in self.spilled:
+            path, dtype, shape, payload = self.spilled[key]
+            array = np.array(np.memmap(path, dtype=np.uint8, mode='r')).view(dtype).reshape(shape)
+            self.discard(key)
+            self.spill_hits += 1
+            self.put(key, array, payload)
+            return array, payload
+        if self.shared_dir is not None:
+            path = self._shared_path(key)
+            if os.path.isfile(path):
+                self.shared_hits += 1
+                return np.load(path, mmap_mode='r'), None
+        self.misses += 1
+        return None
+
+    def put(self, key, array, payload=None):
+        self.discard(key)
+        if self.shared_dir is not None:
+            if payload is not None:
+                raise ValueError("payload can't be stored in shared dir")
+            self._share(key, array)
+        if self.max_bytes is not None and array.nbytes > self.max_bytes:
+            self._spill(key, array, payload)
+            return
+        self.items[key] = (array, payload)
+        self.nbytes += array.nbytes
+        while self.max_bytes is not None and self.nbytes > self.max_bytes:
+            old_key, (old_array, old_payload) = self.items.popitem(last=False)
+            self.nbytes -= old_array.nbytes
+            self.evictions += 1
+            self._spill(old_key, old_array, old_payload)
+
+    def discard(self, key):
+        if key in self.items:
+            array, _ = self.items.pop(key)
+            self.nbytes -= array.nbytes
+        if key in self.spilled:
+            path, dtype, shape, _ = self.spilled.pop(key)
+            self.spill_nbytes -= np.dtype(dtype).itemsize * int(np.prod(shape))
+            os.remove(path)
+
+    def _shared_path(self, key):
+        return os.path.join(self.shared_dir, hashlib.md5(repr(key).encode('utf-8')).hexdigest() + '.npy')
+
+    def _share(self, key, array):
+        path = self._shared_path(key)
+        if os.path.isfile(path):
+            return
+        tmp_path = os.path.join(self.shared_dir, '.tmp.' + uuid.uuid4().hex + '.npy')
+        np.save(tmp_path, array)
+        os.replace(tmp_path, path)  # other processes never see partial file
+
+    def _spill(self, key, array, payload):
+        if self.spill_dir is None or array.nbytes == 0:
+            return
+        if self.spill_max_bytes is not None and array.nbytes > self.spill_max_bytes:
+            return
+        path = os.path.join(self.spill_dir, uuid.uuid4().hex + '.u8')
+        mm = np.memmap(path, dtype=np.uint8, mode='w+', shape=(array.nbytes,))
+        mm[:] = np.ascontiguousarray(array).reshape(-1).view(np.uint8)
+        mm.flush()
+        del mm
+        self.spilled[key] = (path, array.dtype.str, array.shape, payload)
+        self.spill_nbytes += array.nbytes
+        while self.spill_max_bytes is not None and self.spill_nbytes > self.spill_max_bytes:
+            self.discard(next(iter(self.spilled)))
+
+    def clear(self):
+        for key in list(self.spilled):
+            self.discard(key)
+        self.items.clear()
+        self.nbytes = 0
+
+    def close(self):
+        '''
+        Clears the cache and removes its spill subdir
+        '''
+        self.clear()
+        if self._finalizer is not None:
+            self._finalizer()
+
+    def counters(self):
+        '''
+        :return: list of values of STATS_COUNTERS
+        '''
+        return [self.hits, self.spill_hits, self.shared_hits, self.misses, self.evictions,
+                len(self.items), self.nbytes, len(self.spilled), self.spill_nbytes]
+
+    def stats(self):
+        '''
+        :return: dict of counters, hit_rate counts memory, spill and shared dir hits
+        '''
+        return stats_from_counters(self.counters())
+
+
+STATS_COUNTERS = ('hits', 'spill_hits', 'shared_hits', 'misses', 'evictions',
+                  'items', 'bytes', 'spilled_items', 'spilled_bytes')
+
+
+def stats_from_counters(counters):
+    '''
+    :param counters: values of STATS_COUNTERS (see LruArrayCache.counters), possibly summed over caches of
+        several processes
+    :return: stats dict (see LruArrayCache.stats)
+    '''
+    res = dict(zip(STATS_COUNTERS, counters))
+    hits = res['hits'] + res['spill_hits'] + res['shared_hits']
+    requests = hits + res['misses']
+    res['hit_rate'] = hits / requests if requests else 0.
+    return res
+
+
+def create_cache(params, name, shareable=False):
+    '''
+    Creates cache configured by params.data:
+        <name>_cache_bytes: memory budget, unlimited if not set
+        cache_spill_dir: dir to spill evicted arrays to, no spilling if not set
+        <name>_cache_spill_bytes: budget of spilled arrays, unlimited if not set
+        <name>_cache_shared_dir: dir shared by DataLoader workers. If set, memory budget is 0 by default,
+            i.e. arrays are kept only in the shared dir
+    :param shareable: if the cache can use shared dir, i.e. its keys are stable across processes and runs
+        and it keeps no payload
+    '''
+    spill_dir = params.data.get('cache_spill_dir', None)
+    if spill_dir is not None:
+        spill_dir = os.path.join(spill_dir, name)
+    shared_dir = params.data.get(name + '_cache_shared_dir', None)
+    if shared_dir is not None and not shareable:
+        raise ValueError("{}_cache_shared_dir is not supported".format(name))
+    return LruArrayCache(max_bytes=params.data.get(name + '_cache_bytes', None if shared_dir is None else 0),
+                         spill_dir=spill_dir, spill_max_bytes=params.data.get(name + '_cache_spill_bytes', None),
+                         shared_dir=shared_dir)
+
+
+if __name__ == '__main__':
+    import tempfile
+    images = [np.full((10, 10, 3), i, dtype=np.uint8) for i in range(10)]  # 300 bytes each
+
+    cache = LruArrayCache(max_bytes=1000)
+    for i, img in enumerate(images[:4]):
+        cache.put(i, img, payload=[i])
+    assert cache.get(0) is None and cache.nbytes == 900  # the oldest one is evicted
+    assert cache.get(1)[1] == [1]
+    cache.put(4, images[4])
+    assert 1 in cache and 2 not in cache  # 1 was used recently, 2 is evicted
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache = LruArrayCache(max_bytes=600, spill_dir=tmp_dir, spill_max_bytes=900)
+        for i, img in enumerate(images[:6]):
+            cache.put(i, img, payload=[i])
+        assert len(cache.items) == 2 and len(cache.spilled) == 3 and len(os.listdir(cache.spill_dir)) == 3
+        assert 0 not in cache  # spill budget exceeded
+        img, payload = cache.get(2)  # read back from spill file and moved to memory
+        assert (img == images[2]).all() and payload == [2] and img.flags.writeable
+        assert cache.stats()['spill_hits'] == 1 and 2 in cache.items and 4 in cache.spilled
+        cache.put(6, np.arange(200, dtype=np.int32).reshape(10, 20))  # larger than memory budget
+        assert 6 in cache.spilled and (cache.get(6)[0] == np.arange(200).reshape(10, 20)).all()
+        cache.clear()
+        assert not os.listdir(cache.spill_dir) and len(cache) == 0
+        cache.put(7, images[7]); cache.put(8, images[8]); cache.put(9, images[9])
+        assert len(os.listdir(cache.spill_dir)) == 1
+        del cache  # spill subdir is removed with the cache
+        assert not os.listdir(tmp_dir)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache = LruArrayCache(max_bytes=0, shared_dir=tmp_dir)
+        cache.put('a', images[1])
+        other_process_cache = LruArrayCache(max_bytes=0, shared_dir=tmp_dir)
+        img, payload = other_process_cache.get('a')
+        assert (img == images[1]).all() and payload is None and not img.flags.writeable
+        assert other_process_cache.get('b') is None and other_process_cache.stats()['hit_rate'] == 0.5
+        try:
+            cache.put('c', images[2], payload=[2])
+            assert False, 'payload must be rejected'
+        except ValueError:
+            pass
+    print('OK')
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# coding: utf-8
+'''
+Packs a dataset (list file of images with DSBI or LabelMe annotation) into a few large shard files,
+so training reads memory-mapped arrays instead of thousands of image and annotation files.
+
+Pack is a JSON manifest (*.pack) and shards (result records, see braille_utils.result_record) next to it.
+Shard fields:
+    'image.<i>' - uint8 image HxWx3, resized to pack width (if wider) and converted by data.unify_shape
+    'image_files' - source image filenames
+    'rect_offsets' - rects of i-th image are rects[rect_offsets[i]: rect_offsets[i+1]]
+    'rects' - float64 (N, 4): left, top, right, bottom in [0, 1] as read from annotation
+    'labels' - int64 (N,)
+Pack can be used in params.data lists instead of list file (see data.BrailleSubDataset).
+
+Usage: python -m data_utils.pack_dataset <list file> <pack file> --width <max of augmentation.img_width_range>
+'''
+import json
+import os
+import sys
+import types
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import local_config
+from braille_utils import result_record
+
+PACK_SUFFIX = '.pack'
+PACK_VERSION = 1
+
+
+class PackedDataset:
+    '''
+    Read access to images and annotations of a pack. Images are memory-mapped (read only).
+    '''
+    def __init__(self, pack_fn):
+        with open(pack_fn, encoding='utf-8') as f:
+            self.manifest = json.load(f)
+        if self.manifest.get('version', 0) > PACK_VERSION:
+            raise ValueError("unsupported pack version {}: {}".format(self.manifest.get('version'), pack_fn))
+        pack_dir = os.path.dirname(pack_fn)
+        self.items = []  # (shard, index in shard, shard index)
+        self.image_files = []
+        self.annotations = []  # (rect_offsets, rects, labels) of shards
+        for shard_idx, shard_fn in enumerate(self.manifest['shards']):
+            shard = result_record.ResultRecord(os.path.join(pack_dir, shard_fn))
+            image_files = shard['image_files']
+            self.items += [(shard, i, shard_idx) for i in range(len(image_files))]
+            self.image_files += image_files
+            self.annotations.append((np.array(shard['rect_offsets']), np.array(shard['rects']), np.array(shard['labels'])))
+
+    def __len__(self):
+        return len(self.items)
+
+    def check_params(self, params):
+        '''
+        Checks that pack was made with the same annotation settings as params.data
+        '''
+        for key, default in (('rect_margin', 0.3), ('get_points', False)):
+            if self.manifest[key] != params.data.get(key, default):
+                raise ValueError("pack was made with {}={}, params have {}".format(
+                    key, self.manifest[key], params.data.get(key, default)))
+        max_width = max(params.augmentation.img_width_range)
+        if max_width > self.manifest['width']:
+            print("WARNING: pack images are {} wide, less than augmentation width {}".format(
+                self.manifest['width'], max_width))
+
+    def image(self, item):
+        shard, i, _ = self.items[item]
+        return shard['image.{}'.format(i)]
+
+    def rects(self, item):
+        '''
+        :return: list of (left, top, right, bottom, label) as data.read_annotation returns
+        '''
+        _, i, shard_idx = self.items[item]
+        rect_offsets, rects, labels = self.annotations[shard_idx]
+        begin, end = rect_offsets[i], rect_offsets[i + 1]
+        return [tuple(r) + (int(lbl),) for r, lbl in zip(rects[begin:end].tolist(), labels[begin:end].tolist())]
+
+
+def pack_dataset(list_file, pack_fn, width, rect_margin=0.3, get_points=False, shard_bytes=1 << 30, verbose=1):
+    '''
+    :param list_file: full path of list file
+    :param pack_fn: full path of pack manifest to write (*.pack), shards are written next to it
+    :param width: images wider than it are resized to it
+    :param shard_bytes: approximate size of a shard
+    '''
+    import cv2
+    import PIL.Image
+    from data_utils import data
+
+    assert pack_fn.endswith(PACK_SUFFIX), pack_fn
+    params = types.SimpleNamespace(data=dict(rect_margin=rect_margin, get_points=get_points))
+    image_files, label_files = data.read_list_file(list_file)
+    stem = os.path.basename(pack_fn)[:-len(PACK_SUFFIX)]
+    shards = []
+    fields = dict()
+    shard_files = []
+    rect_offsets = [0]
+    rects = []
+    labels = []
+    shard_size = 0
+
+    def write_shard():
+        shard_fn = '{}.{:05}{}'.format(stem, len(shards), result_record.RECORD_SUFFIX)
+        fields.update({
+            'image_files': shard_files,
+            'rect_offsets': np.array(rect_offsets, dtype=np.int64),
+            'rects': np.array(rects, dtype=np.float64).reshape(-1, 4),
+            'labels': np.array(labels, dtype=np.int64),
+        })
+        result_record.write_record(os.path.join(os.path.dirname(pack_fn), shard_fn), fields)
+        shards.append(shard_fn)
+        if verbose:
+            print('{}: {} images'.format(shard_fn, len(shard_files)))
+
+    for img_fn, lbl_fn in zip(image_files, label_files):
+        img = data.unify_shape(np.asarray(PIL.Image.open(img_fn)))
+        height, img_width = img.shape[:2]
+        item_rects = data.read_annotation(lbl_fn, img_width, height, params)
+        if img_width > width:
+            img = cv2.resize(img, (width, int(round(height * width / img_width))), interpolation=cv2.INTER_AREA)
+        fields['image.{}'.format(len(shard_files))] = np.ascontiguousarray(img)
+        shard_files.append(img_fn)
+        rects += [r[:4] for r in item_rects]
+        labels += [r[4] for r in item_rects]
+        rect_offsets.append(len(rects))
+        shard_size += img.nbytes
+        if shard_size >= shard_bytes:
+            write_shard()
+            fields = dict()
+            shard_files = []
+            rect_offsets = [0]
+            rects = []
+            labels = []
+            shard_size = 0
+    if shard_files or not shards:
+        write_shard()
+    with open(pack_fn, 'w', encoding='utf-8') as f:
+        json.dump({'version': PACK_VERSION, 'source': list_file, 'width': width, 'rect_margin': rect_margin,
+                   'get_points': get_points, 'count': len(image_files), 'shards': shards}, f, indent=4)
+    return pack_fn
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Packs dataset list file into memory-mappable shards')
+    parser.add_argument('list_file', type=str, help='list file, relative to local_config.data_path')
+    parser.add_argument('pack_file', type=str, help='pack file (*.pack) to write, relative to local_config.data_path')
+    parser.add_argument('--width', type=int, required=True, help='max of augmentation.img_width_range of training')
+    parser.add_argument('--rect-margin', type=float, default=0.3, help='params.data.rect_margin')
+    parser.add_argument('--get-points', action='store_true', help='params.data.get_points')
+    parser.add_argument('--shard-mb', type=int, default=1024, help='approximate size of a shard, MB')
+    args = parser.parse_args()
+    pack_dataset(os.path.join(local_config.data_path, args.list_file), os.path.join(local_config.data_path, args.pack_file),
+                 args.width, rect_margin=args.rect_margin, get_points=args.get_points, shard_bytes=args.shard_mb << 20)
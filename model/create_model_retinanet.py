@@ -9,6 +9,27 @@ from pytorch_retinanet.encoder import DataEncoder
 import local_config
 from braille_utils import label_tools
 
+# int label -> classes of 6 dots (class_as_6pt mode): 0 if dot is present, -1 (no class) otherwise
+LABEL_TO_DOTS = torch.tensor([[int(ch)-1 for ch in label_tools.int_to_label010(int_lbl)] for int_lbl in range(64)],
+                             dtype=torch.long)
+
+
+def cache_anchor_boxes(encoder):
+    '''
+    DataEncoder builds anchor grid for every encoded or decoded image, but the grid depends on input size only.
+    Makes the encoder build it once per input size.
+    '''
+    get_anchor_boxes = encoder._get_anchor_boxes
+    anchor_boxes = dict()  # input size -> anchor grid
+    def cached_get_anchor_boxes(input_size):
+        key = tuple(input_size.tolist()) if torch.is_tensor(input_size) else tuple(input_size)
+        if key not in anchor_boxes:
+            anchor_boxes[key] = get_anchor_boxes(input_size)
+        return anchor_boxes[key]
+    encoder._get_anchor_boxes = cached_get_anchor_boxes
+    return encoder
+
+
 def create_model_retinanet(params, device):
     '''
     Creates model and auxiliary functions
@@ -18,12 +39,16 @@ def create_model_retinanet(params, device):
     '''
     use_multiple_class_groups = params.data.get('class_as_6pt', False)
     num_classes = 1 if params.data.get_points else ([1]*6 if use_multiple_class_groups else 64)
-    encoder = DataEncoder(**params.model_params.encoder_params)
+    encoder = cache_anchor_boxes(DataEncoder(**params.model_params.encoder_params))
     model = RetinaNet(num_layers=encoder.num_layers(), num_anchors=encoder.num_anchors(),
                       num_classes=num_classes,
                       num_fpn_layers=params.model_params.get('num_fpn_layers', 0)).to(device)
     retina_loss = FocalLoss(num_classes=num_classes, **params.model_params.get('loss_params', dict()))
-
+    # collate (and so target encoding) is run by DataLoader workers (see data.create_dataloader) if any.
+    # They can't use CUDA, batch is moved to device by trainer then
+    collate_device = 'cpu' if params.data.get('num_workers', 0) else device
+    label_to_dots = LABEL_TO_DOTS.to(collate_device)
+    boxes_scale = torch.tensor(params.data.net_hw[::-1]*2, dtype = torch.float32, device=collate_device)
 
     def detection_collate(batch):
         '''
@@ -37,16 +62,19 @@ def create_model_retinanet(params, device):
         #     pass
 
         #device = torch.device('cpu')  # commented to use settings.device
+        device = collate_device
 
-        boxes = [torch.tensor(b[1][:, :4], dtype = torch.float32, device=device)
-                 *torch.tensor(params.data.net_hw[::-1]*2, dtype = torch.float32, device=device) for b in batch]
-        labels = [torch.tensor(b[1][:, 4], dtype = torch.long, device=device) for b in batch]
+        # rects of all images are converted at once, then split by images
+        rects_counts = [len(b[1]) for b in batch]
+        rects = torch.tensor(np.concatenate([np.asarray(b[1]).reshape(-1, 5) for b in batch]), device=device)
+        boxes = torch.split(rects[:, :4].float() * boxes_scale, rects_counts)
+        all_labels = rects[:, 4].long()
         if params.data.get_points:
-            labels = [torch.tensor([0]*len(lb), dtype = torch.long, device=device) for lb in labels]
+            all_labels = torch.zeros_like(all_labels)
         elif use_multiple_class_groups:
             # classes are numbered from 0, no class = -1, then в encode cls_targets=1+labels
-            labels = [torch.tensor([[int(ch)-1 for ch in label_tools.int_to_label010(int_lbl.item())] for int_lbl in lb],
-                                   dtype=torch.long, device=device) for lb in labels]
+            all_labels = label_to_dots[all_labels]
+        labels = torch.split(all_labels, rects_counts)
 
         original_images = [b[3] for b in batch if len(b)>3] # batch contains augmented image if not in train mode
 
@@ -57,16 +85,12 @@ def create_model_retinanet(params, device):
 
         h, w = tuple(params.data.net_hw)
         num_imgs = len(batch)
-        inputs = torch.zeros(num_imgs, 3, h, w).to(imgs[0])
+        inputs = torch.stack(imgs)
 
         loc_targets = []
         cls_targets = []
         for i in range(num_imgs):
-            inputs[i] = imgs[i]
-            labels_i = labels[i]
-            if use_multiple_class_groups and len(labels_i.shape) != 2:  # it can happen if no labels are on image
-                labels_i = labels_i.reshape((0, len(num_classes)))
-            loc_target, cls_target, max_ious = encoder.encode(boxes[i], labels_i, input_size=(w,h))
+            loc_target, cls_target, max_ious = encoder.encode(boxes[i], labels[i], input_size=(w,h))
             loc_targets.append(loc_target)
             cls_targets.append(cls_target)
         if original_images: # inference mode
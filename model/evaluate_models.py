@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Concurrent evaluation of many checkpoints (validate_retinanet.models) on validate_retinanet.datasets.
+
+Every image is read and resized to network input only once: preprocessed images are stored as result records
+in a cache dir and memory-mapped by worker processes, so their pages are shared between workers by OS.
+Checkpoints are evaluated by a pool of worker processes. Output is the same as validate_retinanet.main(True).
+"""
+
+cache_dir = 'NN_results/inputs_cache'  # relative to local_config.data_path
+workers = 2  # number of checkpoints evaluated concurrently
+devices = None  # devices assigned to checkpoints in turn, i.e. ['cuda:0', 'cuda:1']. infer_retinanet.device if None
+
+do_filter_lonely_rects = False
+metrics_for_lines = True
+
+import hashlib
+import multiprocessing
+import os
+import sys
+from collections import Counter
+from pathlib import Path
+import numpy as np
+import PIL.Image
+import torch
+sys.path.append(r'../..')
+sys.path.append('../NN/RetinaNet')
+import local_config
+from ovotools.params import AttrDict
+import braille_utils.postprocess as postprocess
+import braille_utils.result_record as result_record
+import model.infer_retinanet as infer_retinanet
+import model.validate_retinanet as validate_retinanet
+
+
+def cache_inputs(data_set, params_fn):
+    """
+    Preprocesses images not cached yet. Inference preprocessing depends only on inference width,
+    so the cache is shared by all models.
+    :param data_set: dict key -> data_list (see validate_retinanet.prepare_data)
+    :param params_fn: param file of any of the models
+    :return: dict key -> list of (record path, gt_text)
+    """
+    inputs_dir = Path(local_config.data_path) / cache_dir / 'w{}'.format(validate_retinanet.inference_width)
+    os.makedirs(inputs_dir, exist_ok=True)
+    preprocessor = None
+    res = dict()
+    for key, data_list in data_set.items():
+        res[key] = []
+        for gt_dict in data_list:
+            img_fn = Path(gt_dict['image_fn']).resolve()
+            # gt rects are stored in the record, so the key covers annotation too
+            item_key = validate_retinanet.data_item_key(gt_dict)
+            record_path = inputs_dir / (hashlib.md5(item_key.encode('utf-8')).hexdigest() + result_record.RECORD_SUFFIX)
+            res[key].append((record_path, gt_dict['gt_text']))
+            if record_path.is_file():
+                continue
+            if preprocessor is None:
+                preprocessor = infer_retinanet.inference_preprocessor(AttrDict.load(params_fn, verbose=0),
+                                                                      validate_retinanet.inference_width)
+            aug_img, aug_gt_rects = infer_retinanet.preprocess_image(preprocessor, PIL.Image.open(img_fn),
+                                                                     gt_dict['gt_rects'])
+            result_record.write_record(record_path, {
+                'image_fn': str(img_fn),
+                'image': aug_img,
+                'gt_rects': [list(r) for r in aug_gt_rects],
+            })
+    return res
+
+
+def _init_worker(n_threads):
+    torch.set_num_threads(n_threads)
+
+
+def evaluate_checkpoint(model_root, model_weights, device, inputs):
+    """
+    Same as validate_retinanet.validate_model for every dataset, using cached preprocessed images
+    :param inputs: cache_inputs result
+    :return: list of (key, validate_model result)
+    """
+    recognizer = infer_retinanet.BrailleInference(
+        params_fn=validate_retinanet.model_params_fn(model_root),
+        model_weights_fn=os.path.join(local_config.data_path, model_root, model_weights),
+        create_script=None,
+        inference_width=validate_retinanet.inference_width,
+        device=device,
+        verbose=validate_retinanet.verbose)
+    res = []
+    for key, items in inputs.items():
+        counts = Counter()
+        for record_path, gt_text in items:
+            rec = result_record.ResultRecord(record_path)
+            res_dict = recognizer.run_impl(np.array(rec['image']),
+                                           lang=validate_retinanet.lang,
+                                           draw_refined=infer_retinanet.BrailleInference.DRAW_NONE,
+                                           find_orientation=False,
+                                           process_2_sides=False,
+                                           align=False,
+                                           draw=True,
+                                           gt_rects=rec['gt_rects'],
+                                           preprocessed=True)
+            lines = res_dict['lines']
+            if do_filter_lonely_rects:
+                lines, _ = postprocess.filter_lonely_rects_for_lines(lines)
+            counts.update(validate_retinanet.page_metric_counts(
+                lines, boxes=res_dict['boxes'], labels=res_dict['labels'], gt_text=gt_text,
+                gt_rects=res_dict['gt_rects'],
+                image_wh=(res_dict['labeled_image'].width, res_dict['labeled_image'].height),
+                img=res_dict['labeled_image'], do_filter_lonely_rects=do_filter_lonely_rects,
+                metrics_for_lines=metrics_for_lines))
+        res.append((key, validate_retinanet.metrics_from_counts(counts, len(items))))
+    return res
+
+
+def _evaluate_task(task):
+    model_root, model_weights, device, inputs = task
+    return model_root, model_weights, evaluate_checkpoint(model_root, model_weights, device, inputs)
+
+
+def main():
+    models = validate_retinanet.models
+    data_set = validate_retinanet.prepare_data()
+    inputs = cache_inputs(data_set, validate_retinanet.model_params_fn(models[0][0]))
+    model_devices = devices or [infer_retinanet.device]
+    tasks = [(model_root, model_weights, model_devices[i % len(model_devices)], inputs)
+             for i, (model_root, model_weights) in enumerate(models)]
+    # CUDA can't be used in forked processes
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(workers, initializer=_init_worker, initargs=(max(1, os.cpu_count() // workers),)) as pool:
+        print(validate_retinanet.TABLE_HEADER)
+        prev_model_root = None
+        for model_root, model_weights, results in pool.imap(_evaluate_task, tasks):
+            if model_root != prev_model_root:
+                print()
+                prev_model_root = model_root
+            for key, res in results:
+                print(validate_retinanet.table_row(model_root, model_weights, key, res))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # coding: utf-8
 import enum
+import hashlib
 try:
     import fitz
 except:
@@ -26,10 +27,12 @@ import zipfile
 import data_utils.data as data
 import braille_utils.letters as letters
 import braille_utils.label_tools as lt
+import braille_utils.result_record as result_record
 from model import create_model_retinanet
 import pytorch_retinanet
 import pytorch_retinanet.encoder
 import braille_utils.postprocess as postprocess
+import braille_utils.spell_correction as spell_correction
 
 inference_width = 1024
 model_weights = 'model.t7'
@@ -39,6 +42,8 @@ device = 'cuda:0'
 #device = 'cpu'
 cls_thresh = 0.3
 nms_thresh = 0.02
+RAW_SCORE_FLOOR = 0.1  # anchors with all class scores below it are not kept in raw detections. Detections can be
+                       # re-decoded from raw ones only with cls_thresh >= RAW_SCORE_FLOOR
 REFINE_COEFFS = [0.083, 0.092, -0.083, -0.013]  # Coefficients (in units of h symbol) for empirical correction
                         # the resulting dimensions to correct the inaccuracy of the results for subsequent markup
 
@@ -53,6 +58,21 @@ class OrientationAttempts(enum.IntEnum):
     INV_ROT270 = 7
 
 
+def dense_preds(index, preds, num_anchors):
+    '''
+    Inverse of BraileInferenceImpl.sparse_preds: anchors not kept get zero scores
+    :param index, preds: saved raw detections (see BrailleInference.raw_detections_dict)
+    :return: loc_pred, cls_pred
+    '''
+    index = torch.from_numpy(np.array(index, dtype=np.int64))
+    preds = torch.from_numpy(np.array(preds))
+    loc_pred = torch.zeros((num_anchors, 4), dtype=preds.dtype)
+    cls_pred = torch.full((num_anchors, preds.shape[1] - 4), -1e4, dtype=preds.dtype)  # sigmoid -> 0
+    loc_pred[index] = preds[:, :4]
+    cls_pred[index] = preds[:, 4:]
+    return loc_pred, cls_pred
+
+
 class BraileInferenceImpl(torch.nn.Module):
     def __init__(self, params, model, device, label_is_valid, verbose=1):
         super(BraileInferenceImpl, self).__init__()
@@ -94,6 +114,23 @@ class BraileInferenceImpl(torch.nn.Module):
         best_idx = torch.argmin(err_score/(sum_valid+1)) # эвристика так себе придуманная
         return best_idx.item(), (err_score, sum_valid, sum_invalid)
 
+    def decode(self, loc_pred, cls_pred, w: int, h: int, cls_thresh: float, nms_thresh: float):
+        boxes, labels, scores = self.encoder.decode(loc_pred, cls_pred, (w,h),
+                                                    cls_thresh = cls_thresh, nms_thresh = nms_thresh,
+                                                    num_classes=self.num_classes)
+        if len(self.num_classes) > 1:
+            labels = torch.tensor([lt.label010_to_int([str(s.item()+1) for s in lbl101]) for lbl101 in labels])
+        return boxes, labels, scores
+
+    def sparse_preds(self, loc_pred, cls_pred):
+        '''
+        Keeps only anchors that can produce a detection with cls_thresh >= RAW_SCORE_FLOOR
+        :return: anchors indexes, [loc_pred, cls_pred] of these anchors
+        '''
+        keep = cls_pred.sigmoid().max(1)[0] >= RAW_SCORE_FLOOR
+        index = keep.nonzero().view(-1)
+        return index, torch.cat([loc_pred[index], cls_pred[index]], dim=1)
+
     def forward(self, input_tensor, input_tensor_rotated, find_orientation, process_2_sides):
         t = timeit.default_timer()
         orientation_attempts = [OrientationAttempts.NONE]
@@ -143,23 +180,71 @@ class BraileInferenceImpl(torch.nn.Module):
             print("        forward.calc_letter_statistics", timeit.default_timer() - t)
             t = timeit.default_timer()
         h,w = input_data[best_idx].shape[2:]
-        boxes, labels, scores = self.encoder.decode(loc_preds[best_idx][0].cpu().data,
-                                                    cls_preds[best_idx][0].cpu().data, (w,h),
-                                                    cls_thresh = self.cls_thresh, nms_thresh = self.nms_thresh,
-                                                    num_classes=self.num_classes)
-        if len(self.num_classes) > 1:
-            labels = torch.tensor([lt.label010_to_int([str(s.item()+1) for s in lbl101]) for lbl101 in labels])
+        loc_pred, cls_pred = loc_preds[best_idx][0].cpu().data, cls_preds[best_idx][0].cpu().data
+        boxes, labels, scores = self.decode(loc_pred, cls_pred, w, h, self.cls_thresh, self.nms_thresh)
+        raw = self.sparse_preds(loc_pred, cls_pred)
         if process_2_sides:
-            boxes2, labels2, scores2 = self.encoder.decode(loc_preds[best_idx+2][0].cpu().data,
-                                                           cls_preds[best_idx+2][0].cpu().data, (w, h),
-                                                           cls_thresh=self.cls_thresh, nms_thresh=self.nms_thresh,
-                                                           num_classes=self.num_classes)
+            loc_pred2, cls_pred2 = loc_preds[best_idx+2][0].cpu().data, cls_preds[best_idx+2][0].cpu().data
+            boxes2, labels2, scores2 = self.decode(loc_pred2, cls_pred2, w, h, self.cls_thresh, self.nms_thresh)
+            raw2 = self.sparse_preds(loc_pred2, cls_pred2)
         else:
-            boxes2, labels2, scores2 = None, None, None
+            boxes2, labels2, scores2, raw2 = None, None, None, None
         if self.verbose >= 2:
             print("        forward.decode", timeit.default_timer() - t)
             t = timeit.default_timer()
-        return boxes, labels, scores, best_idx, err_score, boxes2, labels2, scores2
+        raw_info = ((w, h), loc_pred.shape[0], raw, raw2)
+        return boxes, labels, scores, best_idx, err_score, boxes2, labels2, scores2, raw_info
+
+
+def inference_preprocessor(params, inference_width=inference_width):
+    '''
+    :param params: model params (AttrDict), modified for inference
+    :return: data.ImagePreprocessor used by BrailleInference
+    '''
+    params.data.net_hw = (inference_width,inference_width,) #(512,768) ###### (1024,1536) #
+    params.data.batch_size = 1 #######
+    params.augmentation = AttrDict(
+        img_width_range=(inference_width, inference_width),
+        stretch_limit = 0.0,
+        rotate_limit=0,
+    )
+    return data.ImagePreprocessor(params, mode = 'inference')
+
+
+def preprocess_image(preprocessor, img, gt_rects=[]):
+    '''
+    Resizes image to network input as BrailleInference.run_impl does
+    :param img: PIL image or np.array
+    :return: aug_img (np.array HxWx3), aug_gt_rects
+    '''
+    aug_img, aug_gt_rects = preprocessor.preprocess_and_augment(np.asarray(img), gt_rects)
+    return data.unify_shape(aug_img), aug_gt_rects
+
+
+class RawDetectionsDecoder:
+    '''
+    Decodes raw detections (see BrailleInference.raw_detections_dict) as BraileInferenceImpl does, but without
+    loading the network. Cheap to create, i.e. in worker processes.
+    '''
+    def __init__(self, params_fn):
+        params = AttrDict.load(params_fn, verbose=0)
+        self.encoder = pytorch_retinanet.encoder.DataEncoder(**params.model_params.encoder_params)
+        self.num_classes = [] if not params.data.get('class_as_6pt', False) else [1]*6
+
+    decode = BraileInferenceImpl.decode
+
+    def decode_raw(self, raw, index, preds, cls_thresh=cls_thresh, nms_thresh=nms_thresh):
+        '''
+        :param raw: raw detections dict (input_size, num_anchors, score_floor)
+        :param index, preds: raw detections of a page side
+        :return: boxes, labels, scores as lists
+        '''
+        if cls_thresh < raw['score_floor']:
+            raise ValueError("cls_thresh {} is below score floor {} of raw detections".format(cls_thresh, raw['score_floor']))
+        w, h = raw['input_size']
+        loc_pred, cls_pred = dense_preds(index, preds, raw['num_anchors'])
+        boxes, labels, scores = self.decode(loc_pred, cls_pred, w, h, cls_thresh, nms_thresh)
+        return boxes.tolist(), labels.tolist(), scores.tolist()
 
 
 class BrailleInference:
@@ -171,21 +256,25 @@ class BrailleInference:
     DRAW_FULL_CHARS = 4
 
     def __init__(self, params_fn=params_fn, model_weights_fn=model_weights_fn, create_script = None,
-                 verbose=1, inference_width=inference_width, device=device):
+                 verbose=1, inference_width=inference_width, device=device, correct_text=False,
+                 spell_word_list=None, perspective_alignment=False):
+        '''
+        :param correct_text: apply language post-correction (see postprocess.text_corrections) to recognized text
+        :param spell_word_list: path to a word list file. If set, suspicious words of recognized text are corrected
+            by it (see spell_correction.SpellCorrector)
+        :param perspective_alignment: align results by perspective transform when possible
+            (see postprocess.find_perspective_transformation), otherwise by rotation only
+        '''
         self.verbose = verbose
+        self.perspective_alignment = perspective_alignment
+        self.correct_text = correct_text
+        self.spell_corrector = spell_correction.load_spell_corrector(str(spell_word_list)) if spell_word_list else None
         if not torch.cuda.is_available() and device != 'cpu':
             print('CUDA not availabel. CPU is used')
             device = 'cpu'
 
         params = AttrDict.load(params_fn, verbose=verbose)
-        params.data.net_hw = (inference_width,inference_width,) #(512,768) ###### (1024,1536) #
-        params.data.batch_size = 1 #######
-        params.augmentation = AttrDict(
-            img_width_range=(inference_width, inference_width),
-            stretch_limit = 0.0,
-            rotate_limit=0,
-        )
-        self.preprocessor = data.ImagePreprocessor(params, mode = 'inference')
+        self.preprocessor = inference_preprocessor(params, inference_width)
 
         if isinstance(model_weights_fn, torch.nn.Module):
             self.impl = BraileInferenceImpl(params, model_weights_fn, device, lt.label_is_valid, verbose=verbose)
@@ -250,7 +339,7 @@ class BrailleInference:
             if self.verbose >= 2:
                 print("run.run_impl_1", timeit.default_timer() - t)
                 t = timeit.default_timer()
-            results_dict = self.run_impl(results_dict0['image'], lang, draw_refined, find_orientation=False,
+            results_dict = self.run_impl(results_dict0['image'].get(), lang, draw_refined, find_orientation=False,
                                          process_2_sides=process_2_sides, align=False, draw=True,
                                          gt_rects=results_dict0['gt_rects'])
             results_dict['best_idx'] = results_dict0['best_idx']
@@ -263,32 +352,84 @@ class BrailleInference:
             print("run.run_impl", timeit.default_timer() - t)
         return results_dict
 		
+    def reinterpret(self, record_path, lang, draw_refined, cls_thresh=None, nms_thresh=None, line_thr=None):
+        '''
+        Redoes recognition from raw detections saved in a result record (see save_record) without running the network:
+        decode, boxes_to_lines and text rendering. Orientation and alignment found by original recognition are kept.
+        Record must be saved with save_development_info (it needs 'image' field).
+        :param cls_thresh, nms_thresh: decode thresholds, module defaults if None
+        :param line_thr: postprocess.Line.LINE_THR to use, its default if None
+        :return: results_dict as run() returns
+        '''
+        t = timeit.default_timer()
+        rec = result_record.ResultRecord(record_path)
+        if 'raw_detections' not in rec or 'image' not in rec:
+            raise ValueError("record has no raw detections or image to reinterpret: " + str(record_path))
+        raw = rec['raw_detections']
+        cls_thresh = self.impl.cls_thresh if cls_thresh is None else cls_thresh
+        nms_thresh = self.impl.nms_thresh if nms_thresh is None else nms_thresh
+        if cls_thresh < raw['score_floor']:
+            raise ValueError("cls_thresh {} is below score floor {} of raw detections".format(cls_thresh, raw['score_floor']))
+        hom = np.array(raw['homography']) if raw['homography'] is not None else None
+        w, h = raw['input_size']
+        aug_img = rec.image('image')
+        aug_img.load()
+        results_dict = {
+            'image': postprocess.DeferredImage(aug_img),
+            'image_bytes': rec.read_bytes('image'),
+            'homography': rec.get('homography').tolist() if 'homography' in rec else None,
+            'raw_detections': dict(raw),
+        }
+        for suff in ('', '.rev'):
+            if 'raw_index' + suff not in rec:
+                continue
+            loc_pred, cls_pred = dense_preds(rec['raw_index' + suff], rec['raw_preds' + suff], raw['num_anchors'])
+            boxes, labels, scores = self.impl.decode(loc_pred, cls_pred, w, h, cls_thresh, nms_thresh)
+            boxes = boxes.tolist()
+            labels = labels.tolist()
+            scores = scores.tolist()
+            lines = postprocess.boxes_to_lines(boxes, labels, lang=lang, scores=scores, line_thr=line_thr)
+            self.refine_lines(lines)
+            if hom is not None and not suff:
+                # same order as in run_impl: lines are built before alignment and moved by it
+                boxes = postprocess.transform_rects(boxes, hom)
+                postprocess.transform_lines(lines, hom)
+            page_img = aug_img.transpose(PIL.Image.FLIP_LEFT_RIGHT) if suff else aug_img
+            results_dict.update(self.draw_results(page_img, boxes, lines, labels, scores, bool(suff), draw_refined,
+                                                   lang=lang))
+            results_dict['raw_detections']['index' + suff] = rec['raw_index' + suff]
+            results_dict['raw_detections']['preds' + suff] = rec['raw_preds' + suff]
+        if self.verbose >= 2:
+            print("reinterpret", timeit.default_timer() - t)
+        return results_dict
+
     def refine_lines(self, lines):
         """
         GVNC. Empirical correction of the resulting dimensions to correct the inaccuracy of the results for subsequent markup
         :param boxes:
         :return:
         """
-        for ln in lines:
-            for ch in ln.chars:
-                h = ch.refined_box[3] - ch.refined_box[1]
-                coefs = np.array(REFINE_COEFFS)
-                deltas = h * coefs
-                ch.refined_box = (np.array(ch.refined_box) + deltas).tolist()
+        postprocess.refine_boxes_by_height(lines, REFINE_COEFFS)
 
-    def run_impl(self, img, lang, draw_refined, find_orientation, process_2_sides, align, draw, gt_rects=[]):
+    def run_impl(self, img, lang, draw_refined, find_orientation, process_2_sides, align, draw, gt_rects=[],
+                 preprocessed=False):
+        '''
+        :param preprocessed: img (np.array) and gt_rects are already preprocessed by preprocess_image
+        '''
         t = timeit.default_timer()
         np_img = np.asarray(img)
-        aug_img, aug_gt_rects = self.preprocessor.preprocess_and_augment(np_img, gt_rects)
-        aug_img = data.unify_shape(aug_img)
+        if preprocessed:
+            assert not find_orientation, "orientation can't be found for preprocessed image"
+            aug_img, aug_gt_rects = np_img, gt_rects
+        else:
+            aug_img, aug_gt_rects = preprocess_image(self.preprocessor, np_img, gt_rects)
         input_tensor = self.preprocessor.to_normalized_tensor(aug_img, device=self.impl.device)
         input_tensor_rotated = torch.tensor(0).to(self.impl.device)
 
         aug_img_rot = None
         if find_orientation:
             np_img_rot = np.rot90(np_img, 1, (0,1))
-            aug_img_rot = self.preprocessor.preprocess_and_augment(np_img_rot)[0]
-            aug_img_rot = data.unify_shape(aug_img_rot)
+            aug_img_rot = preprocess_image(self.preprocessor, np_img_rot)[0]
             input_tensor_rotated = self.preprocessor.to_normalized_tensor(aug_img_rot, device=self.impl.device)
 
         if self.verbose >= 2:
@@ -296,7 +437,7 @@ class BrailleInference:
             t = timeit.default_timer()
 
         with torch.no_grad():
-            boxes, labels, scores, best_idx, err_score, boxes2, labels2, scores2 = self.impl(
+            boxes, labels, scores, best_idx, err_score, boxes2, labels2, scores2, raw_info = self.impl(
                 input_tensor, input_tensor_rotated, find_orientation=find_orientation, process_2_sides=process_2_sides)
         if self.verbose >= 2:
             print("    run_impl.impl", timeit.default_timer() - t)
@@ -305,31 +446,36 @@ class BrailleInference:
         boxes = boxes.tolist()
         labels = labels.tolist()
         scores = scores.tolist()
-        lines = postprocess.boxes_to_lines(boxes, labels, lang = lang)
+        lines = postprocess.boxes_to_lines(boxes, labels, lang = lang, scores=scores)
         self.refine_lines(lines)
 
         if process_2_sides:
             boxes2 = boxes2.tolist()
             labels2 = labels2.tolist()
             scores2 = scores2.tolist()
-            lines2 = postprocess.boxes_to_lines(boxes2, labels2, lang=lang)
+            lines2 = postprocess.boxes_to_lines(boxes2, labels2, lang=lang, scores=scores2)
             self.refine_lines(lines2)
 
         aug_img = PIL.Image.fromarray(aug_img if best_idx < OrientationAttempts.ROT90 else aug_img_rot)
         if best_idx in (OrientationAttempts.ROT180, OrientationAttempts.ROT270):
             aug_img = aug_img.transpose(PIL.Image.ROTATE_180)
+        aug_img = postprocess.DeferredImage(aug_img)
 
         if self.verbose >= 2:
             print("    run_impl.postprocess", timeit.default_timer() - t)
             t = timeit.default_timer()
 
         if align and not process_2_sides:
-            hom = postprocess.find_transformation(lines, (aug_img.width, aug_img.height))
+            hom = None
+            if self.perspective_alignment:
+                hom = postprocess.find_perspective_transformation(lines, (aug_img.width, aug_img.height))
+            if hom is None:
+                hom = postprocess.find_transformation(lines, (aug_img.width, aug_img.height))
             if hom is not None:
-                aug_img = postprocess.transform_image(aug_img, hom)
+                # image is warped only if it is drawn or returned, lines already built are moved as they are
+                aug_img = aug_img.transformed(hom)
                 boxes = postprocess.transform_rects(boxes, hom)
-                lines = postprocess.boxes_to_lines(boxes, labels, lang=lang)
-                self.refine_lines(lines)
+                postprocess.transform_lines(lines, hom)
                 aug_gt_rects = postprocess.transform_rects(aug_gt_rects, hom)
             if self.verbose >= 2:
                 print("    run_impl.align", timeit.default_timer() - t)
@@ -343,19 +489,40 @@ class BrailleInference:
             'err_scores': list([ten.cpu().data.tolist() for ten in err_score]),
             'gt_rects': aug_gt_rects,
             'homography': hom.tolist() if hom is not None else hom,
+            'raw_detections': self.raw_detections_dict(raw_info, hom),
         }
 
         if draw:
-            results_dict.update(self.draw_results(aug_img, boxes, lines, labels, scores, False, draw_refined))
+            results_dict.update(self.draw_results(aug_img.get(), boxes, lines, labels, scores, False, draw_refined,
+                                                  lang=lang))
             if process_2_sides:
-                aug_img = aug_img.transpose(PIL.Image.FLIP_LEFT_RIGHT)
-                results_dict.update(self.draw_results(aug_img, boxes2, lines2, labels2, scores2, True, draw_refined))
+                rev_img = aug_img.get().transpose(PIL.Image.FLIP_LEFT_RIGHT)
+                results_dict.update(self.draw_results(rev_img, boxes2, lines2, labels2, scores2, True, draw_refined,
+                                                      lang=lang))
             if self.verbose >= 2:
                 print("    run_impl.draw", timeit.default_timer() - t)
 
         return results_dict
 
-    def draw_results(self, aug_img, boxes, lines, labels, scores, reverse_page, draw_refined):
+    def raw_detections_dict(self, raw_info, hom):
+        '''
+        Sparse network outputs (see BraileInferenceImpl.sparse_preds) of the chosen orientation and the homography
+        that was applied to detections decoded from them. Allows to redo recognition starting from decode step.
+        '''
+        input_size, num_anchors, raw, raw2 = raw_info
+        res = {
+            'input_size': list(input_size),
+            'num_anchors': int(num_anchors),
+            'score_floor': RAW_SCORE_FLOOR,
+            'homography': hom.tolist() if hom is not None else hom,
+        }
+        for suff, raw_suff in (('', raw), ('.rev', raw2)):
+            if raw_suff is not None:
+                res['index' + suff] = raw_suff[0].cpu().numpy().astype(np.int32)
+                res['preds' + suff] = raw_suff[1].cpu().numpy().astype(np.float32)
+        return res
+
+    def draw_results(self, aug_img, boxes, lines, labels, scores, reverse_page, draw_refined, lang=None):
         suff = '.rev' if reverse_page else ''
         aug_img = copy.deepcopy(aug_img)
         draw = PIL.ImageDraw.Draw(aug_img)
@@ -364,10 +531,12 @@ class BrailleInference:
         fntErr = PIL.ImageFont.truetype(font_fn, 12)
         out_text = []
         out_braille = []
+        out_word_scores = []
         for ln in lines:
             if ln.has_space_before:
                 out_text.append('')
                 out_braille.append('')
+                out_word_scores.append([])
             s = ''
             s_brl = ''
             for ch in ln.chars:
@@ -390,6 +559,11 @@ class BrailleInference:
                     draw.text((ch_box[0]+5,ch_box[3]-7), ch.char, font=fntA, fill="black")
             out_text.append(s)
             out_braille.append(s_brl)
+            out_word_scores.append(spell_correction.line_word_scores(ln))
+        if self.correct_text and lang is not None:
+            out_text = postprocess.correct_text(out_text, lang)
+        if self.spell_corrector is not None:
+            out_text = self.spell_corrector.correct_lines(out_text, out_word_scores)
         return {
             'labeled_image' + suff: aug_img,
             'lines' + suff: lines,
@@ -434,7 +608,7 @@ class BrailleInference:
         filename_stem = "image_sample"
         if save_development_info and not reverse_page:
             labeled_image_filename = filename_stem + '.labeled' + suff + '.jpg'
-            result_dict['image' + suff].save(Path(results_dir) / labeled_image_filename)
+            result_dict['image' + suff].get().save(Path(results_dir) / labeled_image_filename)
             json_path = Path(results_dir) / (filename_stem + '.labeled' + suff + '.json')
             result_dict['dict']['imagePath'] = labeled_image_filename
             with open(json_path, 'w') as opened_json:
@@ -454,13 +628,57 @@ class BrailleInference:
         return str(marked_image_path), str(recognized_text_path), str(recognized_braille_path), result_dict['text' + suff]
 
 
+    def save_record(self, result_dict, process_2_sides, results_dir, target_stem, protocol, timings,
+                    save_development_info):
+        """
+        Saves results of both pages as a single record file (see braille_utils.result_record) instead of loose files
+        :return: list of (marked image, text, braille) field references and recognized text - like save_results
+        """
+        fields = OrderedDict(
+            protocol=protocol,
+            timings=timings,
+            homography=np.array(result_dict['homography'], dtype=np.float64) if result_dict['homography'] is not None else None,
+        )
+        suffixes = ['', '.rev'] if process_2_sides else ['']
+        for suff in suffixes:
+            fields['boxes' + suff] = np.array(result_dict['boxes' + suff], dtype=np.float32).reshape(-1, 4)
+            fields['labels' + suff] = np.array(result_dict['labels' + suff], dtype=np.uint8)
+            fields['scores' + suff] = np.array(result_dict['scores' + suff], dtype=np.float32)
+            fields['text' + suff] = ''.join(s + '\n' for s in result_dict['text' + suff])
+            fields['braille' + suff] = ''.join(s + '\n' for s in result_dict['braille' + suff])
+            fields['labeled_image' + suff] = result_record.image_to_bytes(result_dict['labeled_image' + suff])
+        raw_detections = result_dict.get('raw_detections')
+        if raw_detections is not None:
+            fields['raw_detections'] = {k: v for k, v in raw_detections.items() if not isinstance(v, np.ndarray)}
+            for suff in suffixes:
+                fields['raw_index' + suff] = raw_detections['index' + suff]
+                fields['raw_preds' + suff] = raw_detections['preds' + suff]
+        if save_development_info:
+            fields['image'] = result_dict.get('image_bytes') or result_record.image_to_bytes(result_dict['image'].get())
+            result_dict['dict']['imagePath'] = target_stem + '.labeled.jpg'
+            fields['dict'] = result_dict['dict']
+        record_path = Path(results_dir) / (target_stem + result_record.RECORD_SUFFIX)
+        result_record.write_record(record_path, fields)
+        return [(result_record.field_ref(record_path, 'labeled_image' + suff),
+                 result_record.field_ref(record_path, 'text' + suff),
+                 result_record.field_ref(record_path, 'braille' + suff),
+                 result_dict['text' + suff])
+                for suff in suffixes]
+
     def run_and_save(self, img, results_dir, target_stem, lang, extra_info, draw_refined,
                      remove_labeled_from_filename, find_orientation, align_results, process_2_sides, repeat_on_aligned,
-                     save_development_info=True):
+                     save_development_info=True, save_as_record=False, storage=None, source_name=None):
         """
         :param img: can be 1) PIL.Image 2) filename to image (.jpg etc.) or .pdf file
         :param target_stem: starting part of result files names (i.e. <target_stem>.protocol.txt etc.) Is used when
             img is image, not filename. When target_stem is None, it is taken from img stem.
+        :param save_as_record: save results as a single <target_stem>.rec file (see braille_utils.result_record).
+            Returned paths are field references to this file then.
+        :param storage: braille_utils.storage.ShardedStorage or None. If set, results are saved into its shard for
+            target_stem (which must be unique, i.e. task id) and results_dir is ignored.
+        :param source_name: full name of the image (i.e. path in archive) if target_stem is made from its file name.
+            If storage is set, short hash of it is appended to target_stem, so images with the same name
+            in different folders get different ids.
         """
         t = timeit.default_timer()
         result_dict = self.run(img, lang=lang, draw_refined=draw_refined,
@@ -468,44 +686,76 @@ class BrailleInference:
                                process_2_sides=process_2_sides, align_results=align_results, repeat_on_aligned=repeat_on_aligned)
         if result_dict is None:
             return None
+        timings = OrderedDict(run=timeit.default_timer() - t)
         if self.verbose >= 2:
             print("run_and_save.run", timeit.default_timer() - t)
             t = timeit.default_timer()
 
-        os.makedirs(results_dir, exist_ok=True)
         if target_stem is None:
             assert isinstance(img, (str, Path))
             target_stem = Path(img).stem
         if remove_labeled_from_filename and target_stem.endswith('.labeled'):
             target_stem = target_stem[: -len('.labeled')]
-        while (Path(results_dir) / (target_stem + '.marked.jpg')).exists():
-            target_stem += "(dup)"
+        if storage is not None:
+            if source_name is not None:
+                target_stem += '.' + hashlib.md5(str(source_name).encode('utf-8')).hexdigest()[:8]
+            results_dir = storage.dir_for(target_stem)
+        else:
+            os.makedirs(results_dir, exist_ok=True)
+            existing_marker = result_record.RECORD_SUFFIX if save_as_record else '.marked.jpg'
+            while (Path(results_dir) / (target_stem + existing_marker)).exists():
+                target_stem += "(dup)"
+
+        info = OrderedDict(
+            ver = '20200816',
+            best_idx = result_dict['best_idx'],
+            err_scores = result_dict['err_scores'],
+            homography = result_dict['homography'],
+            model_weights = self.impl.model_weights_fn,
+        )
+        if extra_info:
+            info.update(extra_info)
 
-        if save_development_info:
-            protocol_text_path = Path(results_dir) / (target_stem + '.protocol' + '.txt')
-            with open(protocol_text_path, 'w') as f:
-                info = OrderedDict(
-                    ver = '20200816',
-                    best_idx = result_dict['best_idx'],
-                    err_scores = result_dict['err_scores'],
-                    homography = result_dict['homography'],
-                    model_weights = self.impl.model_weights_fn,
-                )
-                if extra_info:
-                    info.update(extra_info)
-                json.dump(info, f, sort_keys=False, indent=4)
-
-        results = [self.save_results(result_dict, False, results_dir, target_stem, save_development_info)]
-        if process_2_sides:
-            results += [self.save_results(result_dict, True, results_dir, target_stem, save_development_info)]
+        if save_as_record:
+            results = self.save_record(result_dict, process_2_sides, results_dir, target_stem, info, timings,
+                                       save_development_info)
+        else:
+            if save_development_info:
+                protocol_text_path = Path(results_dir) / (target_stem + '.protocol' + '.txt')
+                with open(protocol_text_path, 'w') as f:
+                    json.dump(info, f, sort_keys=False, indent=4)
+
+            results = [self.save_results(result_dict, False, results_dir, target_stem, save_development_info)]
+            if process_2_sides:
+                results += [self.save_results(result_dict, True, results_dir, target_stem, save_development_info)]
 
         if self.verbose >= 2:
             print("run_and_save.save results", timeit.default_timer() - t)
         return results
 
+    def reinterpret_and_save(self, record_path, results_dir, target_stem, lang, draw_refined,
+                             cls_thresh=None, nms_thresh=None, line_thr=None):
+        '''
+        Reinterprets results of record_path (see reinterpret) and saves them to a new <target_stem>.rec record.
+        Source record is kept unchanged as it can be shared by other tasks.
+        :return: as save_record
+        '''
+        t = timeit.default_timer()
+        result_dict = self.reinterpret(record_path, lang=lang, draw_refined=draw_refined,
+                                       cls_thresh=cls_thresh, nms_thresh=nms_thresh, line_thr=line_thr)
+        src = result_record.ResultRecord(record_path)
+        info = OrderedDict(src.get('protocol') or {})
+        info.update(lang=lang, reinterpreted_from=Path(record_path).name,
+                    cls_thresh=self.impl.cls_thresh if cls_thresh is None else cls_thresh,
+                    nms_thresh=self.impl.nms_thresh if nms_thresh is None else nms_thresh,
+                    line_thr=postprocess.Line.LINE_THR if line_thr is None else line_thr)
+        timings = OrderedDict(run=src.get('timings', {}).get('run'), reinterpret=timeit.default_timer() - t)
+        return self.save_record(result_dict, 'raw_index.rev' in src, results_dir, target_stem, info, timings,
+                                save_development_info=True)
+
     def process_dir_and_save(self, img_filename_mask, results_dir, lang, extra_info, draw_refined,
                              remove_labeled_from_filename, find_orientation, process_2_sides, align_results,
-                             repeat_on_aligned, save_development_info=True):
+                             repeat_on_aligned, save_development_info=True, save_as_record=False, storage=None):
         if os.path.isfile(img_filename_mask) and os.path.splitext(img_filename_mask)[1] == '.txt':
             list_file = os.path.join(local_config.data_path, img_filename_mask)
             data_dir = os.path.dirname(list_file)
@@ -533,7 +783,10 @@ class BrailleInference:
                 process_2_sides=process_2_sides,
                 align_results=align_results,
                 repeat_on_aligned=repeat_on_aligned,
-                save_development_info=save_development_info)
+                save_development_info=save_development_info,
+                save_as_record=save_as_record,
+                storage=storage,
+                source_name=Path(img_file).resolve())
             if ith_result is None:
                 print('Error processing file: '+ str(img_file))
                 continue
@@ -542,8 +795,11 @@ class BrailleInference:
 
     def process_archive_and_save(self, arch_path, results_dir, lang, extra_info, draw_refined,
                     remove_labeled_from_filename, find_orientation, align_results, process_2_sides, repeat_on_aligned,
-                    save_development_info=True):
-        arch_name = Path(arch_path).name
+                    save_development_info=True, save_as_record=False, storage=None, arch_stem=None):
+        """
+        :param arch_stem: prefix of results names (<arch_stem>.<image stem>), archive file name by default
+        """
+        arch_name = arch_stem or Path(arch_path).name
         result_list = list()
         with zipfile.ZipFile(arch_path, 'r') as archive:
             for entry in archive.infolist():
@@ -562,7 +818,10 @@ class BrailleInference:
                         process_2_sides=process_2_sides,
                         align_results=align_results,
                         repeat_on_aligned=repeat_on_aligned,
-                        save_development_info=save_development_info)
+                        save_development_info=save_development_info,
+                        save_as_record=save_as_record,
+                        storage=storage,
+                        source_name=entry.filename)
                     if ith_result is None:
                         print('Error processing file: ' + str(img_file))
                         continue
@@ -19,7 +19,14 @@ params = AttrDict(
         net_hw = (416, 416),
         rect_margin = 0.3, #  every of 4 margions to char width
         max_std = 0.1,
-        train_list_file_names = [
+        image_cache_bytes = None,  # memory budget of decoded images cache, unlimited if None
+        aug_cache_bytes = None,  # memory budget of augmented images cache, unlimited if None
+        cache_spill_dir = None,  # local dir to spill images evicted from caches to, if set (see data_utils.image_cache)
+        image_cache_shared_dir = None,  # i.e. '/dev/shm/braille_images': decoded images shared by loading workers
+        annotation_cache_dir = None,  # dir to cache parsed annotations in (see data_utils.annotation_cache)
+        num_workers = 0,  # data loading processes
+        prefetch_factor = 2,  # batches prepared in advance by every loading process
+        train_list_file_names = [  # list files or packs (*.pack, see data_utils.pack_dataset)
             #r'DSBI/data/val_li2.txt',
             r'DSBI/data/train_li2.txt',
         ],
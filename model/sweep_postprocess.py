@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Sweep of decode/NMS/postprocess parameters evaluated by validate_retinanet metrics.
+
+The network is run once per (model, image): raw detections (see BrailleInference.raw_detections_dict) are stored
+in a cache of result records. Every grid point is then evaluated from the cache by worker processes, which only decode
+raw detections and rebuild lines, so a sweep costs about one inference pass over the datasets.
+Models and datasets are taken from validate_retinanet.
+"""
+
+cache_dir = 'NN_results/detections_cache'  # relative to local_config.data_path
+workers = None  # number of worker processes, os.cpu_count() if None
+
+grid = {
+    'cls_thresh': [0.3],  # must not be below infer_retinanet.RAW_SCORE_FLOOR
+    'nms_thresh': [0.01, 0.02, 0.05, 0.1],
+    'line_thr': [0.5, 0.6, 0.7, 0.8, 0.9],  # postprocess.Line.LINE_THR
+}
+
+do_filter_lonely_rects = False
+metrics_for_lines = True
+
+import hashlib
+import itertools
+import multiprocessing
+import os
+import sys
+import timeit
+from collections import Counter
+from pathlib import Path
+import torch
+sys.path.append(r'../..')
+sys.path.append('../NN/RetinaNet')
+import local_config
+import braille_utils.postprocess as postprocess
+import braille_utils.result_record as result_record
+import model.infer_retinanet as infer_retinanet
+import model.validate_retinanet as validate_retinanet
+
+
+def grid_points(grid=grid):
+    """
+    :return: list of dicts param name -> value for all combinations of grid values
+    """
+    names = list(grid.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+def model_cache_dir(params_fn, model_weights_fn):
+    """
+    Cache dir of detections of the model. Depends on weights file (path, size, mtime) and inference settings,
+    so retrained weights are never mixed with old detections.
+    """
+    st = os.stat(model_weights_fn)
+    key = '|'.join(str(v) for v in (Path(model_weights_fn).resolve(), st.st_size, st.st_mtime_ns, Path(params_fn).resolve(),
+                                    validate_retinanet.inference_width, infer_retinanet.RAW_SCORE_FLOOR))
+    model_key = Path(model_weights_fn).stem + '.' + hashlib.md5(key.encode('utf-8')).hexdigest()[:12]
+    return Path(local_config.data_path) / cache_dir / model_key
+
+
+def cache_detections(params_fn, model_weights_fn, data_set):
+    """
+    Runs the network over images not cached yet and stores raw detections of every image as a result record
+    :param data_set: dict key -> data_list (see validate_retinanet.prepare_data)
+    :return: dict key -> list of record paths (in data_list order)
+    """
+    model_dir = model_cache_dir(params_fn, model_weights_fn)
+    os.makedirs(model_dir, exist_ok=True)
+    recognizer = None
+    res = dict()
+    for key, data_list in data_set.items():
+        res[key] = []
+        for gt_dict in data_list:
+            # gt rects are stored in the record, so the key covers annotation as well as image
+            item_key = validate_retinanet.data_item_key(gt_dict)
+            record_path = model_dir / (hashlib.md5(item_key.encode('utf-8')).hexdigest() + result_record.RECORD_SUFFIX)
+            res[key].append(record_path)
+            if record_path.is_file():
+                continue
+            if recognizer is None:
+                recognizer = infer_retinanet.BrailleInference(
+                    params_fn=params_fn,
+                    model_weights_fn=model_weights_fn,
+                    create_script=None,
+                    inference_width=validate_retinanet.inference_width,
+                    verbose=validate_retinanet.verbose)
+            res_dict = recognizer.run(gt_dict['image_fn'],
+                                      lang=validate_retinanet.lang,
+                                      draw_refined=infer_retinanet.BrailleInference.DRAW_NONE,
+                                      find_orientation=False,
+                                      process_2_sides=False,
+                                      align_results=False,
+                                      repeat_on_aligned=False,
+                                      gt_rects=gt_dict['gt_rects'])
+            raw = res_dict['raw_detections']
+            result_record.write_record(record_path, {
+                'image_fn': str(gt_dict['image_fn']),
+                'raw_detections': {k: raw[k] for k in ('input_size', 'num_anchors', 'score_floor', 'homography')},
+                'raw_index': raw['index'],
+                'raw_preds': raw['preds'],
+                'gt_rects': [list(r) for r in res_dict['gt_rects']],
+                'image_wh': [res_dict['labeled_image'].width, res_dict['labeled_image'].height],
+            })
+    return res
+
+
+_decoder = None  # infer_retinanet.RawDetectionsDecoder of a worker process
+
+
+def _init_worker(params_fn):
+    global _decoder
+    torch.set_num_threads(1)
+    _decoder = infer_retinanet.RawDetectionsDecoder(params_fn)
+
+
+def evaluate_point(point, record_paths, gt_texts):
+    """
+    Evaluates validate_retinanet metrics for a grid point using cached detections.
+    Same as validate_retinanet.validate_model with the point parameters applied.
+    :param point: dict param name -> value (see grid)
+    :param record_paths: records written by cache_detections
+    :param gt_texts: groundtruth pseudotexts of the records
+    :return: metrics dict (see validate_retinanet.validate_model)
+    """
+    counts = Counter()
+    for record_path, gt_text in zip(record_paths, gt_texts):
+        rec = result_record.ResultRecord(record_path)
+        boxes, labels, scores = _decoder.decode_raw(rec['raw_detections'], rec['raw_index'], rec['raw_preds'],
+                                                    cls_thresh=point['cls_thresh'], nms_thresh=point['nms_thresh'])
+        lines = postprocess.boxes_to_lines(boxes, labels, lang=validate_retinanet.lang, scores=scores,
+                                           line_thr=point['line_thr'])
+        postprocess.refine_boxes_by_height(lines, infer_retinanet.REFINE_COEFFS)
+        if do_filter_lonely_rects:
+            lines, _ = postprocess.filter_lonely_rects_for_lines(lines)
+        counts.update(validate_retinanet.page_metric_counts(
+            lines, boxes=boxes, labels=labels, gt_text=gt_text, gt_rects=rec['gt_rects'],
+            image_wh=tuple(rec['image_wh']), img=None, do_filter_lonely_rects=do_filter_lonely_rects,
+            metrics_for_lines=metrics_for_lines))
+    return validate_retinanet.metrics_from_counts(counts, len(record_paths))
+
+
+def _evaluate_task(task):
+    point_idx, key, point, record_paths, gt_texts = task
+    return point_idx, key, evaluate_point(point, record_paths, gt_texts)
+
+
+def sweep_model(params_fn, model_weights_fn, data_set, points, n_workers=workers):
+    """
+    :return: list of (point, key, metrics) in points order
+    """
+    records = cache_detections(params_fn, model_weights_fn, data_set)
+    tasks = [(point_idx, key, point, records[key], [gt_dict['gt_text'] for gt_dict in data_list])
+             for point_idx, point in enumerate(points) for key, data_list in data_set.items()]
+    with multiprocessing.Pool(n_workers or os.cpu_count(), initializer=_init_worker, initargs=(str(params_fn),)) as pool:
+        results = pool.map(_evaluate_task, tasks, chunksize=1)
+    return [(points[point_idx], key, metrics) for point_idx, key, metrics in results]
+
+
+def main():
+    data_set = validate_retinanet.prepare_data()
+    points = grid_points()
+    print('model\tweights\tkey\t' + '\t'.join(grid.keys()) + '\t'
+          'precision\trecall\tf1\t'
+          'precision_c\trecall_C\tf1_c\t'
+          'd_by_doc\td_by_char\td_by_char_avg')
+    for model_root, model_weights in validate_retinanet.models:
+        params_fn = validate_retinanet.model_params_fn(model_root)
+        model_weights_fn = os.path.join(local_config.data_path, model_root, model_weights)
+        t0 = timeit.default_timer()
+        for point, key, res in sweep_model(params_fn, model_weights_fn, data_set, points):
+            print('{model}\t{weights}\t{key}\t{point}\t'
+                  '{res[precision_r]:.4}\t{res[recall_r]:.4}\t{res[f1_r]:.4}\t'
+                  '{res[precision_c]:.4}\t{res[recall_c]:.4}\t{res[f1_c]:.4}\t'
+                  '{res[d_by_doc]:.4}\t{res[d_by_char]:.4}\t'
+                  '{res[d_by_char_avg]:.4}'.format(model=model_root, weights=model_weights, key=key,
+                                                   point='\t'.join(str(v) for v in point.values()), res=res))
+        if validate_retinanet.verbose:
+            print('{} points: {:.1f}s'.format(len(points), timeit.default_timer() - t0))
+
+
+if __name__ == '__main__':
+    main()
@@ -111,16 +111,22 @@ else:
             engine.state.metrics['lr'] = ctx.optimizer.param_groups[0]['lr']
             ctx.lr_scheduler.step(**call_params)
 
+    accuracy_evaluator = validate_retinanet.AccuracyEvaluator(os.path.join(ctx.params.get_base_filename(), 'param.txt'),
+                                                              model, settings.device,
+                                                              validate_retinanet.prepare_data(ctx.params.data.val_list_file_names))
+
     @trainer.on(Events.EPOCH_COMPLETED)
     def eval_accuracy(engine):
         if engine.state.epoch % 100 == 1:
-            data_set = validate_retinanet.prepare_data(ctx.params.data.val_list_file_names)
-            for key, data_list in data_set.items():
-                acc_res = validate_retinanet.evaluate_accuracy(os.path.join(ctx.params.get_base_filename(), 'param.txt'),
-                                                               model, settings.device, data_list)
+            for key, acc_res in accuracy_evaluator.evaluate().items():
                 for rk, rv in acc_res.items():
                     engine.state.metrics[key+ ':' + rk] = rv
 
+@trainer.on(Events.EPOCH_COMPLETED)
+def log_cache_stats(engine):
+    for name, stats in train_loader.dataset.cache_stats().items():
+        engine.state.metrics['train:{}_cache.hit_rate'.format(name)] = stats['hit_rate']
+
 #@trainer.on(Events.EPOCH_COMPLETED)
 #def save_model(engine):
 #    if save_every and (engine.state.epoch % save_every) == 0:
@@ -30,9 +30,14 @@ datasets = {
 }
 
 lang = 'RU'
+annotation_cache_dir = None  # dir to cache parsed annotations in (see data_utils.annotation_cache), if set
 
+import hashlib
 import os
 import sys
+import math
+from collections import Counter, defaultdict
+import numpy as np
 import Levenshtein
 from pathlib import Path
 import PIL
@@ -41,7 +46,6 @@ sys.path.append(r'../..')
 sys.path.append('../NN/RetinaNet')
 import local_config
 import data_utils.data as data
-import data_utils.dsbi as dsbi
 import braille_utils.postprocess as postprocess
 import model.infer_retinanet as infer_retinanet
 from braille_utils import label_tools
@@ -77,27 +81,22 @@ def prepare_data(datasets=datasets):
                     rects = None
                     lbl_fn = full_fn.rsplit('.', 1)[0] + '.json'
                     if os.path.isfile(lbl_fn):
-                        rects = data.read_LabelMe_annotation(label_filename=lbl_fn, get_points=False)
+                        rects = data.read_annotation_file(lbl_fn, None, None, rect_margin=rect_margin,
+                                                          get_points=False, cache_dir=annotation_cache_dir)
                     else:
                         lbl_fn = full_fn.rsplit('.', 1)[0] + '.txt'
                         if os.path.isfile(lbl_fn):
                             img = PIL.Image.open(full_fn)
-                            rects = dsbi.read_DSBI_annotation(label_filename=lbl_fn,
-                                                              width=img.width,
-                                                              height=img.height,
-                                                              rect_margin=rect_margin,
-                                                              get_points=False
-                                                              )
+                            rects = data.read_annotation_file(lbl_fn, img.width, img.height, rect_margin=rect_margin,
+                                                              get_points=False, cache_dir=annotation_cache_dir)
                         else:
                             full_fn = full_fn.rsplit('.', 1)[0] + '+recto.jpg'
                             lbl_fn  = full_fn.rsplit('.', 1)[0] + '.txt'
                             if os.path.isfile(lbl_fn):
                                 img = PIL.Image.open(full_fn)
-                                rects = dsbi.read_DSBI_annotation(label_filename=lbl_fn,
-                                                                  width=img.width,
-                                                                  height=img.height,
-                                                                  rect_margin=rect_margin,
-                                                                  get_points=False)
+                                rects = data.read_annotation_file(lbl_fn, img.width, img.height,
+                                                                  rect_margin=rect_margin, get_points=False,
+                                                                  cache_dir=annotation_cache_dir)
                     if rects is not None:
                         boxes = [r[:4] for r in rects]
                         labels = [r[4] for r in rects]
@@ -107,6 +106,18 @@ def prepare_data(datasets=datasets):
     return res_dict
 
 
+def data_item_key(gt_dict):
+    """
+    Key of prepare_data item for caches of results computed from it: image path, size and mtime and hash of
+    groundtruth rects, so the key changes if the image, annotation or annotation parsing params change
+    :return: str
+    """
+    img_fn = Path(gt_dict['image_fn']).resolve()
+    st = os.stat(img_fn)
+    gt_hash = hashlib.md5(repr([list(r) for r in gt_dict['gt_rects']]).encode('utf-8')).hexdigest()
+    return '|'.join(str(v) for v in (img_fn, st.st_size, st.st_mtime_ns, gt_hash))
+
+
 def label_to_pseudochar(label):
     """
     int (0..63) - str ('0' .. 'o')
@@ -200,22 +211,43 @@ def dot_metrics(res, gt):
 
 
 def filter_lonely_rects(boxes, labels, img):
+    '''
+    Removes boxes having no neighbour box crossing their center line within dx_to_h*box height from their sides.
+    Boxes are put into uniform grid of cells of median box height, so only boxes of cells near the box are checked.
+    '''
     dx_to_h = 2.35 # расстояние от края до центра 3го символа
     res_boxes = []
     res_labels = []
     filtered = []
+    if not len(boxes):
+        return res_boxes, res_labels
+    cell = float(np.median([box[3] - box[1] for box in boxes]))
+    if not cell > 0:
+        cell = 1.
+    grid = defaultdict(list)  # (col, row) -> indexes of boxes crossing the cell
+    for j, box2 in enumerate(boxes):
+        for row in range(math.floor(box2[1] / cell), math.floor(box2[3] / cell) + 1):
+            for col in range(math.floor(box2[0] / cell), math.floor(box2[2] / cell) + 1):
+                grid[col, row].append(j)
     for i in range(len(boxes)):
         box = boxes[i]
         cy = (box[1] + box[3])/2
         dx = (box[3]-box[1])*dx_to_h
-        for j in range(len(boxes)):
-            if i == j:
-                continue
-            box2 = boxes[j]
-            if (box2[0] < box[2] + dx) and (box2[2] > box[0] - dx) and (box2[1] < cy) and (box2[3] > cy):
-                res_boxes.append(boxes[i])
-                res_labels.append(labels[i])
+        row = math.floor(cy / cell)
+        found = False
+        for col in range(math.floor((box[0] - dx) / cell), math.floor((box[2] + dx) / cell) + 1):
+            for j in grid.get((col, row), ()):
+                if i == j:
+                    continue
+                box2 = boxes[j]
+                if (box2[0] < box[2] + dx) and (box2[2] > box[0] - dx) and (box2[1] < cy) and (box2[3] > cy):
+                    found = True
+                    break
+            if found:
                 break
+        if found:
+            res_boxes.append(boxes[i])
+            res_labels.append(labels[i])
         else:
             filtered.append(box)
     # if filtered:
@@ -226,173 +258,322 @@ def filter_lonely_rects(boxes, labels, img):
 
     return res_boxes, res_labels
 
+def _check_filter_lonely_rects(n_pages=10, n_boxes=1500):
+    '''
+    Compares filter_lonely_rects with the original O(N^2) version on random pages and measures both
+    '''
+    def filter_lonely_rects_reference(boxes, labels):
+        dx_to_h = 2.35
+        res_boxes = []
+        res_labels = []
+        for i in range(len(boxes)):
+            box = boxes[i]
+            cy = (box[1] + box[3])/2
+            dx = (box[3]-box[1])*dx_to_h
+            for j in range(len(boxes)):
+                if i == j:
+                    continue
+                box2 = boxes[j]
+                if (box2[0] < box[2] + dx) and (box2[2] > box[0] - dx) and (box2[1] < cy) and (box2[3] > cy):
+                    res_boxes.append(boxes[i])
+                    res_labels.append(labels[i])
+                    break
+        return res_boxes, res_labels
+
+    import timeit
+    rng = np.random.RandomState(0)
+    t_ref = t_new = 0
+    for _ in range(n_pages):
+        # sparse random boxes of varying size, many of them lonely
+        xy = rng.uniform(0, 2000, size=(n_boxes, 2))
+        wh = rng.uniform(5, 40, size=(n_boxes, 2))
+        boxes = np.concatenate([xy, xy + wh], axis=1).tolist() + [[0., 0., 0., 0.]]
+        labels = list(range(len(boxes)))
+        t = timeit.default_timer()
+        expected = filter_lonely_rects_reference(boxes, labels)
+        t_ref += timeit.default_timer() - t
+        t = timeit.default_timer()
+        assert filter_lonely_rects(boxes, labels, None) == expected
+        t_new += timeit.default_timer() - t
+    print("filter_lonely_rects OK: {:.4f}s -> {:.4f}s per page".format(t_ref / n_pages, t_new / n_pages))
+
+
+IOU_CHUNK_SIZE = 256  # gt rects per chunk of IoU matrix, bounds memory used for huge pages
+_DOTS_IN_LABEL = torch.tensor([bin(i).count('1') for i in range(64)], dtype=torch.int64)  # popcount of 6-bit labels
+
+
+def _rects_to_tensors(boxes, gt_rects, image_wh):
+    boxes = torch.tensor(boxes)
+    gt_boxes = torch.tensor([r[:4] for r in gt_rects], dtype=torch.float32) * torch.tensor([image_wh[0], image_wh[1], image_wh[0], image_wh[1]])
+    return boxes, gt_boxes
+
+
+def best_iou_matches(gt_boxes, boxes, chunk_size=IOU_CHUNK_SIZE):
+    """
+    Finds best matching (by IoU) box for every gt box and vice versa. IoU is computed by chunks of gt boxes
+    close by y, only with boxes in y band of the chunk, so memory is bounded by chunk_size x band size.
+    Best matches with IoU > 0 are the same as found by argmax of the whole IoU matrix (on ties the first index wins),
+    indexes for IoU == 0 are arbitrary.
+    :param gt_boxes: tensor (N, 4)
+    :param boxes: tensor (M, 4)
+    :return: gt_best_iou (N,), gt_best_idx (N,), rec_best_iou (M,), rec_best_idx (M,)
+    """
+    areas = (boxes[:, 2] - boxes[:, 0])*(boxes[:, 3] - boxes[:, 1])
+    gt_areas = (gt_boxes[:, 2] - gt_boxes[:, 0])*(gt_boxes[:, 3] - gt_boxes[:, 1])
+    gt_best_iou = torch.zeros(len(gt_boxes), dtype=areas.dtype)
+    gt_best_idx = torch.zeros(len(gt_boxes), dtype=torch.int64)
+    rec_best_iou = torch.zeros(len(boxes), dtype=areas.dtype)
+    rec_best_idx = torch.full((len(boxes),), len(gt_boxes), dtype=torch.int64)
+    gt_order = torch.argsort(gt_boxes[:, 1])
+    for start in range(0, len(gt_boxes), chunk_size):
+        rows = gt_order[start: start + chunk_size].sort()[0]  # index order makes argmax prefer the first index
+        gt_chunk = gt_boxes[rows]
+        cols = torch.nonzero((boxes[:, 1] < gt_chunk[:, 3].max()) & (boxes[:, 3] > gt_chunk[:, 1].min()))[:, 0]
+        if not len(cols):
+            continue
+        box_chunk = boxes[cols]
+        x1 = torch.max(gt_chunk[:, 0].unsqueeze(1), box_chunk[:, 0].unsqueeze(0))
+        y1 = torch.max(gt_chunk[:, 1].unsqueeze(1), box_chunk[:, 1].unsqueeze(0))
+        x2 = torch.min(gt_chunk[:, 2].unsqueeze(1), box_chunk[:, 2].unsqueeze(0))
+        y2 = torch.min(gt_chunk[:, 3].unsqueeze(1), box_chunk[:, 3].unsqueeze(0))
+        intersect_area = (x2-x1).clamp(min=0)*(y2-y1).clamp(min=0)
+        iou = intersect_area / (gt_areas[rows].unsqueeze(1) + areas[cols].unsqueeze(0) - intersect_area)
+        row_iou, row_idx = iou.max(dim=1)
+        gt_best_iou[rows] = row_iou
+        gt_best_idx[rows] = cols[row_idx]
+        col_iou, col_idx = iou.max(dim=0)
+        col_idx = rows[col_idx]
+        better = (col_iou > rec_best_iou[cols]) | ((col_iou == rec_best_iou[cols]) & (col_idx < rec_best_idx[cols]))
+        rec_best_iou[cols[better]] = col_iou[better]
+        rec_best_idx[cols[better]] = col_idx[better]
+    return gt_best_iou, gt_best_idx, rec_best_iou, rec_best_idx.clamp(max=max(len(gt_boxes) - 1, 0))
+
+
 def dot_metrics_rects(boxes, labels, gt_rects, image_wh, img, do_filter_lonely_rects):
     if do_filter_lonely_rects:
         boxes, labels = filter_lonely_rects(boxes, labels, img)
-    gt_labels = [r[4] for r in gt_rects]
-    gt_rec_labels = [-1] * len(gt_rects)  # recognized label for gt, -1 - missed
-    rec_is_false = [1] * len(labels)  # recognized is false
+    gt_labels = torch.tensor([r[4] for r in gt_rects], dtype=torch.int64) & 63
+    labels = torch.as_tensor(labels, dtype=torch.int64).reshape(-1) & 63
+    gt_rec_labels = torch.full_like(gt_labels, -1)  # recognized label for gt, -1 - missed
+    rec_is_false = torch.ones_like(labels, dtype=torch.bool)  # recognized is false
 
     if len(gt_rects) and len(labels):
-        boxes = torch.tensor(boxes)
-        gt_boxes = torch.tensor([r[:4] for r in gt_rects], dtype=torch.float32) * torch.tensor([image_wh[0], image_wh[1], image_wh[0], image_wh[1]])
-
-        # Для отладки
-        # labels = torch.tensor(labels)
-        # gt_labels = torch.tensor(gt_labels)
-        #
-        # _, rec_order = torch.sort(boxes[:, 1], dim=0)
-        # boxes = boxes[rec_order][:15]
-        # labels = labels[rec_order][:15]
-        # _, gt_order = torch.sort(gt_boxes[:, 1], dim=0)
-        # gt_boxes = gt_boxes[gt_order][:15]
-        # gt_labels = gt_labels[gt_order][:15]
-        #
-        # _, rec_order = torch.sort(labels, dim=0)
-        # boxes = boxes[rec_order]
-        # labels = labels[rec_order]
-        # _, gt_order = torch.sort(-gt_labels, dim=0)
-        # gt_boxes = gt_boxes[gt_order]
-        # gt_labels = gt_labels[gt_order]
-        #
-        # labels = torch.tensor(labels)
-        # gt_labels = torch.tensor(gt_labels)
-
-        areas = (boxes[:, 2] - boxes[:, 0])*(boxes[:, 3] - boxes[:, 1])
-        gt_areas = (gt_boxes[:, 2] - gt_boxes[:, 0])*(gt_boxes[:, 3] - gt_boxes[:, 1])
-        x1 = torch.max(gt_boxes[:, 0].unsqueeze(1), boxes[:, 0].unsqueeze(0))
-        y1 = torch.max(gt_boxes[:, 1].unsqueeze(1), boxes[:, 1].unsqueeze(0))
-        x2 = torch.min(gt_boxes[:, 2].unsqueeze(1), boxes[:, 2].unsqueeze(0))
-        y2 = torch.min(gt_boxes[:, 3].unsqueeze(1), boxes[:, 3].unsqueeze(0))
-        intersect_area = (x2-x1).clamp(min=0)*(y2-y1).clamp(min=0)
-        iou = intersect_area / (gt_areas.unsqueeze(1) + areas.unsqueeze(0) - intersect_area)
-        for gt_i in range(len(gt_labels)):
-            rec_i = iou[gt_i, :].argmax()
-            if iou[gt_i, rec_i] > 0:
-                gt_i2 = iou[:, rec_i].argmax()
-                if gt_i2 == gt_i:
-                    gt_rec_labels[gt_i] = labels[rec_i]
-                    rec_is_false[rec_i] = 0
-
-    tp = 0
-    fp = 0
-    fn = 0
-    for gt_label, rec_label in zip(gt_labels, gt_rec_labels):
-        if rec_label == -1:
-            fn += count_dots_lbl(gt_label)
-        else:
-            res010 = label_tools.int_to_label010(rec_label)
-            gt010 = label_tools.int_to_label010(gt_label)
-            for p in range(6):
-                if res010[p] == '1' and gt010[p] == '0':
-                    fp += 1
-                elif res010[p] == '0' and gt010[p] == '1':
-                    fn += 1
-                elif res010[p] == '1' and gt010[p] == '1':
-                    tp += 1
-    for label, is_false in zip(labels, rec_is_false):
-        if is_false:
-            fp += count_dots_lbl(label)
+        boxes, gt_boxes = _rects_to_tensors(boxes, gt_rects, image_wh)
+        gt_best_iou, gt_best_idx, rec_best_iou, rec_best_idx = best_iou_matches(gt_boxes, boxes)
+        # gt and recognized rect are matched if they are the best match for each other
+        is_matched = (gt_best_iou > 0) & (rec_best_idx[gt_best_idx] == torch.arange(len(gt_labels)))
+        gt_rec_labels[is_matched] = labels[gt_best_idx[is_matched]]
+        rec_is_false[gt_best_idx[is_matched]] = False
+
+    is_missed = gt_rec_labels == -1
+    rec = gt_rec_labels[~is_missed]
+    gt = gt_labels[~is_missed]
+    tp = int(_DOTS_IN_LABEL[rec & gt].sum())
+    fp = int(_DOTS_IN_LABEL[rec & ~gt & 63].sum()) + int(_DOTS_IN_LABEL[labels[rec_is_false]].sum())
+    fn = int(_DOTS_IN_LABEL[gt & ~rec & 63].sum()) + int(_DOTS_IN_LABEL[gt_labels[is_missed]].sum())
     return tp, fp, fn
 
 
 def char_metrics_rects(boxes, labels, gt_rects, image_wh, img, do_filter_lonely_rects):
     if do_filter_lonely_rects:
         boxes, labels = filter_lonely_rects(boxes, labels, img)
-    gt_labels = [r[4] for r in gt_rects]
-    gt_is_correct = [0] * len(gt_rects)  # recognized label for gt, -1 - missed
-    rec_is_false = [1] * len(labels)  # recognized is false
 
     tp = 0
     fp = 0
     fn = 0
     if len(gt_rects) and len(labels):
-        boxes = torch.tensor(boxes)
-        gt_boxes = torch.tensor([r[:4] for r in gt_rects], dtype=torch.float32) * torch.tensor([image_wh[0], image_wh[1], image_wh[0], image_wh[1]])
-
-        # Для отладки
-        # labels = torch.tensor(labels)
-        # gt_labels = torch.tensor(gt_labels)
-        #
-        # _, rec_order = torch.sort(boxes[:, 1], dim=0)
-        # boxes = boxes[rec_order][:15]
-        # labels = labels[rec_order][:15]
-        # _, gt_order = torch.sort(gt_boxes[:, 1], dim=0)
-        # gt_boxes = gt_boxes[gt_order][:15]
-        # gt_labels = gt_labels[gt_order][:15]
-        #
-        # _, rec_order = torch.sort(labels, dim=0)
-        # boxes = boxes[rec_order]
-        # labels = labels[rec_order]
-        # _, gt_order = torch.sort(-gt_labels, dim=0)
-        # gt_boxes = gt_boxes[gt_order]
-        # gt_labels = gt_labels[gt_order]
-        #
-        # labels = torch.tensor(labels)
-        # gt_labels = torch.tensor(gt_labels)
-
-        areas = (boxes[:, 2] - boxes[:, 0])*(boxes[:, 3] - boxes[:, 1])
-        gt_areas = (gt_boxes[:, 2] - gt_boxes[:, 0])*(gt_boxes[:, 3] - gt_boxes[:, 1])
-        x1 = torch.max(gt_boxes[:, 0].unsqueeze(1), boxes[:, 0].unsqueeze(0))
-        y1 = torch.max(gt_boxes[:, 1].unsqueeze(1), boxes[:, 1].unsqueeze(0))
-        x2 = torch.min(gt_boxes[:, 2].unsqueeze(1), boxes[:, 2].unsqueeze(0))
-        y2 = torch.min(gt_boxes[:, 3].unsqueeze(1), boxes[:, 3].unsqueeze(0))
-        intersect_area = (x2-x1).clamp(min=0)*(y2-y1).clamp(min=0)
-        iou = intersect_area / (gt_areas.unsqueeze(1) + areas.unsqueeze(0) - intersect_area)
-        for gt_i in range(len(gt_labels)):
-            rec_i = iou[gt_i, :].argmax()
-            if iou[gt_i, rec_i] > 0.5:
-                if labels[rec_i] == gt_labels[gt_i]:
-                    gt_is_correct[gt_i] = 1
-        for rec_i in range(len(labels)):
-            gt_i = iou[:, rec_i].argmax()
-            if iou[gt_i, rec_i] > 0.5:
-                if labels[rec_i] == gt_labels[gt_i]:
-                    rec_is_false[rec_i] = 0
-        tp = sum(gt_is_correct)
-        fp = sum(rec_is_false)
-        fn = len(gt_is_correct) - tp
-
-        # if fp or fn:
-        #     draw = PIL.ImageDraw.Draw(img)
-        #     for i, is_correct in enumerate(gt_is_correct):
-        #         if not is_correct:
-        #             draw.rectangle(gt_boxes[i].tolist(), outline="red")
-        #             draw.text((gt_boxes[i][0]-20, gt_boxes[i][3]), label_tools.int_to_label123(gt_labels[i]), fill="red")
-        #         else:
-        #             draw.rectangle(gt_boxes[i].tolist(), outline="green")
-        #     for i, is_false in enumerate(rec_is_false):
-        #         if is_false:
-        #             draw.rectangle(boxes[i].tolist(), outline="blue")
-        #             draw.text((boxes[i][0]+20, boxes[i][3]), label_tools.int_to_label123(labels[i]), fill="blue")
-        #     img.show()
+        gt_labels = torch.tensor([r[4] for r in gt_rects], dtype=torch.int64)
+        labels = torch.as_tensor(labels, dtype=torch.int64).reshape(-1)
+        boxes, gt_boxes = _rects_to_tensors(boxes, gt_rects, image_wh)
+        gt_best_iou, gt_best_idx, rec_best_iou, rec_best_idx = best_iou_matches(gt_boxes, boxes)
+        gt_is_correct = (gt_best_iou > 0.5) & (labels[gt_best_idx] == gt_labels)
+        rec_is_correct = (rec_best_iou > 0.5) & (labels == gt_labels[rec_best_idx])
+        tp = int(gt_is_correct.sum())
+        fp = len(labels) - int(rec_is_correct.sum())
+        fn = len(gt_labels) - tp
 
     return tp, fp, fn
 
 
+def _check_rects_metrics(n_pages=10, n_rects=2000):
+    """
+    Compares dot_metrics_rects and char_metrics_rects with their original versions (matching by python loops over
+    the full IoU matrix) on random pages and measures both
+    """
+    def dot_metrics_rects_reference(boxes, labels, gt_rects, image_wh, img, do_filter_lonely_rects):
+        gt_labels = [r[4] for r in gt_rects]
+        gt_rec_labels = [-1] * len(gt_rects)
+        rec_is_false = [1] * len(labels)
+        if len(gt_rects) and len(labels):
+            boxes, gt_boxes = _rects_to_tensors(boxes, gt_rects, image_wh)
+            areas = (boxes[:, 2] - boxes[:, 0])*(boxes[:, 3] - boxes[:, 1])
+            gt_areas = (gt_boxes[:, 2] - gt_boxes[:, 0])*(gt_boxes[:, 3] - gt_boxes[:, 1])
+            x1 = torch.max(gt_boxes[:, 0].unsqueeze(1), boxes[:, 0].unsqueeze(0))
+            y1 = torch.max(gt_boxes[:, 1].unsqueeze(1), boxes[:, 1].unsqueeze(0))
+            x2 = torch.min(gt_boxes[:, 2].unsqueeze(1), boxes[:, 2].unsqueeze(0))
+            y2 = torch.min(gt_boxes[:, 3].unsqueeze(1), boxes[:, 3].unsqueeze(0))
+            intersect_area = (x2-x1).clamp(min=0)*(y2-y1).clamp(min=0)
+            iou = intersect_area / (gt_areas.unsqueeze(1) + areas.unsqueeze(0) - intersect_area)
+            for gt_i in range(len(gt_labels)):
+                rec_i = iou[gt_i, :].argmax()
+                if iou[gt_i, rec_i] > 0:
+                    gt_i2 = iou[:, rec_i].argmax()
+                    if gt_i2 == gt_i:
+                        gt_rec_labels[gt_i] = labels[rec_i]
+                        rec_is_false[rec_i] = 0
+        tp = 0
+        fp = 0
+        fn = 0
+        for gt_label, rec_label in zip(gt_labels, gt_rec_labels):
+            if rec_label == -1:
+                fn += count_dots_lbl(gt_label)
+            else:
+                res010 = label_tools.int_to_label010(rec_label)
+                gt010 = label_tools.int_to_label010(gt_label)
+                for p in range(6):
+                    if res010[p] == '1' and gt010[p] == '0':
+                        fp += 1
+                    elif res010[p] == '0' and gt010[p] == '1':
+                        fn += 1
+                    elif res010[p] == '1' and gt010[p] == '1':
+                        tp += 1
+        for label, is_false in zip(labels, rec_is_false):
+            if is_false:
+                fp += count_dots_lbl(label)
+        return tp, fp, fn
+
+
+    def char_metrics_rects_reference(boxes, labels, gt_rects, image_wh, img, do_filter_lonely_rects):
+        gt_labels = [r[4] for r in gt_rects]
+        gt_is_correct = [0] * len(gt_rects)
+        rec_is_false = [1] * len(labels)
+        tp = 0
+        fp = 0
+        fn = 0
+        if len(gt_rects) and len(labels):
+            boxes, gt_boxes = _rects_to_tensors(boxes, gt_rects, image_wh)
+            areas = (boxes[:, 2] - boxes[:, 0])*(boxes[:, 3] - boxes[:, 1])
+            gt_areas = (gt_boxes[:, 2] - gt_boxes[:, 0])*(gt_boxes[:, 3] - gt_boxes[:, 1])
+            x1 = torch.max(gt_boxes[:, 0].unsqueeze(1), boxes[:, 0].unsqueeze(0))
+            y1 = torch.max(gt_boxes[:, 1].unsqueeze(1), boxes[:, 1].unsqueeze(0))
+            x2 = torch.min(gt_boxes[:, 2].unsqueeze(1), boxes[:, 2].unsqueeze(0))
+            y2 = torch.min(gt_boxes[:, 3].unsqueeze(1), boxes[:, 3].unsqueeze(0))
+            intersect_area = (x2-x1).clamp(min=0)*(y2-y1).clamp(min=0)
+            iou = intersect_area / (gt_areas.unsqueeze(1) + areas.unsqueeze(0) - intersect_area)
+            for gt_i in range(len(gt_labels)):
+                rec_i = iou[gt_i, :].argmax()
+                if iou[gt_i, rec_i] > 0.5:
+                    if labels[rec_i] == gt_labels[gt_i]:
+                        gt_is_correct[gt_i] = 1
+            for rec_i in range(len(labels)):
+                gt_i = iou[:, rec_i].argmax()
+                if iou[gt_i, rec_i] > 0.5:
+                    if labels[rec_i] == gt_labels[gt_i]:
+                        rec_is_false[rec_i] = 0
+            tp = sum(gt_is_correct)
+            fp = sum(rec_is_false)
+            fn = len(gt_is_correct) - tp
+        return tp, fp, fn
+
+    import timeit
+    reference = {dot_metrics_rects: dot_metrics_rects_reference, char_metrics_rects: char_metrics_rects_reference}
+    rng = np.random.RandomState(0)
+    t_ref = t_new = 0
+    for page in range(n_pages):
+        w, h = 1000, 1400
+        gt_xy = rng.uniform(0, 1, size=(n_rects, 2))
+        gt_rects = [(x, y, x + 0.015, y + 0.015, int(rng.randint(64))) for x, y in gt_xy.tolist()]
+        # recognized: shifted gt (with changed labels), missed gt and false rects
+        kept = rng.rand(n_rects) < 0.9
+        xy = np.concatenate([gt_xy[kept] * (w, h) + rng.normal(0, 3, size=(kept.sum(), 2)),
+                             rng.uniform(0, 1, size=(n_rects // 20, 2)) * (w, h)])
+        boxes = np.concatenate([xy, xy + (15, 21)], axis=1).tolist()
+        labels = [gt_rects[i][4] if rng.rand() < 0.8 else int(rng.randint(64)) for i in np.flatnonzero(kept)]
+        labels += rng.randint(64, size=len(boxes) - len(labels)).tolist()
+        if page == 0:
+            boxes, labels = boxes[:1], labels[:1]
+        elif page == 1:  # duplicates make equal IoU, the first index should win
+            gt_rects += gt_rects[:n_rects // 10]
+            boxes, labels = boxes + boxes[:n_rects // 10], labels + labels[:n_rects // 10]
+        for metrics, metrics_reference in reference.items():
+            t = timeit.default_timer()
+            expected = metrics_reference(boxes, labels, gt_rects, (w, h), None, False)
+            t_ref += timeit.default_timer() - t
+            t = timeit.default_timer()
+            res = metrics(boxes, labels, gt_rects, (w, h), None, False)
+            t_new += timeit.default_timer() - t
+            assert res == expected, (metrics.__name__, res, expected)
+    print("rects metrics OK: {:.3f}s -> {:.3f}s per page".format(t_ref / n_pages, t_new / n_pages))
+
+
+def page_metric_counts(lines, boxes, labels, gt_text, gt_rects, image_wh, img, do_filter_lonely_rects, metrics_for_lines):
+    """
+    Metric counters of one page, summed over pages by validate_model (see metrics_from_counts)
+    :param lines: recognized lines (already filtered by filter_lonely_rects_for_lines if do_filter_lonely_rects)
+    :param boxes, labels: recognized rects, used if not metrics_for_lines
+    :return: dict counter name -> value
+    """
+    if metrics_for_lines:
+        boxes = []
+        labels = []
+        for ln in lines:
+            boxes += [ch.refined_box for ch in ln.chars]
+            labels += [ch.label for ch in ln.chars]
+    counts = dict()
+    # по rect
+    counts['tp_r'], counts['fp_r'], counts['fn_r'] = dot_metrics_rects(
+        boxes=boxes, labels=labels, gt_rects=gt_rects, image_wh=image_wh, img=img,
+        do_filter_lonely_rects=do_filter_lonely_rects)
+    # по тексту
+    res_text = lines_to_pseudotext(lines)
+    d = Levenshtein.distance(res_text, gt_text)
+    counts['d'] = d
+    counts['d1'] = d/len(gt_text) if len(gt_text) else 0.
+    counts['len'] = len(gt_text)
+    counts['tp'], counts['fp'], counts['fn'] = dot_metrics(res_text, gt_text)
+    # по символам
+    counts['tp_c'], counts['fp_c'], counts['fn_c'] = char_metrics_rects(
+        boxes=boxes, labels=labels, gt_rects=gt_rects, image_wh=image_wh, img=img,
+        do_filter_lonely_rects=do_filter_lonely_rects)
+    return counts
+
+
+def metrics_from_counts(counts, n_docs):
+    """
+    :param counts: sums of page_metric_counts results over n_docs pages
+    :return: metrics dict as validate_model returns
+    """
+    tp_r, fp_r, fn_r = counts['tp_r'], counts['fp_r'], counts['fn_r']
+    tp_c, fp_c, fn_c = counts['tp_c'], counts['fp_c'], counts['fn_c']
+    # precision = tp/(tp+fp)
+    # recall = tp/(tp+fn)
+    precision_r = tp_r/(tp_r+fp_r) if tp_r+fp_r != 0 else 0.
+    recall_r = tp_r/(tp_r+fn_r) if tp_r+fn_r != 0 else 0.
+    precision_c = tp_c/(tp_c+fp_c) if tp_c+fp_c != 0 else 0.
+    recall_c = tp_c/(tp_c+fn_c) if tp_c+fn_c != 0 else 0.
+    return {
+        # 'precision': precision,
+        # 'recall': recall,
+        # 'f1': 2*precision*recall/(precision+recall),
+        'precision_r': precision_r,
+        'recall_r': recall_r,
+        'f1_r': 2*precision_r*recall_r/(precision_r+recall_r) if precision_r+recall_r != 0 else 0.,
+        'precision_c': precision_c,
+        'recall_c': recall_c,
+        'f1_c': 2*precision_c*recall_c/(precision_c+recall_c) if precision_c+recall_c != 0 else 0.,
+        'd_by_doc': counts['d']/n_docs,
+        'd_by_char': counts['d']/counts['len'],
+        'd_by_char_avg': counts['d1']/n_docs
+    }
+
+
 def validate_model(recognizer, data_list, do_filter_lonely_rects, metrics_for_lines = False):
     """
     :param recognizer: infer_retinanet.BrailleInference instance
     :param data_list:  list of (image filename, groundtruth pseudotext)
     :return: (<distance> avg. by documents, <distance> avg. by char, <<distance> avg. by char> avg. by documents>)
     """
-    sum_d = 0
-    sum_d1 = 0.
-    sum_len = 0
-    # по тексту
-    tp = 0
-    fp = 0
-    fn = 0
-    # по rect
-    tp_r = 0
-    fp_r = 0
-    fn_r = 0
-
-    # по символам
-    tp_c = 0
-    fp_c = 0
-    fn_c = 0
-
+    counts = Counter()
     for gt_dict in data_list:
         img_fn, gt_text, gt_rects = gt_dict['image_fn'], gt_dict['gt_text'], gt_dict['gt_rects']
         res_dict = recognizer.run(img_fn,
@@ -414,62 +595,12 @@ def validate_model(recognizer, data_list, do_filter_lonely_rects, metrics_for_li
                     draw.rectangle(b.refined_box, fill="red")
                 img.show()
 
-        if metrics_for_lines:
-            boxes = []
-            labels = []
-            for ln in lines:
-                boxes += [ch.refined_box for ch in ln.chars]
-                labels += [ch.label for ch in ln.chars]
-        else:
-            boxes = res_dict['boxes']
-            labels = res_dict['labels']
-
-        tpi, fpi, fni = dot_metrics_rects(boxes = boxes, labels = labels,
-                                          gt_rects = res_dict['gt_rects'], image_wh = (res_dict['labeled_image'].width, res_dict['labeled_image'].height),
-                                          img=res_dict['labeled_image'], do_filter_lonely_rects=do_filter_lonely_rects)
-        tp_r += tpi
-        fp_r += fpi
-        fn_r += fni
-
-        res_text = lines_to_pseudotext(lines)
-        d = Levenshtein.distance(res_text, gt_text)
-        sum_d += d
-        if len(gt_text):
-            sum_d1 += d/len(gt_text)
-        sum_len += len(gt_text)
-        tpi, fpi, fni = dot_metrics(res_text, gt_text)
-        tp += tpi
-        fp += fpi
-        fn += fni
-
-        tpi, fpi, fni = char_metrics_rects(boxes = boxes, labels = labels,
-                                          gt_rects = res_dict['gt_rects'], image_wh = (res_dict['labeled_image'].width, res_dict['labeled_image'].height),
-                                          img=res_dict['labeled_image'], do_filter_lonely_rects=do_filter_lonely_rects)
-        tp_c += tpi
-        fp_c += fpi
-        fn_c += fni
-
-
-    # precision = tp/(tp+fp)
-    # recall = tp/(tp+fn)
-    precision_r = tp_r/(tp_r+fp_r) if tp_r+fp_r != 0 else 0.
-    recall_r = tp_r/(tp_r+fn_r) if tp_r+fn_r != 0 else 0.
-    precision_c = tp_c/(tp_c+fp_c) if tp_c+fp_c != 0 else 0.
-    recall_c = tp_c/(tp_c+fn_c) if tp_c+fn_c != 0 else 0.
-    return {
-        # 'precision': precision,
-        # 'recall': recall,
-        # 'f1': 2*precision*recall/(precision+recall),
-        'precision_r': precision_r,
-        'recall_r': recall_r,
-        'f1_r': 2*precision_r*recall_r/(precision_r+recall_r) if precision_r+recall_r != 0 else 0.,
-        'precision_c': precision_c,
-        'recall_c': recall_c,
-        'f1_c': 2*precision_c*recall_c/(precision_c+recall_c) if precision_c+recall_c != 0 else 0.,
-        'd_by_doc': sum_d/len(data_list),
-        'd_by_char': sum_d/sum_len,
-        'd_by_char_avg': sum_d1/len(data_list)
-    }
+        counts.update(page_metric_counts(lines, boxes=res_dict['boxes'], labels=res_dict['labels'], gt_text=gt_text,
+                                         gt_rects=res_dict['gt_rects'],
+                                         image_wh=(res_dict['labeled_image'].width, res_dict['labeled_image'].height),
+                                         img=res_dict['labeled_image'], do_filter_lonely_rects=do_filter_lonely_rects,
+                                         metrics_for_lines=metrics_for_lines))
+    return metrics_from_counts(counts, len(data_list))
 
 def evaluate_accuracy(params_fn, model, device, data_list, do_filter_lonely_rects = False, metrics_for_lines = True):
     """
@@ -517,6 +648,13 @@ def evaluate_accuracy(params_fn, model, device, data_list, do_filter_lonely_rect
         tp_c += tpi
         fp_c += fpi
         fn_c += fni
+    return accuracy_from_counts(tp_c, fp_c, fn_c)
+
+
+def accuracy_from_counts(tp_c, fp_c, fn_c):
+    """
+    :return: evaluate_accuracy result for char counts
+    """
     precision_c = tp_c/(tp_c+fp_c) if tp_c+fp_c != 0 else 0.
     recall_c = tp_c/(tp_c+fn_c) if tp_c+fn_c != 0 else 0.
     return {
@@ -525,6 +663,125 @@ def evaluate_accuracy(params_fn, model, device, data_list, do_filter_lonely_rect
         'f1': 2*precision_c*recall_c/(precision_c+recall_c) if precision_c+recall_c != 0 else 0.,
     }
 
+
+class AccuracyEvaluator:
+    """
+    Evaluates accuracy (as evaluate_accuracy does) of a model being trained, i.e. every N epochs.
+    Groundtruth and preprocessed input tensors are prepared once, when created. The live model is switched to
+    eval mode only while evaluating, pages of the same size are run as one batch.
+    """
+    def __init__(self, params_fn, model, device, data_set, do_filter_lonely_rects=False, metrics_for_lines=True,
+                 batch_size=4):
+        """
+        :param model: model (torch.nn.Module) being trained
+        :param data_set: dict key -> data_list (see prepare_data)
+        :param batch_size: max number of pages in a batch
+        """
+        was_training = model.training
+        self.recognizer = infer_retinanet.BrailleInference(
+            params_fn=params_fn,
+            model_weights_fn=model,
+            create_script=None,
+            inference_width=inference_width,
+            device=device,
+            verbose=verbose)
+        model.train(was_training)
+        self.model = model
+        self.device = self.recognizer.impl.device
+        self.do_filter_lonely_rects = do_filter_lonely_rects
+        self.metrics_for_lines = metrics_for_lines
+        self.batch_size = batch_size
+        self.pages = dict()  # key -> list of (input tensor HxW, gt rects, image (width, height))
+        preprocessor = self.recognizer.preprocessor
+        for key, data_list in data_set.items():
+            self.pages[key] = []
+            for gt_dict in data_list:
+                aug_img, aug_gt_rects = infer_retinanet.preprocess_image(preprocessor, PIL.Image.open(gt_dict['image_fn']),
+                                                                         gt_dict['gt_rects'])
+                input_tensor = preprocessor.to_normalized_tensor(aug_img)[0].clone()  # all channels are the same
+                self.pages[key].append((input_tensor, aug_gt_rects, (aug_img.shape[1], aug_img.shape[0])))
+
+    def batches(self, pages):
+        """
+        :return: generator of lists of pages of the same size, up to batch_size pages each
+        """
+        by_shape = defaultdict(list)
+        for page in pages:
+            by_shape[tuple(page[0].shape)].append(page)
+        for same_size_pages in by_shape.values():
+            for i in range(0, len(same_size_pages), self.batch_size):
+                yield same_size_pages[i: i + self.batch_size]
+
+    def evaluate(self):
+        """
+        :return: dict key -> evaluate_accuracy result
+        """
+        impl = self.recognizer.impl
+        was_training = self.model.training
+        self.model.eval()
+        res = dict()
+        try:
+            with torch.no_grad():
+                for key, pages in self.pages.items():
+                    tp_c = 0
+                    fp_c = 0
+                    fn_c = 0
+                    for batch in self.batches(pages):
+                        input_batch = torch.stack([page[0] for page in batch]).to(self.device)
+                        input_batch = input_batch.unsqueeze(1).expand(-1, 3, -1, -1)
+                        h, w = input_batch.shape[2:]
+                        loc_preds, cls_preds = self.model(input_batch)
+                        for (_, gt_rects, image_wh), loc_pred, cls_pred in zip(batch, loc_preds.cpu(), cls_preds.cpu()):
+                            boxes, labels, scores = impl.decode(loc_pred, cls_pred, w, h, impl.cls_thresh, impl.nms_thresh)
+                            boxes = boxes.tolist()
+                            labels = labels.tolist()
+                            lines = postprocess.boxes_to_lines(boxes, labels, lang=lang, scores=scores.tolist())
+                            self.recognizer.refine_lines(lines)
+                            if self.do_filter_lonely_rects:
+                                lines, _ = postprocess.filter_lonely_rects_for_lines(lines)
+                            if self.metrics_for_lines:
+                                boxes = [ch.refined_box for ln in lines for ch in ln.chars]
+                                labels = [ch.label for ln in lines for ch in ln.chars]
+                            tpi, fpi, fni = char_metrics_rects(boxes=boxes, labels=labels, gt_rects=gt_rects,
+                                                               image_wh=image_wh, img=None,
+                                                               do_filter_lonely_rects=self.do_filter_lonely_rects)
+                            tp_c += tpi
+                            fp_c += fpi
+                            fn_c += fni
+                    res[key] = accuracy_from_counts(tp_c, fp_c, fn_c)
+        finally:
+            self.model.train(was_training)
+        return res
+
+TABLE_HEADER = ('model\tweights\tkey\t'
+                'precision\trecall\tf1\t'
+                'precision_c\trecall_C\tf1_c\t'
+                'd_by_doc\td_by_char\td_by_char_avg')
+
+
+def table_row(model_root, model_weights, key, res):
+    """
+    :param res: validate_model result
+    :return: row of table like output of main()
+    """
+    return ('{model}\t{weights}\t{key}\t'
+            '{res[precision_r]:.4}\t{res[recall_r]:.4}\t{res[f1_r]:.4}\t'
+            '{res[precision_c]:.4}\t{res[recall_c]:.4}\t{res[f1_c]:.4}\t'
+            '{res[d_by_doc]:.4}\t{res[d_by_char]:.4}\t'
+            '{res[d_by_char_avg]:.4}'.format(model=model_root, weights=model_weights, key=key, res=res))
+
+
+def model_params_fn(model_root):
+    """
+    :return: path of param file of model (relative to local_config.data_path)
+    """
+    params_fn = Path(local_config.data_path) / model_root / 'param.txt'
+    if not params_fn.is_file():
+        params_fn = Path(local_config.data_path) / (model_root + '.param.txt')  # старый вариант
+        assert params_fn.is_file(), str(params_fn)
+    return params_fn
+
+
 def main(table_like_format):
     # make data list
     for m in models:
@@ -533,10 +790,7 @@ def main(table_like_format):
     prev_model_root = None
 
     if table_like_format:
-        print('model\tweights\tkey\t'
-              'precision\trecall\tf1\t'
-              'precision_c\trecall_C\tf1_c\t'
-              'd_by_doc\td_by_char\td_by_char_avg')
+        print(TABLE_HEADER)
     for model_root, model_weights in models:
         if model_root != prev_model_root:
             if not table_like_format:
@@ -546,10 +800,7 @@ def main(table_like_format):
             prev_model_root = model_root
         if verbose:
             print('evaluating weights: ', model_weights)
-        params_fn = Path(local_config.data_path) / model_root / 'param.txt'
-        if not params_fn.is_file():
-            params_fn = Path(local_config.data_path) / (model_root + '.param.txt')  # старый вариант
-            assert params_fn.is_file(), str(params_fn)
+        params_fn = model_params_fn(model_root)
         recognizer = infer_retinanet.BrailleInference(
             params_fn=params_fn,
             model_weights_fn=os.path.join(local_config.data_path, model_root, model_weights),
@@ -563,11 +814,7 @@ def main(table_like_format):
             #       'd_by_doc: {res[d_by_doc]:.4} d_by_char: {res[d_by_char]:.4} '
             #       'd_by_char_avg: {res[d_by_char_avg]:.4}'.format(model_weights=model_weights, key=key, res=res))
             if table_like_format:
-                print('{model}\t{weights}\t{key}\t'
-                      '{res[precision_r]:.4}\t{res[recall_r]:.4}\t{res[f1_r]:.4}\t'
-                      '{res[precision_c]:.4}\t{res[recall_c]:.4}\t{res[f1_c]:.4}\t'
-                      '{res[d_by_doc]:.4}\t{res[d_by_char]:.4}\t'
-                      '{res[d_by_char_avg]:.4}'.format(model=model_root, weights=model_weights, key=key, res=res))
+                print(table_row(model_root, model_weights, key, res))
             else:
                 print('{model_weights} {key} '
                       'precision_r: {res[precision_r]:.4}, recall_r: {res[recall_r]:.4} f1_r: {res[f1_r]:.4} '
@@ -576,6 +823,8 @@ def main(table_like_format):
 
 if __name__ == '__main__':
     import timeit
+    _check_filter_lonely_rects()
+    _check_rects_metrics()
     infer_retinanet.nms_thresh = 0.02
     postprocess.Line.LINE_THR = 0.6
     do_filter_lonely_rects = False
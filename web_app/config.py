@@ -5,4 +5,8 @@ class Config(object):
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'angilina'
     MODEL_PATH = ""
     DATA_ROOT = os.environ.get('DATA_ROOT') or 'static/data'
-    PERMANENT_SESSION_LIFETIME = datetime.timedelta(minutes=60*24*365*2)
\ No newline at end of file
+    PERMANENT_SESSION_LIFETIME = datetime.timedelta(minutes=60*24*365*2)
+    RECOGNITION_CACHE_SIZE = int(os.environ.get('RECOGNITION_CACHE_SIZE') or 100000)  # 0 disables the cache
+    TEXT_CORRECTION = bool(int(os.environ.get('TEXT_CORRECTION') or 0))  # see postprocess.text_corrections
+    SPELL_WORD_LIST = os.environ.get('SPELL_WORD_LIST') or None  # local word list file for spell correction
+    PERSPECTIVE_ALIGNMENT = bool(int(os.environ.get('PERSPECTIVE_ALIGNMENT') or 0))
@@ -3,7 +3,7 @@
 """
 web application Sinhala Braille reader
 """
-from flask import Flask, render_template, redirect, request, url_for, flash
+from flask import Flask, render_template, redirect, request, url_for, flash, send_file, abort
 from flask_login import LoginManager, current_user, login_user, logout_user, login_required
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, BooleanField, SubmitField, FileField, TextAreaField, HiddenField, SelectField
@@ -11,6 +11,7 @@ from wtforms.validators import DataRequired
 from flask_mobility import Mobility
 from flask_mobility.decorators import mobile_template
 
+import io
 import time
 import json
 import argparse
@@ -18,6 +19,7 @@ from pathlib import Path
 
 from .config import Config
 from .reader_core import AngelinaSolver, VALID_EXTENTIONS
+import braille_utils.result_record as result_record
 
 
 app = Flask(__name__)
@@ -148,23 +150,30 @@ def results(template):
         # full path to image -> "/static/..."
         # data to display in the form
 
-        # GVNC for Compatibility с V2: "/static/..." -> picture name
-        marked_image_path = marked_image_path[1:]
-        # marked_image_path = str(Path(marked_image_path).relative_to(app.config['DATA_ROOT']))
-        # changes_presentation
-        marked_image_path = str(Path(marked_image_path).relative_to(app.config['DATA_ROOT']))
-        marked_image_path = marked_image_path.replace("marked", "labeled")
+        if result_record.is_field_ref(marked_image_path):
+            # results are stored as a single record file: image is served by result_record_image()
+            record_path, field = result_record.split_field_ref(str(Path(marked_image_path).relative_to("/static/data")))
+            if field == "labeled_image" and "image" in result_record.ResultRecord(data_root_path / record_path):
+                field = "image"
+            marked_image_path = result_record.field_ref(record_path, field)
+            image_url = url_for('result_record_image', field_ref=marked_image_path)
+        else:
+            # GVNC for Compatibility с V2: "/static/..." -> picture name
+            marked_image_path = marked_image_path[1:]
+            # marked_image_path = str(Path(marked_image_path).relative_to(app.config['DATA_ROOT']))
+            # changes_presentation
+            marked_image_path = str(Path(marked_image_path).relative_to(app.config['DATA_ROOT']))
+            marked_image_path = marked_image_path.replace("marked", "labeled")
+            image_url = "/" + app.config['DATA_ROOT'] + "/" + marked_image_path
         print(marked_image_path)
         # print("Hi")
         
         recognized_text_path = str(Path(recognized_text_path).relative_to(data_root_path))
         recognized_braille_path = str(Path(recognized_braille_path).relative_to(data_root_path))
 
-        with open(data_root_path / recognized_text_path, encoding="utf-8") as f:
-            out_text = ''.join(f.readlines())
-        with open(data_root_path / recognized_braille_path, encoding="utf-8") as f:
-            out_braille = ''.join(f.readlines())
-        image_paths_and_texts.append(("/" + app.config['DATA_ROOT'] + "/" + marked_image_path, out_text, out_braille,))
+        out_text = result_record.read_result_text(str(data_root_path / recognized_text_path))
+        out_braille = result_record.read_result_text(str(data_root_path / recognized_braille_path))
+        image_paths_and_texts.append((image_url, out_text, out_braille,))
 
         # list with full paths to send to mail form
         file_names.append((str(data_root_path / marked_image_path), str(data_root_path / recognized_text_path)))  # list for
@@ -172,6 +181,21 @@ def results(template):
     form = ResultsForm(results_list=json.dumps(file_names))
     return render_template(template, form=form, image_paths_and_texts=image_paths_and_texts)
 
+@app.route("/result_record/<path:field_ref>")
+@login_required
+def result_record_image(field_ref):
+    """
+    serves image stored in a result record file
+    """
+    record_path, field = result_record.split_field_ref(field_ref)
+    record_path = (data_root_path / record_path).resolve()
+    if data_root_path.resolve() not in record_path.parents or not record_path.is_file():
+        abort(404)
+    rec = result_record.ResultRecord(record_path)
+    if field not in rec:
+        abort(404)
+    return send_file(io.BytesIO(rec.read_bytes(field)), mimetype='image/jpeg')
+
 @app.route("/results_demo")
 @mobile_template('{m/}results_demo.html')
 def results_demo(template):
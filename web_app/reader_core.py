@@ -3,6 +3,7 @@
 """
 Description of interfaces between UI and algorithmic modules
 """
+from collections import OrderedDict
 from datetime import datetime
 from enum import Enum
 import json
@@ -17,6 +18,8 @@ import werkzeug.datastructures
 
 from .config import Config
 import model.infer_retinanet as infer_retinanet
+import braille_utils.result_record as result_record
+from braille_utils.storage import ShardedStorage
 
 MODEL_PATH = Config.MODEL_PATH or Path(__file__).parent.parent
 MODEL_WEIGHTS = 'model.t7'
@@ -106,6 +109,96 @@ def exec_sqlite(con, query, params, timeout=10):
                 raise Exception("{} {} times {} to {} for {}".format(str(e), i, t, t0, query))
             time.sleep(0.1)
 
+def model_weights_id():
+    """
+    Identifies weights of the model used for recognition, so results of different models are not mixed up in the cache
+    """
+    global _model_weights_id
+    if _model_weights_id is None:
+        weights_fn = os.path.join(MODEL_PATH, 'weights', MODEL_WEIGHTS)
+        if os.path.isfile(weights_fn):
+            st = os.stat(weights_fn)
+            _model_weights_id = "{}:{}:{}".format(MODEL_WEIGHTS, st.st_size, int(st.st_mtime))
+        else:
+            _model_weights_id = MODEL_WEIGHTS
+    return _model_weights_id
+
+_model_weights_id = None
+
+
+class RecognitionCache:
+    """
+    Maps hash of uploaded file + recognition params to results of a task that has already processed it,
+    so duplicate uploads are not recognized again.
+    Holds at most max_size entries, least recently used ones are evicted. Evicted entries don't remove result files.
+    """
+    KEY_PARAMS = ('lang', 'find_orientation', 'process_2_sides')
+
+    def __init__(self, db_file_name, max_size):
+        self.db_file_name = db_file_name
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def _sql_conn(self):
+        timeout = 0.1
+        new_db = not os.path.isfile(self.db_file_name)
+        con = sqlite3.connect(str(self.db_file_name), timeout=timeout)
+        if new_db:
+            con.cursor().execute("CREATE TABLE IF NOT EXISTS cache(key text PRIMARY KEY, results text, last_used real)")
+            con.commit()
+        return con
+
+    def make_key(self, raw_paths, param_dict):
+        """
+        :param raw_paths: path of raw file in raw storage. It's name is a hash of file content.
+        :param param_dict: task params
+        """
+        key_data = [Path(raw_paths).name, model_weights_id(), Config.TEXT_CORRECTION,
+                    Config.SPELL_WORD_LIST, Config.PERSPECTIVE_ALIGNMENT] + [param_dict.get(p) for p in self.KEY_PARAMS]
+        return hashlib.sha256(json.dumps(key_data).encode('utf-8')).hexdigest()
+
+    def get(self, key, results_root):
+        """
+        :param results_root: results are paths relative to it. Entries which result files no longer exist are dropped.
+        :return: results (list of (marked image, text, braille)) or None
+        """
+        if self.max_size <= 0:
+            return None
+        con = self._sql_conn()
+        res = exec_sqlite(con, "select results from cache where key=?", (key,))
+        if res:
+            results = json.loads(res[0][0])
+            if all(Path(result_record.split_field_ref(results_root / item)[0] if result_record.is_field_ref(item)
+                        else results_root / item).is_file()
+                   for page in results for item in page):
+                exec_sqlite(con, "update cache set last_used=? where key=?", (time.time(), key))
+                self.hits += 1
+                return results
+            exec_sqlite(con, "delete from cache where key=?", (key,))
+        self.misses += 1
+        return None
+
+    def put(self, key, results):
+        if self.max_size <= 0:
+            return
+        con = self._sql_conn()
+        exec_sqlite(con, "insert or replace into cache(key, results, last_used) values(?, ?, ?)",
+                    (key, json.dumps(results), time.time()))
+        exec_sqlite(con, "delete from cache where key not in"
+                         " (select key from cache order by last_used desc limit ?)", (self.max_size,))
+
+    def stats(self):
+        """
+        :return: dict with hits and misses since start, hit rate and number of cached entries
+        """
+        con = self._sql_conn()
+        size = exec_sqlite(con, "select count(*) from cache", ())[0][0]
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.,
+                "size": size}
+
+
 class AngelinaSolver:
     """
     Provides an interface with the computing system: users, tasks and processing results
@@ -116,7 +209,11 @@ class AngelinaSolver:
         self.raw_images_dir = Path('raw')
         self.results_dir = Path('results')
         os.makedirs(self.data_root, exist_ok=True)
+        self.raw_storage = ShardedStorage(self.data_root / self.raw_images_dir)  # uploads named by content hash
+        self.results_storage = ShardedStorage(self.data_root / self.results_dir)  # results named by doc_id
         self.users_db_file_name = self.data_root / "all_users.db"
+        self.recognition_cache = RecognitionCache(self.data_root / "recognition_cache.db",
+                                                  max_size=Config.RECOGNITION_CACHE_SIZE)
 
     def get_recognizer(self):
         global recognizer
@@ -126,7 +223,10 @@ class AngelinaSolver:
             recognizer = infer_retinanet.BrailleInference(verbose=2,
                 params_fn=os.path.join(MODEL_PATH, 'weights', 'param.txt'),
                 model_weights_fn=os.path.join(MODEL_PATH, 'weights', MODEL_WEIGHTS),
-                create_script=None)
+                create_script=None,
+                correct_text=Config.TEXT_CORRECTION,
+                spell_word_list=Config.SPELL_WORD_LIST,
+                perspective_alignment=Config.PERSPECTIVE_ALIGNMENT)
             print(timeit.default_timer() - t)
         return recognizer
 
@@ -243,10 +343,8 @@ class AngelinaSolver:
         file_ext = Path(task_name).suffix.lower()
         assert file_ext[1:] in VALID_EXTENTIONS, "incorrect file type: " + str(task_name)
 
-        os.makedirs(self.data_root / self.raw_images_dir, exist_ok=True)
-        raw_image_fn = doc_id + file_ext
-        raw_path = self.data_root / self.raw_images_dir / raw_image_fn
-        file_storage.save(str(raw_path))
+        raw_id = self.raw_storage.put_stream(file_storage.stream, suffix=file_ext)
+        raw_image_fn = self.raw_storage.relative_path(raw_id, file_ext).as_posix()
 
         task["raw_paths"] = raw_image_fn
         task["state"] = TaskState.RAW_FILE_LOADED.value
@@ -289,32 +387,61 @@ class AngelinaSolver:
         ### calculations
         task["state"] = TaskState.PROCESSING_STARTED.value
         exec_sqlite(con, "update tasks set state=:state where doc_id=:doc_id", task)
-        file_ext = Path(task["raw_paths"]).suffix.lower()
-        raw_path = self.data_root / self.raw_images_dir / task["raw_paths"]
         param_dict = json.loads(task["params"])
+        cache_key = self.recognition_cache.make_key(task["raw_paths"], param_dict)
+        result_files = self.recognition_cache.get(cache_key, self.data_root / self.results_dir)
+        if result_files is None:
+            result_files = self._recognize(doc_id, task["raw_paths"], param_dict)
+            if result_files is None:
+                task["state"] = TaskState.ERROR.value
+                exec_sqlite(con, "update tasks set state=:state where doc_id=:doc_id", task)
+                return False
+            if result_files:
+                self.recognition_cache.put(cache_key, result_files)
+
+        task["state"] = TaskState.PROCESSING_DONE.value
+        task["results"] = json.dumps(result_files)
+        task["thumbnail"] = "pic.jpg"  # TODO
+        text = result_record.read_result_text(str(self.data_root / self.results_dir / result_files[0][1]))
+        task["thumbnail_desc"] = ''.join(text.splitlines(keepends=True)[:3])
+        exec_sqlite(con, "update tasks set state=:state, results=:results, thumbnail=:thumbnail, thumbnail_desc=:thumbnail_desc where doc_id=:doc_id", task)
+        if gvnc_mode:  # GVNC
+            return False
+        return True
+
+    def _recognize(self, doc_id, raw_paths, param_dict):
+        """
+        Runs recognition of the raw file of the task
+        :return: list of (marked image, text, braille) paths relative to results dir or None in case of error
+        """
+        file_ext = Path(raw_paths).suffix.lower()
+        raw_path = self.data_root / self.raw_images_dir / raw_paths
         if file_ext[1:] == 'zip':
             results_list = self.get_recognizer().process_archive_and_save(raw_path, self.data_root / self.results_dir,
+                                                                    arch_stem=doc_id,
                                                                     lang=param_dict['lang'], extra_info=param_dict,
                                                                     draw_refined=self.get_recognizer().DRAW_NONE,
                                                                     remove_labeled_from_filename=False,
                                                                     find_orientation=param_dict['find_orientation'],
                                                                     align_results=True,
                                                                     process_2_sides=param_dict['process_2_sides'],
-                                                                    repeat_on_aligned=False)
+                                                                    repeat_on_aligned=False,
+                                                                    save_as_record=True,
+                                                                    storage=self.results_storage)
 
         else:
-            results_list = self.get_recognizer().run_and_save(raw_path, self.data_root / self.results_dir, target_stem=None,
+            results_list = self.get_recognizer().run_and_save(raw_path, self.data_root / self.results_dir, target_stem=doc_id,
                                                         lang=param_dict['lang'], extra_info=param_dict,
                                                         draw_refined=self.get_recognizer().DRAW_NONE,
                                                         remove_labeled_from_filename=False,
                                                         find_orientation=param_dict['find_orientation'],
                                                         align_results=True,
                                                         process_2_sides=param_dict['process_2_sides'],
-                                                        repeat_on_aligned=False)
+                                                        repeat_on_aligned=False,
+                                                        save_as_record=True,
+                                                        storage=self.results_storage)
         if results_list is None:
-            task["state"] = TaskState.ERROR.value
-            exec_sqlite(con, "update tasks set state=:state where doc_id=:doc_id", task)
-            return False
+            return None
 
         # full path -> relative to data path
         result_files = list()
@@ -323,15 +450,55 @@ class AngelinaSolver:
             recognized_text_path =  str(Path(recognized_text_path).relative_to(self.data_root / self.results_dir))
             recognized_braille_path = str(Path(recognized_braille_path).relative_to(self.data_root / self.results_dir))
             result_files.append((marked_image_path, recognized_text_path, recognized_braille_path))
+        return result_files
 
-        task["state"] = TaskState.PROCESSING_DONE.value
-        task["results"] = json.dumps(result_files)
-        task["thumbnail"] = "pic.jpg"  # TODO
-        with (self.data_root / self.results_dir / result_files[0][1]).open(encoding="utf-8") as f:
-            task["thumbnail_desc"] = ''.join(f.readlines()[:3])
-        exec_sqlite(con, "update tasks set state=:state, results=:results, thumbnail=:thumbnail, thumbnail_desc=:thumbnail_desc where doc_id=:doc_id", task)
-        if gvnc_mode:  # GVNC
+    def reinterpret(self, task_id, lang=None, thresholds=None):
+        """
+        Redoes recognition of a completed task from raw detections stored with its results, without running the model.
+        Used to switch language or tune postprocessing thresholds quickly.
+        lang: new language or None to keep current one
+        thresholds: dict with any of cls_thresh, nms_thresh, line_thr or None
+        Returns True on success, False if task results have no raw detections (i.e. were produced by older version)
+        """
+        user_id, doc_id = task_id.split("_")
+        con = self._user_tasks_sql_conn(user_id)
+        result = exec_sqlite(con, "select params, state, results from tasks where doc_id=:doc_id", {"doc_id": doc_id})
+        assert len(result) == 1, (user_id, doc_id, len(result))
+        params, state, results = result[0]
+        assert state == TaskState.PROCESSING_DONE.value, (user_id, doc_id, state)
+        param_dict = json.loads(params)
+        if lang:
+            param_dict['lang'] = lang
+        if thresholds:
+            param_dict['thresholds'] = thresholds
+        results_root = self.data_root / self.results_dir
+        record_paths = list(OrderedDict.fromkeys(result_record.split_field_ref(item[0])[0]
+                                                 for item in json.loads(results)
+                                                 if result_record.is_field_ref(item[0])))
+        if not record_paths:
             return False
+        result_files = list()
+        for record_path in record_paths:
+            new_stem = uuid.uuid4().hex
+            try:
+                results_list = self.get_recognizer().reinterpret_and_save(
+                    results_root / record_path, self.results_storage.dir_for(new_stem), new_stem,
+                    lang=param_dict['lang'], draw_refined=self.get_recognizer().DRAW_NONE,
+                    **param_dict.get('thresholds', {}))
+            except ValueError:
+                return False
+            for marked_image_path, recognized_text_path, recognized_braille_path, _ in results_list:
+                result_files.append(tuple(str(Path(p).relative_to(results_root))
+                                          for p in (marked_image_path, recognized_text_path, recognized_braille_path)))
+        text = result_record.read_result_text(str(results_root / result_files[0][1]))
+        task = {
+            "doc_id": doc_id,
+            "params": json.dumps(param_dict),
+            "results": json.dumps(result_files),
+            "thumbnail_desc": ''.join(text.splitlines(keepends=True)[:3]),
+        }
+        exec_sqlite(con, "update tasks set params=:params, results=:results, thumbnail_desc=:thumbnail_desc"
+                         " where doc_id=:doc_id", task)
         return True
 
     def get_results(self, task_id):